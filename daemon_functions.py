@@ -0,0 +1,121 @@
+import http.server
+import json
+import logging
+import os
+import shutil
+import threading
+import urllib.parse
+
+import store_functions
+
+if __name__ == "__main__":
+    print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
+    exit(1)
+
+
+# Local HTTP API:
+#   POST /jobs?filename=file.exe&vms=vm1,/group&snapshots=clean  (file as request body) - submit job, returns job ID
+#   GET /jobs                                                   - list of jobs
+#   GET /jobs/<id>                                              - job status and results
+#   GET /jobs/<id>/artifacts                                    - list of job artifacts (reports directory, store)
+#   GET /jobs/<id>/artifacts/<name>                             - download artifact
+#   DELETE /jobs/<id>                                           - cancel job (queued tasks removed, running stopped)
+# Server object has callbacks set by daemon_start().
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug('API: %s ' + format, self.address_string(), *args)
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        if path == ['jobs']:
+            self.send_json(200, self.server.list_jobs())
+            return
+        if len(path) < 2 or path[0] != 'jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        job = self.server.get_job(path[1])
+        if not job:
+            self.send_json(404, {'error': f'Job {path[1]} not found'})
+            return
+        if len(path) == 2:
+            self.send_json(200, job)
+            return
+
+        # Artifacts are files in reports directory of the job's file and files of job's tasks moved to artifact store
+        artifacts_directory = f'{self.server.reports_directory}/{job["sha256"]}'
+        artifacts = {}
+        if os.path.isdir(artifacts_directory):
+            artifacts = {name: f'{artifacts_directory}/{name}' for name in os.listdir(artifacts_directory)}
+        if self.server.store_directory:
+            for task in job.get('tasks', []):
+                for name, blob in task.get('artifacts', {}).items():
+                    artifacts[name] = store_functions.blob_path(self.server.store_directory, blob)
+        if path[2:] == ['artifacts']:
+            self.send_json(200, sorted(artifacts))
+        elif len(path) == 4 and path[2] == 'artifacts' and os.path.isfile(artifacts.get(path[3], '')):
+            artifact = artifacts[path[3]]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(artifact)))
+            self.end_headers()
+            with open(artifact, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path.strip('/') != 'jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        query = urllib.parse.parse_qs(url.query)
+        filename = query.get('filename', [''])[0]
+        vms_list = [vm for vms in query.get('vms', []) for vm in vms.split(',') if vm]
+        snapshots_list = [snapshot for snapshots in query.get('snapshots', []) for snapshot in snapshots.split(',')
+                          if snapshot]
+        length = int(self.headers.get('Content-Length', 0))
+        if not filename or not length:
+            self.send_json(400, {'error': 'File name and file content are required'})
+            return
+        result = self.server.submit_job(filename, self.rfile.read(length), vms_list, snapshots_list)
+        if result[0] == 0:
+            self.send_json(202, result[1])
+        else:
+            self.send_json(400, {'error': result[1]})
+
+    def do_DELETE(self):
+        path = urllib.parse.urlparse(self.path).path.strip('/').split('/')
+        if len(path) != 2 or path[0] != 'jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        job = self.server.cancel_job(path[1])
+        if job:
+            self.send_json(200, job)
+        else:
+            self.send_json(404, {'error': f'Job {path[1]} not found'})
+
+
+# Start local HTTP API in background thread.
+# submit_job(filename, data, vms_list, snapshots_list) returns (0, job) or (1, error),
+# get_job(job_id) returns job or None, list_jobs() returns list of jobs, cancel_job(job_id) returns job or None.
+def daemon_start(port, submit_job, get_job, list_jobs, cancel_job, reports_directory='reports', address='127.0.0.1',
+                 store_directory=None):
+    server = http.server.ThreadingHTTPServer((address, port), DaemonRequestHandler)
+    server.daemon_threads = True
+    server.submit_job = submit_job
+    server.get_job = get_job
+    server.list_jobs = list_jobs
+    server.cancel_job = cancel_job
+    server.reports_directory = reports_directory
+    server.store_directory = store_directory
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f'Daemon API is listening on http://{address}:{port}/jobs')
+    return server
@@ -1,139 +1,291 @@
 import argparse
+import atexit
+import concurrent.futures
+import contextlib
+import contextvars
 import logging
 import os
+import secrets
+import signal
+import socket
 import threading
 import time
-import http.client
 
 script_version = '0.11'
 
 try:
+    import health_functions
+    import metrics_functions
+    import queue_functions
     import support_functions
     import vm_functions
 except ModuleNotFoundError:
-    print('Unable to import support_functions and/or vm_functions. Exiting.')
+    print('Unable to import health_functions, metrics_functions, queue_functions, support_functions and/or '
+          'vm_functions. Exiting.')
     exit(1)
 
-# Parse command line arguments
-parser = argparse.ArgumentParser(prog='vm-automation', description=f'''VirtualBox VM automation {script_version};
-                                                                   https://github.com/Pernat1y/vm-automation''')
-
-required_options = parser.add_argument_group('Required options')
-required_options.add_argument('file', type=str, nargs='+', help='Path to file')
-required_options.add_argument('--vms', '-v', type=str, nargs='*', required=True,
-                              help='Space-separated list of VMs to use')
-required_options.add_argument('--snapshots', '-s', type=str, nargs='*', required=True,
-                              help='Space-separated list of snapshots to use')
-
-main_options = parser.add_argument_group('Main options')
-main_options.add_argument('--vboxmanage', default='vboxmanage', type=str, nargs='?',
-                          help='Path to vboxmanage binary (default: %(default)s)')
-main_options.add_argument('--check_version', action='store_true',
-                          help='Check for latest VirtualBox version online (default: %(default)s)')
-main_options.add_argument('--timeout', default=60, type=int, nargs='?',
-                          help='Timeout in seconds for both commands and VM (default: %(default)s)')
-main_options.add_argument('--delay', default=7, type=int, nargs='?',
-                          help='Delay in seconds before/after starting VMs (default: %(default)s)')
-main_options.add_argument('--threads', default=2, choices=range(9), type=int, nargs='?',
-                          help='Number of concurrent threads to run (0=number of VMs, default: %(default)s)')
-main_options.add_argument('--verbosity', default='info', choices=['debug', 'info', 'error', 'off'], type=str, nargs='?',
-                          help='Log verbosity level (default: %(default)s)')
-main_options.add_argument('--debug', action='store_true',
-                          help='Print all messages. Alias for "--verbosity debug" (default: %(default)s)')
-main_options.add_argument('--log', default=None, type=str, nargs='?',
-                          help='Path to log file (default: %(default)s) (console)')
-main_options.add_argument('--report', action='store_true',
-                          help='Generate html report (default: %(default)s)')
-main_options.add_argument('--record', action='store_true',
-                          help='Record video of guest\' screen (default: %(default)s)')
-main_options.add_argument('--pcap', action='store_true',
-                          help='Enable recording of VM\'s traffic (default: %(default)s)')
-main_options.add_argument('--memdump', action='store_true', help='Dump memory VM (default: %(default)s)')
-main_options.add_argument('--no_time_sync', action='store_true',
-                          help='Disable host-guest time sync for VM (default: %(default)s)')
-
-guests_options = parser.add_argument_group('VM options')
-guests_options.add_argument('--ui', default='gui', choices=['1', '0', 'gui', 'headless'], nargs='?',
-                            help='Start VMs in GUI or headless mode (default: %(default)s)')
-guests_options.add_argument('--login', '--user', default='user', type=str, nargs='?',
-                            help='Login for guest OS (default: %(default)s)')
-guests_options.add_argument('--password', default='12345678', type=str, nargs='?',
-                            help='Password for guest OS (default: %(default)s)')
-guests_options.add_argument('--remote_folder', default='desktop', choices=['desktop', 'downloads', 'documents', 'temp'],
-                            type=str, nargs='?',
-                            help='Destination folder in guest OS to place file. (default: %(default)s)')
-guests_options.add_argument('--open_with', default='%windir%\\explorer.exe', type=str,
-                            nargs='?', help='Absolute path to app, which will open main file (default: %(default)s)')
-guests_options.add_argument('--file_args', default=None, type=str, nargs='?',
-                            help='Argument to pass to the main file/executable (default: %(default)s)')
-guests_options.add_argument('--network', default=None, choices=['on', 'off'], nargs='?',
-                            help='State of network adapter of guest OS (default: %(default)s)')
-guests_options.add_argument('--resolution', default=None, type=str, nargs='?',
-                            help='Screen resolution for guest OS. Can be set to "random" (default: %(default)s)')
-guests_options.add_argument('--mac', default=None, type=str, nargs='?',
-                            help='Set MAC address for guest OS. Can be set to "random" (default: %(default)s)')
-guests_options.add_argument('--get_file', default=None, type=str, nargs='?',
-                            help='Get specific file from guest OS before stopping VM (default: %(default)s)')
-guests_options.add_argument('--pre', default=None, type=str, nargs='?',
-                            help='Script to run before main file (default: %(default)s)')
-guests_options.add_argument('--post', default=None, type=str, nargs='?',
-                            help='Script to run after main file (default: %(default)s)')
-
-args = parser.parse_args()
-
-# Main options
-filename = args.file[0]
-vms_list = args.vms
-snapshots_list = args.snapshots
-threads = args.threads
-timeout = args.timeout
-delay = args.delay
-verbosity = args.verbosity
-debug = args.debug
-log = args.log
-report = args.report
-record = args.record
-pcap = args.pcap
-memdump = args.memdump
-no_time_sync = args.no_time_sync
-
-# vm_functions options
-vm_functions.vboxmanage_path = args.vboxmanage
-check_version = args.check_version
-ui = args.ui
-vm_functions.timeout = timeout
-
-# VM options
-vm_pre_exec = args.pre
-vm_post_exec = args.post
-vm_login = args.login
-vm_password = args.password
-remote_folder = args.remote_folder
-open_with = args.open_with
-file_args = args.file_args
-vm_network_state = args.network
-vm_resolution = args.resolution
-vm_mac = args.mac
-vm_get_file = args.get_file
+
+# Command line arguments
+def config_parser():
+    parser = argparse.ArgumentParser(prog='vm-automation', description=f'''VirtualBox VM automation {script_version};
+                                                                       https://github.com/Pernat1y/vm-automation''')
+
+    required_options = parser.add_argument_group('Required options')
+    required_options.add_argument('file', type=str, nargs='*', help='Path to file')
+    required_options.add_argument('--vms', '-v', type=str, nargs='*',
+                                  help='Space-separated list of VMs or VM groups ("/group") to use. '
+                                       'Tasks for group run on any free VM in that group')
+    required_options.add_argument('--snapshots', '-s', type=str, nargs='*',
+                                  help='Space-separated list of snapshots to use')
+
+    main_options = parser.add_argument_group('Main options')
+    main_options.add_argument('--vboxmanage', default='vboxmanage', type=str, nargs='?',
+                              help='Path to vboxmanage binary (default: %(default)s)')
+    main_options.add_argument('--record_commands', default=None, type=str, nargs='?', const='cassette.jsonl',
+                              help='Record vboxmanage commands, their output and duration to file (default file: '
+                                   'cassette.jsonl)')
+    main_options.add_argument('--replay_commands', default=None, type=str, nargs='?', const='cassette.jsonl',
+                              help='Do not run vboxmanage, use output of commands recorded with "--record_commands" '
+                                   '(default file: cassette.jsonl)')
+    main_options.add_argument('--replay_speed', default=0, type=float, nargs='?',
+                              help='Speed of replay: 1=recorded duration of commands, 10=10 times faster, '
+                                   '0=no delay (default: %(default)s)')
+    main_options.add_argument('--check_version', action='store_true',
+                              help='Check for latest VirtualBox version online (default: %(default)s)')
+    main_options.add_argument('--timeout', default=60, type=int, nargs='?',
+                              help='Timeout in seconds for both commands and VM '
+                                   '(0=no command timeout, default: %(default)s)')
+    main_options.add_argument('--delay', default=7, type=int, nargs='?',
+                              help='Delay in seconds before/after starting VMs (default: %(default)s)')
+    main_options.add_argument('--wait_login', action='store_true',
+                              help='After start wait until user is logged in to guest OS (up to timeout) instead of '
+                                   'fixed delay (default: %(default)s)')
+    main_options.add_argument('--phase_timeout', default=300, type=int, nargs='?',
+                              help='Time budget in seconds for every task phase (restore, boot, upload, etc.) on top '
+                                   'of delay and timeout. Task is cancelled and VM is stopped if phase takes longer '
+                                   '(0=disabled, default: %(default)s)')
+    main_options.add_argument('--threads', default=2, choices=range(9), type=int, nargs='?',
+                              help='Number of concurrent threads to run (0=number of VMs, default: %(default)s)')
+    main_options.add_argument('--plan', action='store_true',
+                              help='Print schedule of tasks and their expected duration (by timings of previous runs), '
+                                   'VM utilisation and bottleneck phase without running tasks (default: %(default)s)')
+    main_options.add_argument('--verbosity', default='info', choices=['debug', 'info', 'error', 'off'], type=str,
+                              nargs='?',
+                              help='Log verbosity level (default: %(default)s)')
+    main_options.add_argument('--debug', action='store_true',
+                              help='Print all messages. Alias for "--verbosity debug" (default: %(default)s)')
+    main_options.add_argument('--log', default=None, type=str, nargs='?',
+                              help='Path to log file (default: %(default)s) (console)')
+    main_options.add_argument('--log_format', default='text', choices=['text', 'json'], type=str, nargs='?',
+                              help='Log format: text or JSON document per line (default: %(default)s)')
+    main_options.add_argument('--log_queue', action='store_true',
+                              help='Write log from background thread, so tasks are not blocked by logging '
+                                   '(default: %(default)s)')
+    main_options.add_argument('--report', action='store_true',
+                              help='Generate html report (default: %(default)s)')
+    main_options.add_argument('--store', default=None, type=str, nargs='?', const='reports/store',
+                              help='Move screenshots, traffic dumps, recordings, memory dumps and downloaded files to '
+                                   'artifact store, where identical files are kept once. Report references them by '
+                                   'hash. Implies "--report" (default directory: reports/store)')
+    main_options.add_argument('--store_retention', default=None, type=int, nargs='?',
+                              help='Remove references to artifacts older than N days and artifacts which are not '
+                                   'referenced from store and exit (default: %(default)s)')
+    main_options.add_argument('--record', action='store_true',
+                              help='Record video of guest\' screen (default: %(default)s)')
+    main_options.add_argument('--record_profile', default='normal', choices=['low', 'normal', 'high'], type=str,
+                              nargs='?',
+                              help='Screen recording profile: low (2 fps, 128 kbps) for bulk runs, normal (10 fps, '
+                                   '512 kbps) or high (30 fps, 1228 kbps) for triage (default: %(default)s)')
+    main_options.add_argument('--pcap', action='store_true',
+                              help='Enable recording of VM\'s traffic (default: %(default)s)')
+    main_options.add_argument('--memdump', action='store_true', help='Dump memory VM (default: %(default)s)')
+    main_options.add_argument('--memdump_diff', action='store_true',
+                              help='Dump memory VM and keep only pages changed since clean snapshot. '
+                                   'Baseline dump is taken once per VM/snapshot (default: %(default)s)')
+    main_options.add_argument('--no_time_sync', action='store_true',
+                              help='Disable host-guest time sync for VM (default: %(default)s)')
+    main_options.add_argument('--search', default=None, type=str, nargs='?',
+                              help='Search results of previous runs for domain/host and exit (default: %(default)s)')
+
+    main_options.add_argument('--journal', default=None, type=str, nargs='?', const='journal.jsonl',
+                              help='Save state of every task to journal file, so batch can be resumed (default file: '
+                                   'journal.jsonl)')
+    main_options.add_argument('--resume', action='store_true',
+                              help='Stop VMs left running and run unfinished tasks from journal (default: %(default)s)')
+    main_options.add_argument('--daemon', default=None, type=int, nargs='?', const=8080,
+                              help='Run as daemon and accept jobs over local HTTP API on specified port '
+                                   '(default port: 8080)')
+    main_options.add_argument('--metrics_port', default=None, type=int, nargs='?', const=9100,
+                              help='Serve metrics in Prometheus format on http://127.0.0.1:<port>/metrics '
+                                   '(default port: 9100)')
+    main_options.add_argument('--metrics_file', default=None, type=str, nargs='?', const='metrics.prom',
+                              help='Save metrics in Prometheus format to file after every task '
+                                   '(default file: metrics.prom)')
+
+    queue_options = parser.add_argument_group('Queue options (multi-host execution)')
+    queue_options.add_argument('--queue', default=None, type=str, nargs='?',
+                               help='Path to shared job queue (SQLite database) (default: %(default)s)')
+    queue_options.add_argument('--submit', action='store_true',
+                               help='Add jobs for file/VMs/snapshots to the queue and exit (default: %(default)s)')
+    queue_options.add_argument('--worker', action='store_true',
+                               help='Advertise local VMs (all or "--vms") and run jobs from the queue '
+                                    '(default: %(default)s)')
+    queue_options.add_argument('--status', action='store_true',
+                               help='Show number of jobs in the queue and list of workers and exit '
+                                    '(default: %(default)s)')
+
+    provision_options = parser.add_argument_group('Provisioning options')
+    provision_options.add_argument('--provision', default=None, type=str, nargs='?',
+                                   help='Import image (OVA/OVF) as base VM, create clones with baseline snapshot '
+                                        '(first of "--snapshots" or "clean") in group "/<base_vm>" and exit. Import '
+                                        'is skipped if image is not changed (default: %(default)s)')
+    provision_options.add_argument('--clones', default=1, type=int, nargs='?',
+                                   help='Number of clones to create, in parallel ("--threads") (default: %(default)s)')
+    provision_options.add_argument('--clone_mode', default='linked', choices=['linked', 'full'], type=str, nargs='?',
+                                   help='Linked clones share disks of base VM, full clones are independent copies '
+                                        '(default: %(default)s)')
+    provision_options.add_argument('--base_vm', default=None, type=str, nargs='?',
+                                   help='Name of base VM (default: name of image file)')
+    provision_options.add_argument('--inventory', default='inventory.json', type=str, nargs='?',
+                                   help='Inventory of provisioned VMs and hashes of images (default: %(default)s)')
+
+    backup_options = parser.add_argument_group('Backup retention options (remove old vm_backup() snapshots of idle VMs '
+                                               'from "--vms" and exit)')
+    backup_options.add_argument('--keep_backups', default=None, type=int, nargs='?',
+                                help='Keep last N backups (default: %(default)s)')
+    backup_options.add_argument('--max_backup_age', default=None, type=int, nargs='?',
+                                help='Keep backups taken within N days (default: %(default)s)')
+
+    health_options = parser.add_argument_group('Health check options')
+    health_options.add_argument('--health', action='store_true',
+                                help='Check VMs and snapshots from "--vms" and "--snapshots" in parallel: restore, '
+                                     'boot, guest login and file stat, IP address, screenshot. Save results to '
+                                     '"--health_file" and exit (default: %(default)s)')
+    health_options.add_argument('--health_file', default='health.json', type=str, nargs='?',
+                                help='Results of health checks. VMs/snapshots which failed last check are not used '
+                                     'for tasks (default: %(default)s)')
+
+    guests_options = parser.add_argument_group('VM options')
+    guests_options.add_argument('--ui', default='gui', choices=['1', '0', 'gui', 'headless'], nargs='?',
+                                help='Start VMs in GUI or headless mode (default: %(default)s)')
+    guests_options.add_argument('--login', '--user', default='user', type=str, nargs='?',
+                                help='Login for guest OS (default: %(default)s)')
+    guests_options.add_argument('--password', default='12345678', type=str, nargs='?',
+                                help='Password for guest OS (default: %(default)s)')
+    guests_options.add_argument('--remote_folder', default='desktop',
+                                choices=['desktop', 'downloads', 'documents', 'temp'], type=str, nargs='?',
+                                help='Destination folder in guest OS to place file. (default: %(default)s)')
+    guests_options.add_argument('--open_with', default='%windir%\\explorer.exe', type=str, nargs='?',
+                                help='Absolute path to app, which will open main file (default: %(default)s)')
+    guests_options.add_argument('--file_args', default=None, type=str, nargs='?',
+                                help='Argument to pass to the main file/executable (default: %(default)s)')
+    guests_options.add_argument('--network', default=None, choices=['on', 'off'], nargs='?',
+                                help='State of network adapter of guest OS (default: %(default)s)')
+    guests_options.add_argument('--network_profiles', default=None, type=str, nargs='*',
+                                choices=['offline', 'nat', 'hostonly', 'internal'],
+                                help='Run every task with each network profile of first adapter (in one report): '
+                                     'offline (link is down), nat, hostonly ("--hostonly_adapter"), internal '
+                                     '("--internal_network"). Overrides "--network"')
+    guests_options.add_argument('--hostonly_adapter', default='vboxnet0', type=str, nargs='?',
+                                help='Host-only adapter for "hostonly" network profile (default: %(default)s)')
+    guests_options.add_argument('--internal_network', default='vm-automation', type=str, nargs='?',
+                                help='Internal network for "internal" network profile (default: %(default)s)')
+    guests_options.add_argument('--responder_vm', default=None, type=str, nargs='?',
+                                help='VM with fake internet services (DNS, HTTP, etc.) attached to internal network. '
+                                     'Started before first task with "internal" network profile and left running '
+                                     '(default: %(default)s)')
+    guests_options.add_argument('--resolution', default=None, type=str, nargs='?',
+                                help='Screen resolution for guest OS. Can be set to "random" (default: %(default)s)')
+    guests_options.add_argument('--mac', default=None, type=str, nargs='?',
+                                help='Set MAC address for guest OS. Can be set to "random" (default: %(default)s)')
+    guests_options.add_argument('--get_file', default=None, type=str, nargs='?',
+                                help='Get specific file from guest OS before stopping VM (default: %(default)s)')
+    guests_options.add_argument('--pre', default=None, type=str, nargs='?',
+                                help='Script to run before main file (default: %(default)s)')
+    guests_options.add_argument('--post', default=None, type=str, nargs='?',
+                                help='Script to run after main file (default: %(default)s)')
+    return parser
+
+
+# Fill in options which depend on other options
+def normalize_config(config):
+    config.filename = config.file[0] if config.file else None
+    config.vms = config.vms or ['all']
+    config.snapshots = config.snapshots or ['all']
+    if config.memdump_diff:
+        config.memdump = True
+    if config.store:
+        config.report = True
+    if config.debug:
+        config.verbosity = 'debug'
+    return config
+
+
+# Return configuration (argparse.Namespace) from command line arguments. Options can be set as keyword arguments
+# too, so tasks can be run from other scripts:
+#   demo_cli.configure(demo_cli.parse_config(['file.exe'], vms=['vm1'], snapshots=['clean'], report=True))
+def parse_config(argv=None, **options):
+    config = config_parser().parse_args([] if argv is None and options else argv)
+    for option, value in options.items():
+        if not hasattr(config, option):
+            raise ValueError(f'Unknown option: {option}')
+        setattr(config, option, value)
+    return normalize_config(config)
+
+
+# Configuration used by all functions below, set by configure()
+config = None
+
+
+# Set configuration and apply it to vm_functions. Commands may be recorded or replayed instead of running vboxmanage
+def configure(new_config):
+    global config
+    config = new_config
+    backend = vm_functions.subprocess_backend
+    if config.replay_commands:
+        backend = vm_functions.ReplayBackend(config.replay_commands, speed=config.replay_speed)
+    if config.record_commands:
+        backend = vm_functions.RecordingBackend(config.record_commands, backend=backend)
+    vm_functions.default_client = vm_functions.VBoxClient(config.vboxmanage, timeout=config.timeout, backend=backend)
+    return config
+
+
+# Worker name for the queue
+worker_name = socket.gethostname()
+busy_vms = set()
+busy_lock = threading.Lock()
+vm_last_used = {}
+
+# Jobs to run, snapshots of VMs, jobs submitted to daemon
+jobs_list = []
+vms_snapshots = {}
+daemon_jobs = {}
+
+# Cancellation: set on SIGINT/SIGTERM, no new tasks are started after that.
+# Every running task has own cancel token: {'vm': (job, token)}
+cancel_event = threading.Event()
+running_tasks = {}
+
+# VMs to use as {'vm': '/group'}
+vms_groups = {}
+
+# VMs/snapshots which failed health check: {'vm/snapshot'}
+unhealthy_tasks = set()
+
+# VM with fake internet services for 'internal' network profile is started once
+responder_lock = threading.Lock()
+responder_started = threading.Event()
+
+# Guest properties watched while task runs: logged in users, IP addresses and markers set by scripts in guest OS
+# ('VBoxControl guestproperty set /VMAutomation/<name> <value>'). IP addresses and markers are saved to task results
+watched_properties = '/VirtualBox/GuestInfo/OS/LoggedInUsers|/VirtualBox/GuestInfo/Net/*/V4/IP|/VMAutomation/*'
 
 # Some VirtualBox commands require full path to file
 cwd = os.getcwd()
 
-# Logging options
-if debug:
-    verbosity = 'debug'
-if log == 'off':
-    logging.disable()
-elif verbosity in ['error', 'info', 'debug']:
-    log_levels = {'error': logging.ERROR,
-                  'info': logging.INFO,
-                  'debug': logging.DEBUG}
-    if log == 'console':
-        vm_functions.logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=log_levels[verbosity])
-    else:
-        vm_functions.logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=log_levels[verbosity],
-                                         filename=log, filemode='a')
-    vm_functions.logger = logging.getLogger('vm-automation')
+# Html reports are written by one background thread (in order), so VM is released before thumbnails of screenshots are
+# created. Remaining reports are written before exit
+report_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='report')
 
 
 # Show general info
@@ -144,7 +296,8 @@ def show_info():
     logging.info(f'VirtualBox version: {vbox_version}\n')
 
     # Check for VirtualBox version
-    if check_version:
+    if config.check_version:
+        import http.client
         print(f'Script version: {script_version}')
         conn = http.client.HTTPSConnection("download.virtualbox.org")
         conn.request("GET", "/virtualbox/LATEST-STABLE.TXT")
@@ -158,9 +311,11 @@ def show_info():
         else:
             logging.warning('Unable to check for VirtualBox version.')
 
-    logging.info(f'VMs: {vms_list}')
-    logging.info(f'Snapshots: {snapshots_list}\n')
-    result = support_functions.file_info(filename)
+    logging.info(f'VMs: {config.vms}')
+    logging.info(f'Snapshots: {config.snapshots}\n')
+    if not config.filename:
+        return None, None, None
+    result = support_functions.file_info(config.filename)
     if result[0] != 0:
         logging.error('Error while processing file. Exiting.')
         exit(1)
@@ -168,11 +323,11 @@ def show_info():
 
 
 # Function to take screenshot on guest OS
-def take_screenshot(vm, task_name):
+def take_screenshot(vm, task_name, sha256):
     screenshot_index = 1
     while screenshot_index < 10000:
         screenshot_index_zeros = str(screenshot_index).zfill(4)
-        if report:
+        if config.report:
             screenshot_name_num = f'reports/{sha256}/{task_name}_{screenshot_index_zeros}.png'
         else:
             screenshot_name_num = f'{task_name}_{screenshot_index_zeros}.png'
@@ -183,201 +338,906 @@ def take_screenshot(vm, task_name):
             break
 
 
-# Main routines
-def main_routine(vm, snapshots_list):
-    for snapshot in snapshots_list:
-        task_name = f'{vm}_{snapshot}'
-        logging.info(f'{task_name}: Task started')
+# Save duration of task phase to timings. Returns start time of the next phase
+def phase_finished(timings, phase, phase_started):
+    now = time.time()
+    timings[phase] = round(now - phase_started, 2)
+    return now
 
-        # Create directory for report
-        if report:
-            os.makedirs(f'reports/{sha256}', mode=0o444, exist_ok=True)
 
-        # Stop VM, restore snapshot
-        vm_functions.vm_stop(vm, ignore_status_error=1)
-        time.sleep(delay / 2)
-        result = vm_functions.vm_snapshot_restore(vm, snapshot, ignore_status_error=1)
-        if result[0] != 0:
-            # If we were unable to restore snapshot - continue to the next snapshot/VM
-            logging.error(f'Unable to restore VM "{vm}" to snapshot "{snapshot}". Skipping.')
-            vm_functions.vm_stop(vm, ignore_status_error=1)
-            continue
-        # Change MAC address
-        if vm_mac:
-            vm_functions.vm_set_mac(vm, vm_mac)
-        # Disable time sync
-        if no_time_sync:
-            vm_functions.vm_disable_time_sync(vm)
-        # Dump traffic
-        if pcap:
-            if vm_network_state == 'off':
-                logging.warning('Traffic dump enabled, but network state is set to \'off\'.')
-            if report:
-                pcap_file = f'{cwd}/reports/{sha256}/{vm}_{snapshot}.pcap'
-            else:
-                pcap_file = f'{cwd}/{vm}_{snapshot}.pcap'
-            vm_functions.vm_pcap(vm, pcap_file)
+# Start watchdog for task phase: task is cancelled if phase takes longer than its time budget.
+# Watchdog of previous phase is stopped. Returns new watchdog (None if phase is not set or budget is disabled)
+def phase_watchdog(cancel_token, task_record, phase=None, watchdog=None):
+    if watchdog:
+        watchdog.cancel()
+    if not phase or not config.phase_timeout:
+        return None
+    budget = config.phase_timeout + config.delay + (config.timeout if phase == 'exec' else 0)
+
+    def phase_expired():
+        logging.error(f'{task_record["vm"]}_{task_record["snapshot"]}: Phase "{phase}" took longer than {budget} '
+                      f'seconds. Cancelling task.')
+        task_record['error'] = f'{phase} timeout'
+        cancel_token.set()
+
+    # Run in context of task, so log records of watchdog have task set
+    watchdog = threading.Timer(budget, contextvars.copy_context().run, args=(phase_expired,))
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
+
+
+# Clean up after cancelled task: stop recording, power off VM, disable traffic dump and recording in VM settings and
+# save partial results. Status is 'failed' for phase timeout, 'interrupted' for signal and 'cancelled' otherwise
+def task_cancelled(vm, task_record, watchdog=None):
+    phase_watchdog(None, task_record, watchdog=watchdog)
+    logging.warning(f'{vm}_{task_record["snapshot"]}: Task cancelled. Stopping VM.')
+    if config.record:
+        result = vm_functions.vm_info(vm)
+        if result[0] == 0 and result[1].get('VMState') == 'running':
+            vm_functions.vm_record_stop(vm)
+    vm_functions.vm_stop(vm, ignore_status_error=1)
+    if config.pcap or config.record:
+        vm_functions.vm_capture_off(vm)
+    if task_record.get('error'):
+        task_record['status'] = 'failed'
+    elif cancel_event.is_set():
+        task_record['status'] = 'interrupted'
+    else:
+        task_record['status'] = 'cancelled'
+    if config.report:
+        support_functions.save_results(task_record)
+    return task_record
+
+
+# Cancel all tasks on SIGINT/SIGTERM: running tasks are stopped and cleaned up, queued tasks are kept in journal.
+# Second signal exits immediately
+def cancel_all(signum, frame):
+    if cancel_event.is_set():
+        logging.critical('Exiting without cleanup.')
+        os._exit(1)
+    logging.warning(f'Received {signal.Signals(signum).name}. Cancelling tasks, press Ctrl+C again to exit now.')
+    cancel_event.set()
+    for job, cancel_token in list(running_tasks.values()):
+        cancel_token.set()
 
-        # Start VM
-        time.sleep(delay / 2)
-        result = vm_functions.vm_start(vm, ui)
+
+# Wait for background operation (e.g. memory dump), checking cancel token. Returns result of operation or None if
+# task was cancelled
+def operation_wait(operation, cancel_token):
+    while operation.wait(1) is None:
+        if cancel_token.is_set():
+            return None
+    return operation.result
+
+
+# Update metrics with task results: status and durations of phases
+def task_metrics(task_record):
+    metrics_functions.metrics_inc('vm_automation_tasks_total', status=task_record['status'])
+    for phase, duration in task_record.get('timings', {}).items():
+        metrics_functions.metrics_observe('vm_automation_phase_seconds', duration, phase=phase)
+    if config.metrics_file:
+        metrics_functions.metrics_dump(config.metrics_file)
+
+
+# Start VM with fake internet services (if set) before first task with 'internal' network profile
+def responder_start():
+    with responder_lock:
+        if not config.responder_vm or responder_started.is_set():
+            return 0
+        result = vm_functions.vm_info(config.responder_vm)
+        if result[0] == 0 and result[1].get('VMState') != 'running':
+            result = vm_functions.vm_start(config.responder_vm, 'headless')
         if result[0] != 0:
-            # If we were unable to start VM - continue to the next one
-            logging.error(f'Unable to start VM "{vm}". Skipping.')
+            logging.error(f'Unable to start responder VM "{config.responder_vm}".')
+            return result[0]
+        responder_started.set()
+    return 0
+
+
+# Save task state to journal
+def task_state(task_id, state, **data):
+    if config.journal and task_id:
+        queue_functions.journal_write(config.journal, task_id, state, **data)
+
+
+# Run one task: analyse file on VM restored to snapshot (with network profile, if set). Returns task results
+# Task is cancelled when cancel_token (threading.Event) is set: checked between phases and while waiting
+def task_routine(vm, snapshot, filename, sha256, md5, file_size, task_id=None, cancel_token=None,
+                 network_profile=None):
+    task_name = f'{vm}_{snapshot}_{network_profile}' if network_profile else f'{vm}_{snapshot}'
+    task = f'{task_name}/{task_id}' if task_id else task_name
+    context = support_functions.task_context.set(task)
+
+    # Save log of task as ./reports/<file_hash>/<vm>_<snapshot>.log
+    if config.report:
+        os.makedirs(f'reports/{sha256}', mode=0o444, exist_ok=True)
+        support_functions.task_log_handler.task_open(task, f'reports/{sha256}/{task_name}.log')
+    try:
+        # Cleanup (e.g. guest property watcher) is done when task is finished or cancelled
+        with contextlib.ExitStack() as cleanup:
+            return task_steps(vm, snapshot, filename, sha256, md5, file_size, task_id, cancel_token, cleanup,
+                              network_profile)
+    finally:
+        support_functions.task_log_handler.task_close(task)
+        support_functions.task_context.reset(context)
+
+
+# Task phases, see task_routine()
+def task_steps(vm, snapshot, filename, sha256, md5, file_size, task_id, cancel_token, cleanup, network_profile):
+    task_name = f'{vm}_{snapshot}_{network_profile}' if network_profile else f'{vm}_{snapshot}'
+    logging.info(f'{task_name}: Task started')
+    task_record = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'sha256': sha256, 'md5': md5, 'filename': filename,
+                   'vm': vm, 'snapshot': snapshot, 'network': network_profile or config.network, 'status': 'failed',
+                   'network_summary': None, 'timings': {}, 'ips': [], 'events': []}
+    timings = task_record['timings']
+    task_started = phase_started = time.time()
+    cancel_token = cancel_token or threading.Event()
+    watchdog = phase_watchdog(cancel_token, task_record, 'restore')
+    # Watchdog of current phase is stopped when task is finished, also when task is stopped early
+    cleanup.callback(lambda: phase_watchdog(None, task_record, watchdog=watchdog))
+
+    # Stop VM, restore snapshot
+    vm_functions.vm_stop(vm, ignore_status_error=1)
+    cancel_token.wait(config.delay / 2)
+    result = vm_functions.vm_snapshot_restore(vm, snapshot, ignore_status_error=1)
+    if result[0] != 0:
+        # If we were unable to restore snapshot - stop the task
+        logging.error(f'Unable to restore VM "{vm}" to snapshot "{snapshot}". Skipping.')
+        vm_functions.vm_stop(vm, ignore_status_error=1)
+        return task_record
+    # Change MAC address, disable time sync, dump traffic and enable screen recording (starts together with VM).
+    # Only settings which differ from current ones are applied, with one command.
+    result = vm_functions.vm_info(vm)
+    vm_info = result[1] if result[0] == 0 else {}
+    if network_profile:
+        vm_config = {'mac': config.mac, 'network_profile': network_profile, 'hostonly_adapter': config.hostonly_adapter,
+                     'internal_network': config.internal_network}
+        if network_profile == 'internal' and responder_start() != 0:
             vm_functions.vm_stop(vm, ignore_status_error=1)
-            continue
+            return task_record
+    else:
+        vm_config = {'mac': config.mac, 'network': config.network}
+    if config.no_time_sync:
+        vm_config['time_sync'] = 0
+    if config.pcap:
+        if task_record['network'] in ['off', 'offline']:
+            logging.warning('Traffic dump enabled, but network state is set to \'off\'.')
+        if config.report:
+            pcap_file = f'{cwd}/reports/{sha256}/{task_name}.pcap'
+        else:
+            pcap_file = f'{cwd}/{task_name}.pcap'
+        vm_config['pcap'] = pcap_file
+    if config.record:
+        if config.report:
+            recording_name = f'{cwd}/reports/{sha256}/{task_name}.webm'
+        else:
+            recording_name = f'{cwd}/{task_name}.webm'
+        recording_name = support_functions.normalize_path(recording_name)
+        logging.info(f'Recording video as "{recording_name}" on VM "{vm}" ({config.record_profile} profile).')
+        vm_config['recording'] = {'filename': recording_name, 'profile': config.record_profile}
+    result = vm_functions.vm_config(vm, vm_config, info=vm_info)
+    if result[0] != 0:
+        # Task must not run with other network than requested - stop the task
+        logging.error(f'Unable to configure VM "{vm}". Skipping.')
+        vm_functions.vm_stop(vm, ignore_status_error=1)
+        return task_record
+    phase_started = phase_finished(timings, 'restore', phase_started)
+    watchdog = phase_watchdog(cancel_token, task_record, 'boot', watchdog)
+
+    # Start VM
+    if cancel_token.wait(config.delay / 2):
+        return task_cancelled(vm, task_record, watchdog)
+    result = vm_functions.vm_start(vm, config.ui)
+    if result[0] != 0:
+        # If we were unable to start VM - stop the task
+        logging.error(f'Unable to start VM "{vm}". Skipping.')
+        vm_functions.vm_stop(vm, ignore_status_error=1)
+        return task_record
+    task_state(task_id, 'running', vm=vm)
+
+    # Watch guest properties
+    def property_changed(name, value, flags):
+        if name.startswith('/VMAutomation/'):
+            logging.info(f'{task_name}: Guest property {name} set to "{value}".')
+            task_record['events'].append({'name': name, 'value': value, 'time': round(time.time() - task_started, 3)})
+        elif value and value not in task_record['ips']:
+            task_record['ips'].append(value)
+    watcher = cleanup.enter_context(vm_functions.PropertyWatcher(vm, watched_properties))
+    watcher.subscribe(property_changed, '/VirtualBox/GuestInfo/Net/*/V4/IP|/VMAutomation/*')
 
-        # Wait for VM
-        time.sleep(delay)
+    # Wait for VM: until user is logged in or for fixed delay
+    if config.wait_login:
+        for _ in range(max(config.timeout, 1)):
+            if cancel_token.is_set():
+                return task_cancelled(vm, task_record, watchdog)
+            if watcher.wait_for('/VirtualBox/GuestInfo/OS/LoggedInUsers', lambda users: users not in ['', '0'],
+                                timeout=1):
+                break
+            # Guest properties are not available: fall back to fixed delay
+            if watcher.stopped.is_set():
+                if cancel_token.wait(config.delay):
+                    return task_cancelled(vm, task_record, watchdog)
+                break
+        else:
+            logging.warning(f'{task_name}: User is not logged in to guest OS after {config.timeout} seconds.')
+    elif cancel_token.wait(config.delay):
+        return task_cancelled(vm, task_record, watchdog)
 
-        # Set guest network state
-        result = vm_functions.vm_network(vm, vm_network_state)
+    # Dump VM memory in clean state once per VM/snapshot, to be used as baseline for memory diff
+    if config.memdump_diff:
+        baseline_file = f'{cwd}/baselines/{vm}_{snapshot}.dmp'
+        if not os.path.isfile(baseline_file):
+            os.makedirs(f'{cwd}/baselines', exist_ok=True)
+            result = operation_wait(vm_functions.vm_memdump(vm, baseline_file, background=1)[1], cancel_token)
+            if (result is None or result[0] != 0) and os.path.isfile(baseline_file):
+                os.remove(baseline_file)
+    phase_started = phase_finished(timings, 'boot', phase_started)
+    watchdog = phase_watchdog(cancel_token, task_record, 'upload', watchdog)
+    if cancel_token.is_set():
+        return task_cancelled(vm, task_record, watchdog)
+
+    # Set guest network state. VMs restored to saved state can not change it before start
+    if vm_info.get('VMState', 'saved') == 'saved':
+        if network_profile:
+            result = vm_functions.vm_network_profile(vm, network_profile, config.hostonly_adapter,
+                                                     config.internal_network)
+        else:
+            result = vm_functions.vm_network(vm, config.network)
         if result[0] != 0:
             vm_functions.vm_stop(vm)
-            continue
+            return task_record
 
-        # Set guest resolution
-        vm_functions.vm_set_resolution(vm, vm_resolution)
+    # Set guest resolution
+    vm_functions.vm_set_resolution(vm, config.resolution)
 
-        # Start screen recording
-        if record:
-            if report:
-                recording_name = f'{cwd}/reports/{sha256}/{vm}_{snapshot}.webm'
-            else:
-                recording_name = f'{cwd}/{vm}_{snapshot}.webm'
-            recording_name = support_functions.normalize_path(recording_name)
-            vm_functions.vm_record(vm, recording_name)
-
-        # Run pre exec script
-        if vm_pre_exec:
-            vm_functions.vm_exec(vm, vm_login, vm_password, vm_pre_exec, open_with=open_with, file_args=file_args)
-            take_screenshot(vm, task_name)
+    # Run pre exec script
+    if config.pre:
+        vm_functions.vm_exec(vm, config.login, config.password, config.pre, open_with=config.open_with,
+                             file_args=config.file_args)
+        take_screenshot(vm, task_name, sha256)
+    else:
+        logging.debug('Pre exec is not set.')
+
+    # Set path to file on guest OS
+    remote_file_path = support_functions.randomize_filename(config.login, filename, config.remote_folder)
+
+    # Upload file to VM, check if file exist and execute
+    result = vm_functions.vm_upload(vm, config.login, config.password, filename, remote_file_path)
+    if result[0] != 0:
+        take_screenshot(vm, task_name, sha256)
+        vm_functions.vm_stop(vm)
+        return task_record
+
+    # Check if file exist on VM
+    result = vm_functions.vm_file_stat(vm, config.login, config.password, remote_file_path)
+    if result[0] != 0:
+        take_screenshot(vm, task_name, sha256)
+        vm_functions.vm_stop(vm)
+        return task_record
+    take_screenshot(vm, task_name, sha256)
+    phase_started = phase_finished(timings, 'upload', phase_started)
+    watchdog = phase_watchdog(cancel_token, task_record, 'exec', watchdog)
+    if cancel_token.is_set():
+        return task_cancelled(vm, task_record, watchdog)
+
+    # Run file
+    result = vm_functions.vm_exec(vm, config.login, config.password, remote_file_path, open_with=config.open_with,
+                                  file_args=config.file_args)
+    if result[0] != 0:
+        take_screenshot(vm, task_name, sha256)
+        vm_functions.vm_stop(vm)
+        return task_record
+    take_screenshot(vm, task_name, sha256)
+
+    for _ in range(2):
+        logging.debug('Waiting for %s seconds...', config.timeout / 2)
+        if cancel_token.wait(config.timeout / 2):
+            return task_cancelled(vm, task_record, watchdog)
+        take_screenshot(vm, task_name, sha256)
+
+    # Check for file at the end of task
+    result = vm_functions.vm_file_stat(vm, config.login, config.password, remote_file_path)
+    if result[0] != 0:
+        logging.info('Original file does not exists anymore (melted or removed by AV).')
+
+    # Run post exec script
+    if config.post:
+        vm_functions.vm_exec(vm, config.login, config.password, config.post, open_with=config.open_with)
+        take_screenshot(vm, task_name, sha256)
+    else:
+        logging.debug('Post exec is not set.')
+    phase_started = phase_finished(timings, 'exec', phase_started)
+    watchdog = phase_watchdog(cancel_token, task_record, 'collect', watchdog)
+    if cancel_token.is_set():
+        return task_cancelled(vm, task_record, watchdog)
+    task_state(task_id, 'collecting', vm=vm)
+
+    # Get file from guest
+    if config.get_file:
+        # Normalize path and extract file name
+        src_path = support_functions.normalize_path(config.get_file)
+        src_filename = os.path.basename(src_path)
+        if config.report:
+            # Place in reports directory
+            dst_file = f'{cwd}/reports/{sha256}/{src_filename}'
         else:
-            logging.debug('Pre exec is not set.')
+            # Place in current dir
+            dst_file = f'{cwd}/{src_filename}'
+        # Download file
+        vm_functions.vm_copyfrom(vm, config.login, config.password, src_path, dst_file)
 
-        # Set path to file on guest OS
-        remote_file_path = support_functions.randomize_filename(vm_login, filename, remote_folder)
+    # Stop recording
+    if config.record:
+        vm_functions.vm_record_stop(vm)
+    phase_started = phase_finished(timings, 'collect', phase_started)
+    watchdog = phase_watchdog(cancel_token, task_record, 'memdump', watchdog)
+    if cancel_token.is_set():
+        return task_cancelled(vm, task_record, watchdog)
 
-        # Upload file to VM, check if file exist and execute
-        result = vm_functions.vm_upload(vm, vm_login, vm_password, filename, remote_file_path)
-        if result[0] != 0:
-            take_screenshot(vm, task_name)
-            vm_functions.vm_stop(vm)
+    # Dump VM memory
+    if config.memdump:
+        if config.report:
+            memdump_file = f'{cwd}/reports/{sha256}/{task_name}.dmp'
+        else:
+            memdump_file = f'{cwd}/{task_name}.dmp'
+        result = operation_wait(vm_functions.vm_memdump(vm, memdump_file, background=1)[1], cancel_token)
+        if result is None:
+            return task_cancelled(vm, task_record, watchdog)
+        # Keep only pages changed since baseline
+        if config.memdump_diff and result[0] == 0 and os.path.isfile(baseline_file):
+            result = support_functions.memdump_diff(baseline_file, memdump_file, f'{memdump_file}diff')
+            logging.info(f'{task_name}: {result[1]} of {result[2]} memory pages changed.')
+            os.remove(memdump_file)
+        phase_started = phase_finished(timings, 'memdump', phase_started)
+    phase_watchdog(cancel_token, task_record, watchdog=watchdog)
+
+    # Stop VM
+    vm_functions.vm_stop(vm)
+
+    # Summarize traffic dump
+    network_summary = None
+    if config.pcap:
+        result = support_functions.pcap_summary(pcap_file, index_file=f'{pcap_file}.json')
+        if result[0] == 0:
+            network_summary = result[1]
+            logging.info(f'{task_name}: {network_summary["flows_total"]} network flows, '
+                         f'{len(network_summary["dns"])} DNS queries.')
+            task_record['network_summary'] = {key: network_summary[key] for key in
+                                              ['packets', 'bytes', 'flows_total', 'dns', 'http_hosts', 'tls_sni']}
+
+    # Move files of task to artifact store, report references them by hash. Log of task is still being written
+    artifacts = None
+    if config.store:
+        import store_functions
+        report_dir = f'{cwd}/reports/{sha256}'
+        files = [f'{report_dir}/{name}' for name in os.listdir(report_dir)
+                 if name.startswith((f'{task_name}_', f'{task_name}.')) and name != f'{task_name}.log']
+        if config.get_file:
+            files.append(dst_file)
+        result = store_functions.store_add(config.store, files, f'{sha256}/{task_name}')
+        task_record['artifacts'] = result[1]
+        artifacts = {name: store_functions.blob_path(config.store, blob) for name, blob in result[1].items()}
+        artifacts[f'{task_name}.log'] = f'{report_dir}/{task_name}.log'
+    task_record['status'] = 'done'
+    phase_finished(timings, 'report', phase_started)
+    phase_finished(timings, 'total', task_started)
+    support_functions.save_timings(vm, snapshot, timings, history_file=f'{cwd}/timings.json')
+
+    # Save html report as ./reports/<file_hash>/index.html (in background, see report_executor)
+    if config.report:
+        report_executor.submit(contextvars.copy_context().run, report_routine, vm, snapshot, filename,
+                               config.file_args, file_size, sha256, md5, config.timeout,
+                               ', '.join(config.network_profiles or []) or config.network,
+                               network_summary=network_summary, artifacts=artifacts,
+                               thumbnails_directory=f'{config.store}/thumbnails' if config.store else None,
+                               network_profile=network_profile)
+        # Save task results as ./reports/results.jsonl
+        support_functions.save_results(task_record)
+
+    logging.info(f'{task_name}: Task finished')
+    return task_record
+
+
+# Write html report of task, see support_functions.html_report()
+def report_routine(*args, **kwargs):
+    try:
+        support_functions.html_report(*args, **kwargs)
+    except Exception as error:
+        logging.error(f'Unable to save html report: {error!r}')
+
+
+# Return VMs of list which can run job: VMs of job target which did not fail health check with job snapshot
+def job_vms(job, vms_list, vms_groups):
+    return [vm for vm in vms_list if f'{vm}/{job["snapshot"]}' not in unhealthy_tasks and
+            queue_functions.select_vm(job['target'], [vm], vms_groups)]
+
+
+# Main routine: take jobs ({'target': 'vm' or '/group', 'snapshot': 'snapshot', 'network': network profile or None,
+# 'sample': (file, sha256, md5, size)}) for free VMs until list is empty. In daemon mode wait for new jobs instead
+def main_routine(jobs_list, vms_groups, wait=0):
+    while not cancel_event.is_set():
+        job = vm = None
+        cancel_token = threading.Event()
+        with busy_lock:
+            if not jobs_list and not wait:
+                break
+            free_vms = [vm for vm in vms_groups if vm not in busy_vms]
+            for job in jobs_list:
+                vm = queue_functions.select_vm(job['target'], job_vms(job, free_vms, vms_groups), vms_groups,
+                                               vm_last_used)
+                if vm:
+                    jobs_list.remove(job)
+                    busy_vms.add(vm)
+                    running_tasks[vm] = (job, cancel_token)
+                    if job.get('daemon_job') in daemon_jobs:
+                        daemon_jobs[job['daemon_job']]['status'] = 'running'
+                    break
+            # Jobs left can not be run on any VM (VM is removed or failed health check): batch is finished
+            if not vm and not wait and not any(job_vms(job, vms_groups, vms_groups) for job in jobs_list):
+                logging.error(f'No VMs to run {len(jobs_list)} tasks. Skipping.')
+                for job in jobs_list:
+                    task_state(job.get('id'), 'failed')
+                jobs_list.clear()
+                break
+        if not vm:
+            cancel_event.wait(config.delay / 2)
             continue
 
-        # Check if file exist on VM
-        result = vm_functions.vm_file_stat(vm, vm_login, vm_password, remote_file_path)
-        if result[0] != 0:
-            take_screenshot(vm, task_name)
-            vm_functions.vm_stop(vm)
+        task_record = {'sha256': job['sample'][1], 'vm': vm, 'snapshot': job['snapshot'],
+                       'network': job.get('network'), 'status': 'failed'}
+        # Unexpected error fails the task, but does not stop the thread: VM is released and task is finished
+        try:
+            task_state(job.get('id'), 'restoring', vm=vm)
+            task_record = task_routine(vm, job['snapshot'], *job['sample'], task_id=job.get('id'),
+                                       cancel_token=cancel_token, network_profile=job.get('network'))
+        except Exception as error:
+            logging.error(f'Task on VM "{vm}" ({job["snapshot"]}) failed: {error!r}')
+        finally:
+            with busy_lock:
+                busy_vms.discard(vm)
+                running_tasks.pop(vm, None)
+                vm_last_used[vm] = time.time()
+                if job.get('daemon_job') in daemon_jobs:
+                    daemon_job = daemon_jobs[job['daemon_job']]
+                    daemon_job['tasks'].append(task_record)
+                    if len(daemon_job['tasks']) == daemon_job['tasks_total'] and daemon_job['status'] != 'cancelled':
+                        daemon_job['status'] = 'done'
+            try:
+                task_state(job.get('id'), task_record['status'], vm=vm)
+                task_metrics(task_record)
+            except Exception as error:
+                logging.error(f'Unable to save state of task on VM "{vm}": {error!r}')
+
+
+# Worker routine: take jobs for free local VMs ({'vm': '/group'}, with their snapshots {'vm': ['snapshot']}) from the
+# queue and send back results
+def worker_routine(vms_groups, vms_snapshots=None):
+    while not cancel_event.is_set():
+        cancel_token = threading.Event()
+        with busy_lock:
+            free_vms = {vm: groups for vm, groups in vms_groups.items() if vm not in busy_vms}
+            job = queue_functions.queue_claim(config.queue, worker_name, free_vms, vm_last_used, vms_snapshots)
+            if job:
+                busy_vms.add(job['vm'])
+                running_tasks[job['vm']] = (job, cancel_token)
+        if not job:
+            cancel_event.wait(config.delay)
             continue
-        take_screenshot(vm, task_name)
 
-        # Run file
-        result = vm_functions.vm_exec(vm, vm_login, vm_password, remote_file_path, open_with=open_with,
-                                      file_args=file_args)
+        logging.info(f'Job {job["id"]}: VM "{job["vm"]}", snapshot "{job["snapshot"]}", file {job["sha256"]}')
+        task_record = {'sha256': job['sha256'], 'vm': job['vm'], 'snapshot': job['snapshot'], 'status': 'failed'}
+        # Unexpected error fails the job, but does not stop the worker thread: VM is released and job is completed
+        try:
+            result = queue_functions.queue_fetch_sample(config.queue, job['sha256'])
+            if result[0] == 0:
+                task_record = task_routine(job['vm'], job['snapshot'], result[1], job['sha256'], result[2], result[3],
+                                           cancel_token=cancel_token)
+        except Exception as error:
+            logging.error(f'Job {job["id"]} failed: {error!r}')
+        try:
+            if task_record['status'] == 'interrupted':
+                # Worker is stopping, so job can be taken by another worker
+                queue_functions.queue_release(config.queue, job['id'])
+            else:
+                queue_functions.queue_complete(config.queue, job['id'], task_record['status'], task_record)
+            task_metrics(task_record)
+        except Exception as error:
+            logging.error(f'Unable to save result of job {job["id"]}: {error!r}')
+        finally:
+            with busy_lock:
+                busy_vms.discard(job['vm'])
+                running_tasks.pop(job['vm'], None)
+                vm_last_used[job['vm']] = time.time()
+
+
+# Return targets (VMs and '/groups') and VMs they include as {'vm': '/group'}.
+# If vms_list is set to 'all', use all available VMs
+def get_targets(vms_list, all_vms):
+    targets_list = []
+    for target in vms_list:
+        if target == 'all':
+            targets_list.extend(all_vms)
+        elif target.startswith('/'):
+            if queue_functions.group_members(all_vms, target):
+                targets_list.append(target)
+            else:
+                logging.error(f'VM group "{target}" does not have any VMs. Skipping.')
+        elif target in all_vms:
+            targets_list.append(target)
+        else:
+            logging.error(f'VM "{target}" does not exists. Skipping.')
+    vms_groups = {}
+    for target in targets_list:
+        for vm in queue_functions.group_members(all_vms, target) if target.startswith('/') else [target]:
+            vms_groups[vm] = all_vms[vm]
+    return targets_list, vms_groups
+
+
+# Return snapshots to use for target. Snapshots are autodetected if set to 'all' (for group - snapshots available on
+# every VM in group) and kept in vms_snapshots
+def get_snapshots(target, members, snapshots_list):
+    if 'all' not in snapshots_list:
+        return snapshots_list
+    logging.debug('Snapshots list will be obtained from VM information.')
+    for vm in members:
+        if vm not in vms_snapshots:
+            result = vm_functions.list_snapshots(vm)
+            vms_snapshots[vm] = result[1] if result[0] == 0 else []
+    target_snapshots = queue_functions.common_snapshots(vms_snapshots, members)
+    if not target_snapshots:
+        logging.error(f'Unable to get list of snapshots for VM "{target}". Skipping.')
+    return target_snapshots
+
+
+# Return jobs for every target and snapshot, longest first (by durations of previous runs), so no VM is left with
+# long task at the end
+def get_jobs(targets_list, snapshots_list, all_vms, sample):
+    jobs_list = []
+    timings_history = support_functions.load_timings(f'{cwd}/timings.json')
+    for target in targets_list:
+        members = queue_functions.group_members(all_vms, target) if target.startswith('/') else [target]
+        for snapshot in get_snapshots(target, members, snapshots_list):
+            if all(f'{vm}/{snapshot}' in unhealthy_tasks for vm in members):
+                logging.error(f'VM "{target}" failed health check with snapshot "{snapshot}". Skipping.')
+                continue
+            expected_duration = support_functions.expected_duration(timings_history, members, snapshot,
+                                                                    default=config.timeout + config.delay * 2)
+            for network_profile in config.network_profiles or [None]:
+                jobs_list.append({'target': target, 'snapshot': snapshot, 'sample': sample,
+                                  'expected_duration': expected_duration, 'network': network_profile})
+    jobs_list.sort(key=lambda job: job['expected_duration'], reverse=True)
+
+    # Save jobs to journal before running them
+    for job in jobs_list:
+        job['id'] = secrets.token_hex(8)
+        task_state(job['id'], 'queued', job=job)
+    return jobs_list
+
+
+# Daemon: save submitted file and add its tasks to jobs list. Returns job
+def daemon_submit(filename, data, daemon_vms_list, daemon_snapshots_list):
+    filename = os.path.basename(filename)
+    os.makedirs(f'{cwd}/samples', exist_ok=True)
+    temp_file = f'{cwd}/samples/{threading.get_ident()}.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(data)
+    file_sha256, file_md5 = support_functions.file_hash(temp_file)
+    file = f'{cwd}/samples/{file_sha256}/{filename}'
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    os.replace(temp_file, file)
+    sample = (file, file_sha256, file_md5, support_functions.file_size(file))
+
+    # Only VMs of daemon can be used
+    targets_list = get_targets(daemon_vms_list or config.vms, vms_groups)[0]
+    jobs = get_jobs(targets_list, daemon_snapshots_list or config.snapshots, vms_groups, sample)
+    if not jobs:
+        return 1, 'No tasks for this VMs/snapshots'
+    with busy_lock:
+        job_id = str(len(daemon_jobs) + 1)
+        daemon_jobs[job_id] = {'id': job_id, 'status': 'queued', 'filename': filename, 'sha256': file_sha256,
+                               'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'tasks_total': len(jobs), 'tasks': []}
+        for job in jobs:
+            job['daemon_job'] = job_id
+        jobs_list.extend(jobs)
+        jobs_list.sort(key=lambda job: job['expected_duration'], reverse=True)
+    logging.info(f'Job {job_id}: file "{filename}", {len(jobs)} tasks.')
+    return 0, daemon_jobs[job_id]
+
+
+# Daemon: cancel job. Queued tasks are removed, running tasks are stopped. Returns job or None
+def daemon_cancel(job_id):
+    with busy_lock:
+        daemon_job = daemon_jobs.get(job_id)
+        if not daemon_job:
+            return None
+        if daemon_job['status'] in ['queued', 'running']:
+            for job in [job for job in jobs_list if job.get('daemon_job') == job_id]:
+                jobs_list.remove(job)
+                daemon_job['tasks_total'] -= 1
+                task_state(job['id'], 'cancelled')
+            for job, cancel_token in running_tasks.values():
+                if job.get('daemon_job') == job_id:
+                    cancel_token.set()
+            daemon_job['status'] = 'cancelled'
+    logging.info(f'Job {job_id}: cancelled.')
+    return daemon_job
+
+
+# Command line entry point
+def main(argv=None):
+    global vms_groups
+    parser = config_parser()
+    args = parser.parse_args(argv)
+
+    # Search results of previous runs
+    if args.search:
+        result = support_functions.search_results(args.search)
+        for result_record in result[1]:
+            print(f'{result_record["time"]} {result_record["sha256"]} {result_record["filename"]} '
+                  f'{result_record["vm"]} {result_record["snapshot"]}')
+        exit(result[0])
+    if (args.submit or args.worker or args.status) and not args.queue:
+        parser.error('the following arguments are required: --queue')
+    if args.status:
+        result = queue_functions.queue_status(args.queue)
+        print(f'Jobs: {result[1]}')
+        for worker, last_seen in result[2].items():
+            print(f'Worker: {worker}, last seen: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(last_seen))}')
+        exit(result[0])
+    if args.resume and not args.journal:
+        parser.error('the following arguments are required: --journal')
+    backup_cleanup = args.keep_backups is not None or args.max_backup_age is not None
+    # Destructive modes are not run on all VMs of host by default
+    if (backup_cleanup or args.health) and not args.vms:
+        parser.error('the following arguments are required: --vms/-v ("--vms all" for all VMs)')
+    if args.store_retention is not None:
+        import store_functions
+        result = store_functions.store_cleanup(args.store or 'reports/store', max_age=args.store_retention)
+        print(f'Artifacts removed: {result[1]}, space reclaimed: {round(result[2] / 1024 / 1024)} MB')
+        exit(result[0])
+    if not args.worker and not args.daemon and not args.resume and not args.provision and not backup_cleanup and \
+            not args.health and (not args.file or not args.vms or not args.snapshots):
+        parser.error('the following arguments are required: file, --vms/-v, --snapshots/-s')
+    configure(normalize_config(args))
+
+    # Logging options
+    if config.log == 'off':
+        logging.disable()
+    elif config.verbosity in ['error', 'info', 'debug']:
+        log_levels = {'error': logging.ERROR,
+                      'info': logging.INFO,
+                      'debug': logging.DEBUG}
+        # Every record has task (VM, snapshot and task ID) it belongs to. With '--report' log of every task is also
+        # saved to reports directory
+        log_listener = support_functions.log_setup(log_levels[config.verbosity],
+                                                   file=None if config.log == 'console' else config.log,
+                                                   log_format=config.log_format, log_queue=config.log_queue)
+        if log_listener:
+            atexit.register(log_listener.stop)
+
+    # Submit jobs to the queue
+    if config.submit:
+        result = queue_functions.queue_submit(config.queue, config.file, config.vms, config.snapshots)
+        print(f'Jobs: {result[1]}')
+        exit(result[0])
+
+    # Provision VMs from image
+    if config.provision:
+        import provision_functions
+        base_vm = config.base_vm or os.path.splitext(os.path.basename(config.provision))[0]
+        snapshot = config.snapshots[0] if config.snapshots[0] != 'all' else 'clean'
+        result = provision_functions.provision(config.provision, base_vm, config.clones, mode=config.clone_mode,
+                                               snapshot=snapshot, threads=config.threads or config.clones,
+                                               inventory_file=config.inventory)
+        for vm, vm_info in result[1].items():
+            print(f'{vm} {vm_info["group"]} {vm_info["mode"]} {vm_info["snapshots"]}')
+        exit(1 if result[0] else 0)
+
+    # Remove old backups. Running VMs are skipped
+    if backup_cleanup:
+        result = vm_functions.list_vms(dictionary=1)
         if result[0] != 0:
-            take_screenshot(vm, task_name)
-            vm_functions.vm_stop(vm)
-            continue
-        take_screenshot(vm, task_name)
+            logging.error('Unable to get list of VMs. Exiting.')
+            exit(1)
+        failed = 0
+        reclaimed = 0
+        for vm in sorted(get_targets(config.vms, result[1])[1]):
+            result = vm_functions.vm_backup_cleanup(vm, keep_last=config.keep_backups, max_age=config.max_backup_age)
+            if result[0] != 0:
+                failed += 1
+                continue
+            reclaimed += result[1]['reclaimed']
+            print(f'{vm}: {len(result[1]["removed"])} backups removed, {len(result[1]["kept"])} kept')
+        print(f'Space reclaimed: {round(reclaimed / 1024 / 1024)} MB')
+        exit(1 if failed else 0)
 
-        for _ in range(2):
-            logging.debug(f'Waiting for {timeout / 2} seconds...')
-            time.sleep(timeout / 2)
-            take_screenshot(vm, task_name)
+    # VMs/snapshots which failed last health check are not used
+    unhealthy_tasks.update(health_functions.health_unhealthy(health_functions.health_load(config.health_file)))
+    if unhealthy_tasks and not config.health:
+        logging.warning(f'VMs/snapshots excluded after failed health check: {sorted(unhealthy_tasks)}')
 
-        # Check for file at the end of task
-        result = vm_functions.vm_file_stat(vm, vm_login, vm_password, remote_file_path)
+    # Serve metrics
+    metrics_functions.metrics_gauge('vm_automation_tasks_queued', lambda: len(jobs_list))
+    metrics_functions.metrics_gauge('vm_automation_tasks_running', lambda: len(running_tasks))
+    metrics_functions.metrics_gauge('vm_automation_vms_busy', lambda: len(busy_vms))
+    metrics_functions.metrics_gauge('vm_automation_vms_idle', lambda: len(vms_groups) - len(busy_vms))
+    if config.metrics_port:
+        metrics_functions.metrics_start(config.metrics_port)
+
+    # Run as worker: advertise local VMs and run jobs from the queue
+    if config.worker:
+        result = vm_functions.list_vms(dictionary=1)
         if result[0] != 0:
-            logging.info('Original file does not exists anymore (melted or removed by AV).')
+            logging.error('Unable to get list of VMs. Exiting.')
+            exit(1)
+        inventory = {}
+        for vm, group in result[1].items():
+            if 'all' in config.vms or vm in config.vms:
+                snapshots_list = vm_functions.list_snapshots(vm)[1]
+                inventory[vm] = {'group': group, 'snapshots': [snapshot for snapshot in snapshots_list
+                                                               if f'{vm}/{snapshot}' not in unhealthy_tasks]}
+        if not inventory:
+            logging.error('No VMs to advertise. Exiting.')
+            exit(1)
+        if config.threads == 0 or config.threads > len(inventory):
+            config.threads = len(inventory)
+        logging.info(f'Worker "{worker_name}": VMs {list(inventory)}, threads: {config.threads}')
+        signal.signal(signal.SIGINT, cancel_all)
+        signal.signal(signal.SIGTERM, cancel_all)
+        vms_groups = {vm: inventory[vm]['group'] for vm in inventory}
+        worker_snapshots = {vm: inventory[vm]['snapshots'] for vm in inventory}
+        threads_list = []
+        for _ in range(config.threads):
+            t = threading.Thread(target=worker_routine, args=(vms_groups, worker_snapshots), daemon=True)
+            t.start()
+            threads_list.append(t)
+        # Refresh advertisement periodically, so coordinator can see that worker is alive
+        while not cancel_event.is_set():
+            queue_functions.queue_register_worker(config.queue, worker_name, inventory)
+            cancel_event.wait(60)
+        for t in threads_list:
+            t.join()
+        exit(0)
 
-        # Run post exec script
-        if vm_post_exec:
-            vm_functions.vm_exec(vm, vm_login, vm_password, vm_post_exec, open_with=open_with)
-            take_screenshot(vm, task_name)
-        else:
-            logging.debug('Post exec is not set.')
-
-        # Get file from guest
-        if vm_get_file:
-            # Normalize path and extract file name
-            src_path = support_functions.normalize_path(vm_get_file)
-            src_filename = os.path.basename(src_path)
-            if report:
-                # Place in reports directory
-                dst_file = f'{cwd}/reports/{sha256}/{src_filename}'
-            else:
-                # Place in current dir
-                dst_file = f'{cwd}/{src_filename}'
-            # Download file
-            vm_functions.vm_copyfrom(vm, vm_login, vm_password, src_path, dst_file)
+    # Resume unfinished tasks from journal. VMs of interrupted tasks are stopped first
+    resumed_jobs = []
+    if config.resume:
+        for task_id, task in queue_functions.journal_unfinished(config.journal).items():
+            if 'vm' in task:
+                logging.info(f'Task {task_id} was interrupted ({task["state"]}). Stopping VM "{task["vm"]}".')
+                vm_functions.vm_stop(task['vm'], ignore_status_error=1)
+            resumed_jobs.append(dict(task['job'], id=task_id))
+        logging.info(f'Tasks to resume: {len(resumed_jobs)}')
+        if not resumed_jobs:
+            exit(0)
+        config.vms = sorted({job['target'] for job in resumed_jobs})
 
-        # Stop recording
-        if record:
-            vm_functions.vm_record_stop(vm)
+    # Get list of all available VMs with their groups
+    result = vm_functions.list_vms(dictionary=1)
+    if result[0] != 0:
+        logging.error('Unable to get list of VMs. Exiting.')
+        exit(1)
+    all_vms = result[1]
+    targets_list, vms_groups = get_targets(config.vms, all_vms)
+    if not vms_groups:
+        logging.error('No VMs to use. Exiting.')
+        exit(1)
 
-        # Dump VM memory
-        if memdump:
-            if report:
-                memdump_file = f'{cwd}/reports/{sha256}/{vm}_{snapshot}.dmp'
-            else:
-                memdump_file = f'{cwd}/{vm}_{snapshot}.dmp'
-            vm_functions.vm_memdump(vm, memdump_file)
+    # Number of concurrent threads
+    if config.threads == 0:
+        config.threads = len(vms_groups)
+        logging.debug('Threads count is set to number of VMs: %s', config.threads)
+    else:
+        if config.threads > len(vms_groups):
+            logging.warning(f'Number of concurrent threads is larger then number of available VMs '
+                            f'({len(vms_groups)}).')
+            config.threads = len(vms_groups)
+        logging.debug('Threads count is set to %s', config.threads)
 
-        # Stop VM
-        vm_functions.vm_stop(vm)
+    # Check VMs and snapshots (and warm them up) before running tasks
+    if config.health:
+        health_snapshots = {vm: get_snapshots(vm, [vm], config.snapshots) for vm in vms_groups}
+        records = health_functions.health_run(health_snapshots, config.threads, login=config.login,
+                                              password=config.password, ui=config.ui,
+                                              boot_timeout=config.phase_timeout or 300)
+        health_functions.health_save(records, config.health_file)
+        for record in sorted(records, key=lambda record: (record['vm'], record['snapshot'])):
+            latencies = ' '.join(f'{check}={record["checks"][check]["latency"]}s'
+                                 for check in health_functions.health_checks if check in record['checks'])
+            errors = [f'{check}: {result["error"]}' for check, result in record['checks'].items() if not result['ok']]
+            print(f'{record["vm"]} {record["snapshot"]} {"healthy" if record["healthy"] else "UNHEALTHY"} '
+                  f'{latencies} {" ".join(errors)}'.rstrip())
+        exit(0 if all(record['healthy'] for record in records) else 1)
 
-        # Save html report as ./reports/<file_hash>/index.html
-        if report:
-            support_functions.html_report(vm, snapshot, filename, file_args, file_size, sha256, md5, timeout,
-                                          vm_network_state)
-
-        logging.info(f'{task_name}: Task finished')
-
-
-if 'all' in vms_list:
-    # If vms_list is set to 'all', obtain list of all available VMs and use them
-    vms_list = vm_functions.list_vms()
-
-# Autodetect snapshots
-if 'all' in snapshots_list:
-    snapshots_autodetect = True
-else:
-    snapshots_autodetect = False
-
-# Number of concurrent threads
-if threads == 0:
-    threads = len(vms_list)
-    logging.debug(f'Threads count is set to number of VMs: {threads}')
-else:
-    if threads > len(vms_list):
-        logging.warning(f'Number of concurrent threads is larger then number of available VMs ({len(vms_list)}).')
-        threads = len(vms_list)
-    logging.debug(f'Threads count is set to {threads}')
-
-# Show file information
-sha256, md5, file_size = show_info()
-
-# Start threads
-for vm in vms_list:
-    # Limit number of concurrent threads
-    while threading.active_count() - 1 >= threads:
-        time.sleep(delay / 2)
-
-    if snapshots_autodetect:
-        logging.debug('Snapshots list will be obtained from VM information.')
-        snapshots_list = vm_functions.list_snapshots(vm)
-        if snapshots_list[0] == 0:
-            snapshots_list = snapshots_list[1]
-        else:
-            logging.error(f'Unable to get list of snapshots for VM "{vm}". Skipping.')
-            continue
+    # Print schedule of tasks for every file, VM and snapshot and its expected duration (by timings of previous runs).
+    # Only lists of VMs and snapshots are read, VMs are not used
+    if config.plan:
+        import plan_functions
+        plan_jobs = []
+        for target in targets_list:
+            members = queue_functions.group_members(all_vms, target) if target.startswith('/') else [target]
+            for snapshot in get_snapshots(target, members, config.snapshots):
+                if all(f'{vm}/{snapshot}' in unhealthy_tasks for vm in members):
+                    logging.error(f'VM "{target}" failed health check with snapshot "{snapshot}". Skipping.')
+                    continue
+                plan_jobs.extend({'target': target, 'snapshot': snapshot, 'file': os.path.basename(file),
+                                  'network': network_profile}
+                                 for file in config.file for network_profile in config.network_profiles or [None])
+        result = plan_functions.plan_schedule(plan_jobs, vms_groups, config.threads, config.delay,
+                                              support_functions.load_timings(f'{cwd}/timings.json'),
+                                              default=config.timeout + config.delay * 2, excluded=unhealthy_tasks)
+        summary = result[2]
+        for task in result[1]:
+            print(f'{plan_functions.format_duration(task["start"])} - {plan_functions.format_duration(task["end"])} '
+                  f'{task["vm"]} {task["snapshot"]} {task["file"]} {task["network"] or ""}'.rstrip())
+        print(f'Tasks: {summary["tasks"]} ({summary["no_history"]} without timings of previous runs), threads: '
+              f'{summary["threads"]}, limited by: {summary["limit"]}')
+        print(f'Expected duration: {plan_functions.format_duration(summary["makespan"])}, '
+              f'VM utilisation: {round(summary["total_utilisation"] * 100)}%')
+        for vm, utilisation in summary['utilisation'].items():
+            print(f'  {vm}: {round(utilisation * 100)}%')
+        if summary['bottleneck'] and sum(summary['phases'].values()):
+            print(f'Bottleneck phase: {summary["bottleneck"]} ('
+                  f'{round(summary["phases"][summary["bottleneck"]] / sum(summary["phases"].values()) * 100)}% '
+                  f'of known task time)')
+        exit(1 if summary['unscheduled'] else 0)
 
-    try:
-        t = threading.Thread(target=main_routine, args=(vm, snapshots_list))
-        t.name = f'{vm}_{snapshots_list}'
+    # Show file information
+    sha256, md5, file_size = show_info()
+
+    # Stop running tasks and VMs on Ctrl+C or termination
+    signal.signal(signal.SIGINT, cancel_all)
+    signal.signal(signal.SIGTERM, cancel_all)
+
+    # Run as daemon: keep VMs list in memory and take jobs from local HTTP API
+    if config.daemon:
+        import daemon_functions
+        threads_list = []
+        for _ in range(config.threads):
+            t = threading.Thread(target=main_routine, args=(jobs_list, vms_groups, 1), daemon=True)
+            t.start()
+            threads_list.append(t)
+        daemon_functions.daemon_start(config.daemon, daemon_submit, daemon_jobs.get,
+                                      lambda: list(daemon_jobs.values()), daemon_cancel,
+                                      reports_directory=f'{cwd}/reports', store_directory=config.store)
+        cancel_event.wait()
+        for t in threads_list:
+            t.join()
+        exit(0)
+
+    # Jobs list
+    if resumed_jobs:
+        for job in sorted(resumed_jobs, key=lambda job: job['expected_duration'], reverse=True):
+            if job_vms(job, vms_groups, vms_groups):
+                jobs_list.append(job)
+            else:
+                logging.error(f'Task {job["id"]}: VM "{job["target"]}" does not exist or failed health check with '
+                              f'snapshot "{job["snapshot"]}". Skipping.')
+                task_state(job['id'], 'failed')
+    else:
+        jobs_list.extend(get_jobs(targets_list, config.snapshots, all_vms,
+                                  (config.filename, sha256, md5, file_size)))
+    logging.debug('Tasks: %s, expected duration: %s seconds for %s threads.', len(jobs_list),
+                  sum(job['expected_duration'] for job in jobs_list), config.threads)
+
+    # Start threads
+    threads_list = []
+    for _ in range(config.threads):
+        t = threading.Thread(target=main_routine, args=(jobs_list, vms_groups))
         t.start()
-        time.sleep(delay)  # Delay before starting next VM
-    except (KeyboardInterrupt, SystemExit):
-        raise
+        threads_list.append(t)
+        if cancel_event.wait(config.delay):  # Delay before starting next VM
+            break
+    for t in threads_list:
+        t.join()
+    report_executor.shutdown()
+    if config.metrics_file:
+        metrics_functions.metrics_dump(config.metrics_file)
+    if cancel_event.is_set():
+        logging.warning(f'Cancelled. Tasks left: {len(jobs_list)}.')
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
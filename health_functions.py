@@ -0,0 +1,146 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+import support_functions
+import vm_functions
+
+if __name__ == "__main__":
+    print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
+    exit(1)
+
+# Lock for health check results, shared between threads
+health_lock = threading.Lock()
+
+# Checks of VM/snapshot, in order. Checks after failed one are skipped
+health_checks = ['restore', 'boot', 'auth', 'stat', 'ips', 'screenshot']
+
+
+# Check that VM restored to snapshot can be used for tasks: snapshot is restored, VM is started and user is logged in
+# to guest OS (up to boot_timeout seconds), guest control accepts credentials, file exists on guest, guest has IP
+# address and screenshot can be taken. VM is stopped after check.
+# Returns {'vm': ..., 'snapshot': ..., 'healthy': True/False, 'checks': {'check': {'ok': ..., 'latency': ...,
+# 'error': ...}}, 'ips': [...]}
+def health_check(vm, snapshot, login, password, remote_file='C:\\Windows\\explorer.exe', ui='headless',
+                 boot_timeout=120, screenshot_file=None):
+    record = {'vm': vm, 'snapshot': snapshot, 'time': time.time(), 'healthy': False, 'checks': {}, 'ips': []}
+
+    def check(name, ok, started, error=''):
+        record['checks'][name] = {'ok': ok, 'latency': round(time.time() - started, 2),
+                                  'error': '' if ok else error.strip()}
+        if not ok:
+            logging.error(f'Health check "{name}" failed on VM "{vm}" ({snapshot}): {error.strip()}')
+        return ok
+
+    vm_functions.vm_stop(vm, ignore_status_error=1)
+    try:
+        started = time.time()
+        result = vm_functions.vm_snapshot_restore(vm, snapshot, ignore_status_error=1)
+        if not check('restore', result[0] == 0, started, result[2]):
+            return record
+
+        started = time.time()
+        result = vm_functions.vm_start(vm, ui)
+        if result[0] != 0:
+            check('boot', False, started, result[2])
+            return record
+        with vm_functions.PropertyWatcher(vm, '/VirtualBox/GuestInfo/OS/LoggedInUsers') as watcher:
+            logged_in = watcher.wait_for('/VirtualBox/GuestInfo/OS/LoggedInUsers', lambda users: users not in ['', '0'],
+                                         timeout=boot_timeout)
+        if not check('boot', bool(logged_in), started, '' if logged_in else
+                     f'User is not logged in after {boot_timeout} seconds (Guest Additions are not running?)'):
+            return record
+
+        # One command checks both credentials and file: missing file means that credentials are accepted
+        started = time.time()
+        result = vm_functions.vm_file_stat(vm, login, password, remote_file)
+        if not check('auth', result[0] == 0 or vm_functions.error_category(result[2]) == 'guest_file', started,
+                     result[2]):
+            return record
+        if not check('stat', result[0] == 0, started, result[2]):
+            return record
+
+        started = time.time()
+        result = vm_functions.list_ips(vm)
+        if not check('ips', result[0] == 0 and bool(result[1]), started, result[2] or 'Guest has no IP addresses'):
+            return record
+        record['ips'] = result[1]
+
+        started = time.time()
+        screenshot = os.path.abspath(screenshot_file or f'health_{vm}_{snapshot}.png')
+        result = vm_functions.vm_screenshot(vm, screenshot)
+        ok = result[0] == 0 and os.path.isfile(screenshot) and os.path.getsize(screenshot) > 0
+        if not screenshot_file and os.path.isfile(screenshot):
+            os.remove(screenshot)
+        if not check('screenshot', ok, started, result[2] or 'Screenshot is empty'):
+            return record
+        record['healthy'] = True
+    finally:
+        vm_functions.vm_stop(vm, ignore_status_error=1)
+        record['latency'] = round(time.time() - record['time'], 2)
+    logging.info(f'VM "{vm}" ({snapshot}) is healthy.')
+    return record
+
+
+# Check VMs and snapshots ({'vm': ['snapshot']}) in parallel, snapshots of one VM are checked one by one.
+# Options are passed to health_check(). Returns results of checks
+def health_run(vms_snapshots, threads=4, **options):
+    vms_list = list(vms_snapshots)
+    records = []
+
+    def check_routine():
+        while True:
+            with health_lock:
+                if not vms_list:
+                    return
+                vm = vms_list.pop(0)
+            for snapshot in vms_snapshots[vm]:
+                context = support_functions.task_context.set(f'{vm}_{snapshot}')
+                try:
+                    record = health_check(vm, snapshot, **options)
+                finally:
+                    support_functions.task_context.reset(context)
+                with health_lock:
+                    records.append(record)
+
+    # Commands are run by client of caller
+    threads_list = [threading.Thread(target=contextvars.copy_context().run, args=(check_routine,))
+                    for _ in range(max(1, min(threads, len(vms_list))))]
+    for t in threads_list:
+        t.start()
+    for t in threads_list:
+        t.join()
+    return records
+
+
+# Load results of previous checks: {'vm/snapshot': record}
+def health_load(health_file='health.json'):
+    if not os.path.isfile(health_file):
+        return {}
+    with open(health_file, encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            logging.warning(f'Unable to read health check results "{health_file}".')
+            return {}
+
+
+# Add results of checks to file (results of previous checks of other VMs/snapshots are kept). File is replaced
+# atomically
+def health_save(records, health_file='health.json'):
+    with health_lock:
+        health = health_load(health_file)
+        for record in records:
+            health[f'{record["vm"]}/{record["snapshot"]}'] = record
+        with open(f'{health_file}.tmp', mode='w', encoding='utf-8') as f:
+            json.dump(health, f, indent=1)
+        os.replace(f'{health_file}.tmp', health_file)
+    return 0
+
+
+# Return VMs/snapshots which failed last check: {'vm/snapshot'}
+def health_unhealthy(health):
+    return {key for key, record in health.items() if not record['healthy']}
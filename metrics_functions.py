@@ -0,0 +1,132 @@
+import bisect
+import logging
+import os
+import threading
+
+if __name__ == "__main__":
+    print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
+    exit(1)
+
+# Lock for metrics values, shared between threads
+metrics_lock = threading.Lock()
+
+# Known metrics: {'name': ('type', 'help')}
+metrics_info = {
+    'vm_automation_tasks_total': ('counter', 'Finished tasks by status'),
+    'vm_automation_tasks_queued': ('gauge', 'Tasks waiting for free VM'),
+    'vm_automation_tasks_running': ('gauge', 'Tasks running now'),
+    'vm_automation_vms_busy': ('gauge', 'VMs running tasks'),
+    'vm_automation_vms_idle': ('gauge', 'VMs waiting for tasks'),
+    'vm_automation_phase_seconds': ('histogram', 'Duration of task phases (restore, boot, upload, exec, ...)'),
+    'vm_automation_vboxmanage_calls_total': ('counter', 'vboxmanage calls by subcommand'),
+    'vm_automation_vboxmanage_seconds': ('histogram', 'Duration of vboxmanage calls by subcommand'),
+    'vm_automation_vboxmanage_errors_total': ('counter', 'Failed vboxmanage calls by subcommand and error category'),
+}
+
+# Upper bounds of histogram buckets, seconds
+buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Values: {'name': {(('label', 'value'), ...): value}}. Histogram value is [count per bucket, ..., sum, count]
+metrics_values = {}
+
+# Gauges calculated on collection: {'name': function}
+metrics_gauges = {}
+
+
+# Increase counter
+def metrics_inc(name, value=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        values = metrics_values.setdefault(name, {})
+        values[key] = values.get(key, 0) + value
+
+
+# Add observation (e.g. duration in seconds) to histogram
+def metrics_observe(name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with metrics_lock:
+        histogram = metrics_values.setdefault(name, {}).setdefault(key, [0] * (len(buckets) + 3))
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+# Register gauge, which value is returned by function on collection
+def metrics_gauge(name, function):
+    metrics_gauges[name] = function
+
+
+# Format labels as {label="value",...}
+def metrics_labels(key):
+    if not key:
+        return ''
+    labels = []
+    for label, value in key:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        labels.append(f'{label}="{value}"')
+    return '{' + ','.join(labels) + '}'
+
+
+# Return all metrics in Prometheus text format
+def metrics_text():
+    with metrics_lock:
+        values = {name: {key: list(value) if isinstance(value, list) else value for key, value in metric.items()}
+                  for name, metric in metrics_values.items()}
+    for name, function in metrics_gauges.items():
+        try:
+            values[name] = {(): function()}
+        except Exception as error:
+            logging.debug('Unable to get value of metric %s: %s', name, error)
+
+    lines = []
+    for name in sorted(values):
+        histogram = any(isinstance(value, list) for value in values[name].values())
+        metric_type, metric_help = metrics_info.get(name, ('histogram' if histogram else 'untyped', name))
+        lines.append(f'# HELP {name} {metric_help}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for key, value in sorted(values[name].items()):
+            if not histogram:
+                lines.append(f'{name}{metrics_labels(key)} {value}')
+                continue
+            cumulative = 0
+            for bucket, count in zip(buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f'{name}_bucket{metrics_labels(key + (("le", bucket),))} {cumulative}')
+            lines.append(f'{name}_sum{metrics_labels(key)} {round(value[-2], 3)}')
+            lines.append(f'{name}_count{metrics_labels(key)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Save metrics to text file (e.g. for node_exporter textfile collector). File is replaced atomically
+def metrics_dump(file):
+    with open(f'{file}.tmp', mode='w', encoding='utf-8') as f:
+        f.write(metrics_text())
+    os.replace(f'{file}.tmp', file)
+    return 0
+
+
+# Start metrics HTTP server in background thread: GET /metrics.
+# HTTP server is imported only when needed, to keep import of this module fast
+def metrics_start(port, address='127.0.0.1'):
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logging.debug('Metrics: %s ' + format, self.address_string(), *args)
+
+        def do_GET(self):
+            if self.path.split('?')[0].rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = http.server.ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f'Metrics are available on http://{address}:{port}/metrics')
+    return server
@@ -0,0 +1,86 @@
+import heapq
+
+import queue_functions
+import support_functions
+
+if __name__ == "__main__":
+    print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
+    exit(1)
+
+
+# Format duration in seconds as H:MM:SS
+def format_duration(seconds):
+    seconds = round(seconds)
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}'
+
+
+# Return expected duration of task and of its phases on VM. History of the VM itself is used if available, average of
+# target (VM group) otherwise, default duration if task was never run. Phases are empty if history is unknown
+def task_estimate(history, vm, members, snapshot, default=0):
+    for vms_list in [[vm] if vm else [], members]:
+        phases = {}
+        for member in vms_list:
+            for phase in history.get(f'{member}/{snapshot}', {}):
+                phases[phase] = support_functions.expected_duration(history, vms_list, snapshot, phase)
+        if 'total' in phases:
+            return phases.pop('total'), phases
+    return default, {}
+
+
+# Simulate scheduling of jobs ({'target': 'vm' or '/group', 'snapshot': ..., 'file': ...}) the same way as they are
+# run: jobs are taken longest first by number of threads, threads are started with delay, every job is run on free VM
+# of its target (least recently used VM of group). VM/snapshot pairs from excluded ({'vm/snapshot'}, e.g. failed
+# health check) are not used. Nothing is run on VMs.
+# Returns schedule (jobs with 'vm', 'start', 'end', 'phases') and summary: makespan (seconds), utilisation of every VM
+# and overall, expected time of every phase, bottleneck phase and limit of concurrency ('threads' or 'VMs')
+def plan_schedule(jobs_list, vms_groups, threads, delay=0, history=None, default=0, excluded=None):
+    history = history or {}
+    excluded = excluded or set()
+    pending = []
+    for job in jobs_list:
+        members = queue_functions.group_members(vms_groups, job['target']) if job['target'].startswith('/') else \
+            [job['target']]
+        expected_duration = task_estimate(history, None, members, job['snapshot'], default)[0]
+        pending.append(dict(job, members=members, expected_duration=expected_duration))
+    pending.sort(key=lambda job: job['expected_duration'], reverse=True)
+
+    threads = max(1, min(threads or len(vms_groups), len(vms_groups)))
+    events = [(number * delay, number) for number in range(threads)]
+    busy_until = {}
+    last_used = {}
+    schedule = []
+    while events and pending:
+        now, number = heapq.heappop(events)
+        free_vms = [vm for vm in vms_groups if busy_until.get(vm, 0) <= now]
+        job = vm = None
+        for job in pending:
+            vm = queue_functions.select_vm(job['target'], [vm for vm in free_vms
+                                                           if f'{vm}/{job["snapshot"]}' not in excluded],
+                                           vms_groups, last_used)
+            if vm:
+                break
+        if not vm:
+            # Wait for the next VM to finish. Thread is stopped if no VM is busy (job can not be run at all)
+            later = [end for end in busy_until.values() if end > now]
+            if later:
+                heapq.heappush(events, (min(later), number))
+            continue
+        pending.remove(job)
+        duration, phases = task_estimate(history, vm, job.pop('members'), job['snapshot'], default)
+        busy_until[vm] = last_used[vm] = now + duration
+        schedule.append(dict(job, vm=vm, start=now, end=now + duration, phases=phases))
+        heapq.heappush(events, (now + duration, number))
+
+    makespan = max([task['end'] for task in schedule], default=0)
+    busy = {vm: sum(task['end'] - task['start'] for task in schedule if task['vm'] == vm) for vm in vms_groups}
+    phases = {}
+    for task in schedule:
+        for phase, duration in task['phases'].items():
+            phases[phase] = phases.get(phase, 0) + duration
+    summary = {'tasks': len(schedule), 'unscheduled': len(pending), 'makespan': makespan, 'threads': threads,
+               'utilisation': {vm: busy[vm] / makespan if makespan else 0 for vm in busy},
+               'total_utilisation': sum(busy.values()) / makespan / len(busy) if makespan and busy else 0,
+               'phases': phases, 'bottleneck': max(phases, key=phases.get) if phases else None,
+               'no_history': len([task for task in schedule if not task['phases']]),
+               'limit': 'threads' if threads < len(vms_groups) else 'VMs'}
+    return 0, schedule, summary
@@ -0,0 +1,158 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+import support_functions
+import vm_functions
+
+if __name__ == "__main__":
+    print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
+    exit(1)
+
+# Lock for inventory, shared between threads
+inventory_lock = threading.Lock()
+
+
+# Return SHA256 hash of file. Hashes are cached by path, size and modification time, so unchanged images (several GB)
+# are not read again: {'/path/image.ova': {'size': ..., 'mtime': ..., 'sha256': ...}}
+def cached_hash(file, cache):
+    stat = os.stat(file)
+    path = os.path.abspath(file)
+    entry = cache.get(path, {})
+    if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+        return entry['sha256']
+    logging.info(f'Calculating hash of "{file}".')
+    sha256 = support_functions.file_hash(file)[0]
+    cache[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256}
+    return sha256
+
+
+# Load inventory of provisioned VMs: {'vms': {'vm': {'group': '/group', 'snapshots': ['snapshot'], 'base': 'vm',
+# 'sha256': ..., 'mode': 'linked'}}, 'hashes': {...}}. VMs are described the same way as VMs advertised by queue workers
+def inventory_load(inventory_file='inventory.json'):
+    inventory = {'vms': {}, 'hashes': {}}
+    if os.path.isfile(inventory_file):
+        with open(inventory_file, encoding='utf-8') as f:
+            try:
+                inventory.update(json.load(f))
+            except ValueError:
+                logging.warning(f'Unable to read inventory "{inventory_file}".')
+    return inventory
+
+
+# Save inventory. File is replaced atomically
+def inventory_save(inventory, inventory_file='inventory.json'):
+    with inventory_lock:
+        with open(f'{inventory_file}.tmp', mode='w', encoding='utf-8') as f:
+            json.dump(inventory, f, indent=1)
+        os.replace(f'{inventory_file}.tmp', inventory_file)
+    return 0
+
+
+# Create clone of base VM with baseline snapshot and add it to inventory. Clone of previous version of image (or in
+# other mode) is removed first
+def provision_clone(inventory, base_vm, vm, mode, snapshot, group):
+    if vm in inventory['vms']:
+        vm_functions.vm_remove(vm)
+        with inventory_lock:
+            inventory['vms'].pop(vm)
+    if mode == 'linked':
+        result = vm_functions.vm_clone(base_vm, vm, mode='machine', snapshot=snapshot, linked=1, groups=group)
+    else:
+        result = vm_functions.vm_clone(base_vm, vm, mode='machine', snapshot=snapshot, groups=group)
+    if result[0] != 0:
+        logging.error(f'Unable to clone VM "{base_vm}" as "{vm}": {result[2]}')
+        return result[0]
+    result = vm_functions.vm_snapshot_take(vm, snapshot)
+    if result[0] != 0:
+        return result[0]
+    with inventory_lock:
+        inventory['vms'][vm] = {'group': group, 'snapshots': [snapshot], 'base': base_vm,
+                                'sha256': inventory['vms'][base_vm]['sha256'], 'mode': mode, 'created': time.time()}
+    logging.info(f'VM "{vm}" is ready.')
+    return 0
+
+
+# Import image (OVA/OVF) as base VM and create clones ({base_vm}_01, ...) in parallel, every clone gets baseline
+# snapshot and is placed in group (default: '/{base_vm}'), so it can be used with '--vms /group'.
+# Import is skipped if image is not changed since previous run, clones which are up to date are kept. If image is
+# changed, VMs provisioned from its previous version are removed. Only VMs recorded in inventory are ever removed.
+# Mode: 'linked' (clones share disks of base VM snapshot, created in seconds) or 'full' (independent copies).
+# Returns number of failed clones and inventory records of clones
+def provision(image, base_vm, clones, mode='linked', snapshot='clean', group=None, threads=4,
+              inventory_file='inventory.json'):
+    inventory = inventory_load(inventory_file)
+    vms = inventory['vms']
+    group = group or f'/{base_vm}'
+    sha256 = cached_hash(image, inventory['hashes'])
+    result = vm_functions.list_vms(dictionary=1)
+    if result[0] != 0:
+        return 1, {}
+    existing_vms = result[1]
+
+    # Remove VMs provisioned from previous version of image: clones first, as linked clones use disks of base VM
+    if base_vm in vms and vms[base_vm]['sha256'] != sha256:
+        logging.info(f'Image "{image}" is changed since VM "{base_vm}" was imported. Removing VMs provisioned from it.')
+        for vm in [vm for vm, vm_info in vms.items() if vm_info.get('base') == base_vm] + [base_vm]:
+            if vm in existing_vms and vm_functions.vm_remove(vm)[0] == 0:
+                existing_vms.pop(vm)
+            vms.pop(vm)
+
+    # Import image once
+    if base_vm in vms and base_vm in existing_vms:
+        logging.info(f'VM "{base_vm}" is up to date with image "{image}". Skipping import.')
+    elif base_vm in existing_vms:
+        logging.error(f'VM "{base_vm}" already exists and is not provisioned from image. Exiting.')
+        inventory_save(inventory, inventory_file)
+        return 1, {}
+    else:
+        result = vm_functions.vm_import(base_vm, image)
+        if result[0] == 0:
+            # Clones are created from snapshot of base VM
+            result = vm_functions.vm_snapshot_take(base_vm, snapshot)
+        if result[0] != 0:
+            inventory_save(inventory, inventory_file)
+            return 1, {}
+        vms[base_vm] = {'group': None, 'snapshots': [snapshot], 'image': os.path.abspath(image), 'sha256': sha256,
+                        'imported': time.time()}
+        inventory_save(inventory, inventory_file)
+
+    # Select clones to create: missing ones, or created from other version of image or in other mode
+    names = [f'{base_vm}_{number:02d}' for number in range(1, clones + 1)]
+    clones_list = []
+    failed = []
+    for vm in names:
+        if vm in vms and vms[vm]['sha256'] == sha256 and vms[vm]['mode'] == mode and vms[vm]['group'] == group and \
+                vm in existing_vms:
+            logging.info(f'VM "{vm}" is up to date. Skipping.')
+        elif vm not in vms and vm in existing_vms:
+            logging.error(f'VM "{vm}" already exists and is not provisioned from image. Skipping.')
+            failed.append(vm)
+        else:
+            clones_list.append(vm)
+            if vm not in existing_vms:
+                vms.pop(vm, None)
+
+    # Create clones in parallel. Commands are run by client of caller
+    def clone_routine():
+        while True:
+            with inventory_lock:
+                if not clones_list:
+                    return
+                vm = clones_list.pop(0)
+            if provision_clone(inventory, base_vm, vm, mode, snapshot, group) != 0:
+                failed.append(vm)
+
+    threads_list = [threading.Thread(target=contextvars.copy_context().run, args=(clone_routine,))
+                    for _ in range(max(1, min(threads, len(clones_list))))]
+    for t in threads_list:
+        t.start()
+    for t in threads_list:
+        t.join()
+    inventory_save(inventory, inventory_file)
+    if failed:
+        logging.error(f'Unable to provision VMs: {failed}')
+    return len(failed), {vm: vms[vm] for vm in names if vm in vms}
@@ -0,0 +1,244 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import support_functions
+import vm_functions
+
+if __name__ == "__main__":
+    print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
+    exit(1)
+
+# Lock for job journal, shared between threads
+journal_lock = threading.Lock()
+
+
+# Open job queue (SQLite database, may be placed on a network share) and create tables if needed
+def queue_connect(queue_file):
+    # sqlite3 is imported only when queue is used
+    import sqlite3
+    connection = sqlite3.connect(queue_file, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS samples (sha256 TEXT PRIMARY KEY, filename TEXT, md5 TEXT, size INTEGER, data BLOB);
+        CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, sha256 TEXT, vm TEXT, vm_group TEXT,
+                                         snapshot TEXT, status TEXT DEFAULT 'queued', worker TEXT, result TEXT,
+                                         created REAL, started REAL, finished REAL);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+        CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, inventory TEXT, last_seen REAL);
+        ''')
+    # Queues created by previous versions do not have VM group of job
+    if 'vm_group' not in [row['name'] for row in connection.execute('PRAGMA table_info(jobs)')]:
+        try:
+            connection.execute('ALTER TABLE jobs ADD COLUMN vm_group TEXT')
+        except sqlite3.OperationalError:
+            # Column was added by another worker
+            pass
+    return connection
+
+
+# Advertise VMs of worker: {'vm': {'group': '/group', 'snapshots': ['snapshot']}}
+def queue_register_worker(queue_file, worker, inventory):
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        connection.execute('INSERT OR REPLACE INTO workers (name, inventory, last_seen) VALUES (?, ?, ?)',
+                           (worker, json.dumps(inventory), time.time()))
+    logging.debug('Worker "%s" registered with VMs: %s', worker, list(inventory))
+    return 0
+
+
+# Return VMs advertised by all workers: {'vm': {'group': '/group', 'snapshots': [...], 'worker': 'name'}}
+def queue_inventory(queue_file):
+    inventory = {}
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        for row in connection.execute('SELECT name, inventory FROM workers ORDER BY name'):
+            for vm, vm_info in json.loads(row['inventory']).items():
+                inventory[vm] = dict(vm_info, worker=row['name'])
+    return inventory
+
+
+# Return VMs which belong to group: {'vm': '/group'} -> ['vm']
+def group_members(vms_groups, group):
+    group = group.rstrip('/') or '/'
+    return [vm for vm, groups in vms_groups.items() if group in vm_functions.vm_groups(groups)]
+
+
+# Select VM for job target (VM name or '/group') from free VMs. Within group the least recently used VM is selected,
+# so load is spread evenly across group
+def select_vm(target, free_vms, vms_groups, last_used=None):
+    if not target.startswith('/'):
+        return target if target in free_vms else None
+    candidates = [vm for vm in group_members(vms_groups, target) if vm in free_vms]
+    if not candidates:
+        return None
+    last_used = last_used or {}
+    return min(candidates, key=lambda vm: last_used.get(vm, 0))
+
+
+# Return snapshots available on all VMs in list: {'vm': ['snapshot']}
+def common_snapshots(vms_snapshots, vms_list):
+    snapshots_list = None
+    for vm in vms_list:
+        vm_snapshots = vms_snapshots.get(vm, [])
+        if snapshots_list is None:
+            snapshots_list = list(vm_snapshots)
+        else:
+            snapshots_list = [snapshot for snapshot in snapshots_list if snapshot in vm_snapshots]
+    return snapshots_list or []
+
+
+# Add jobs for every file/VM/snapshot to the queue. Files are stored in queue, so workers do not need access to them.
+# VM may be set to '/group' to run job on any free VM in that group.
+# 'all' in VMs or snapshots is expanded using VMs advertised by workers.
+def queue_submit(queue_file, files, vms_list, snapshots_list):
+    inventory = queue_inventory(queue_file)
+    vms_groups = {vm: vm_info['group'] for vm, vm_info in inventory.items()}
+    vms_snapshots = {vm: vm_info['snapshots'] for vm, vm_info in inventory.items()}
+    if 'all' in vms_list:
+        vms_list = sorted(inventory)
+    jobs = []
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        for file in files:
+            if not os.path.isfile(file):
+                logging.error(f'File "{file}" does not exist. Skipping.')
+                continue
+            result = support_functions.file_info(file)
+            if result[0] != 0:
+                logging.error(f'Unable to submit file "{file}". Skipping.')
+                continue
+            sha256, md5, size = result[1], result[2], result[3]
+            with open(file, 'rb') as f:
+                connection.execute('INSERT OR IGNORE INTO samples (sha256, filename, md5, size, data) '
+                                   'VALUES (?, ?, ?, ?, ?)', (sha256, os.path.basename(file), md5, size, f.read()))
+            for target in vms_list:
+                if target.startswith('/'):
+                    vm, vm_group, members = None, target, group_members(vms_groups, target)
+                else:
+                    vm, vm_group, members = target, None, [target]
+                if 'all' in snapshots_list:
+                    if not all(member in inventory for member in members) or not members:
+                        logging.error(f'VM "{target}" is not advertised by any worker. Unable to get snapshots.')
+                        continue
+                    vm_snapshots = common_snapshots(vms_snapshots, members)
+                else:
+                    vm_snapshots = snapshots_list
+                for snapshot in vm_snapshots:
+                    cursor = connection.execute('INSERT INTO jobs (sha256, vm, vm_group, snapshot, created) '
+                                                'VALUES (?, ?, ?, ?, ?)', (sha256, vm, vm_group, snapshot, time.time()))
+                    jobs.append(cursor.lastrowid)
+    logging.info(f'{len(jobs)} jobs submitted.')
+    return 0, jobs
+
+
+# Take oldest queued job for one of the free VMs ({'vm': '/group'}), either for specific VM or for group VM
+# belongs to. If snapshots of VMs are set ({'vm': ['snapshot']}), group job is taken only by VM which has its snapshot
+# (job is left for other VMs otherwise). Returns job as dictionary (with VM selected for job) or None
+def queue_claim(queue_file, worker, free_vms, last_used=None, vms_snapshots=None):
+    if not free_vms:
+        return None
+    vms_list = list(free_vms)
+    groups_list = sorted({group for groups in free_vms.values() for group in vm_functions.vm_groups(groups)})
+    job = None
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        # Lock database for writing, so job can not be taken by two workers
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute(f'''SELECT id, sha256, vm, vm_group, snapshot FROM jobs
+                                          WHERE status = 'queued' AND (vm IN ({', '.join('?' * len(vms_list))}) OR
+                                          vm IS NULL AND vm_group IN ({', '.join('?' * len(groups_list))}))
+                                          ORDER BY id''', vms_list + groups_list)
+            for row in rows:
+                candidates = free_vms if row['vm'] or vms_snapshots is None else \
+                    {vm: groups for vm, groups in free_vms.items() if row['snapshot'] in vms_snapshots.get(vm, [])}
+                vm = select_vm(row['vm'] or row['vm_group'], candidates, free_vms, last_used)
+                if vm:
+                    job = dict(row, vm=vm)
+                    break
+            if job:
+                connection.execute("UPDATE jobs SET status = 'running', vm = ?, worker = ?, started = ? WHERE id = ?",
+                                   (job['vm'], worker, time.time(), job['id']))
+            connection.execute('UPDATE workers SET last_seen = ? WHERE name = ?', (time.time(), worker))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+    return job
+
+
+# Save file from queue to local directory. Returns path to file
+def queue_fetch_sample(queue_file, sha256, directory='samples'):
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        row = connection.execute('SELECT filename, md5, size FROM samples WHERE sha256 = ?', (sha256,)).fetchone()
+        if not row:
+            logging.error(f'File with SHA256 {sha256} is not found in queue.')
+            return 1, None, None, None
+        file = f'{directory}/{sha256}/{row["filename"]}'
+        if not os.path.isfile(file):
+            os.makedirs(f'{directory}/{sha256}', exist_ok=True)
+            data = connection.execute('SELECT data FROM samples WHERE sha256 = ?', (sha256,)).fetchone()['data']
+            with open(file, 'wb') as f:
+                f.write(data)
+    return 0, file, row['md5'], row['size']
+
+
+# Save job results
+def queue_complete(queue_file, job_id, status, result):
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        connection.execute('UPDATE jobs SET status = ?, result = ?, finished = ? WHERE id = ?',
+                           (status, json.dumps(result), time.time(), job_id))
+    return 0
+
+
+# Return job to the queue (e.g. worker was stopped before job was finished). Group jobs can be taken by any VM again
+def queue_release(queue_file, job_id):
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        connection.execute("UPDATE jobs SET status = 'queued', vm = CASE WHEN vm_group IS NULL THEN vm END, "
+                           "worker = NULL, started = NULL WHERE id = ?", (job_id,))
+    return 0
+
+
+# Return number of jobs by status and list of workers
+def queue_status(queue_file):
+    with contextlib.closing(queue_connect(queue_file)) as connection:
+        jobs = dict(connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        workers = {row['name']: row['last_seen'] for row in connection.execute('SELECT name, last_seen FROM workers')}
+    return 0, jobs, workers
+
+
+# Append task state change to job journal (one JSON document per line). Every entry is flushed to disk before
+# returning, so journal survives crash of the script or host. States: queued, restoring, running, collecting, done,
+# failed, cancelled (by user), interrupted (by signal, can be resumed). Additional data (job for 'queued', VM for other
+# states) is saved with the entry
+def journal_write(journal_file, task_id, state, **data):
+    line = json.dumps(dict(data, task=task_id, state=state, time=time.time())) + '\n'
+    with journal_lock:
+        with open(journal_file, mode='a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+    return 0
+
+
+# Return last known state of every task from job journal: {'task_id': {'state': ..., 'job': ..., 'vm': ...}}
+def journal_read(journal_file):
+    tasks = {}
+    if not os.path.isfile(journal_file):
+        return tasks
+    with open(journal_file, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line may be incomplete after crash
+                logging.debug('Skipping incomplete journal entry: %s', line)
+                continue
+            tasks.setdefault(entry.pop('task'), {}).update(entry)
+    return tasks
+
+
+# Return unfinished tasks from job journal. Tasks which were interrupted after VM was selected have 'vm' set
+def journal_unfinished(journal_file):
+    return {task_id: task for task_id, task in journal_read(journal_file).items()
+            if task['state'] not in ['done', 'failed', 'cancelled'] and 'job' in task}
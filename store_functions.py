@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import support_functions
+
+if __name__ == "__main__":
+    print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
+    exit(1)
+
+# Lock for store index, shared between threads
+store_lock = threading.Lock()
+
+
+# Artifact store: files (blobs) are kept by SHA256 hash of content as <store>/<hash[:2]>/<hash>, so identical files
+# (screenshots, dropped files, etc.) are stored once. Index (<store>/index.json) keeps size of every blob and its
+# references (e.g. '<file_hash>/<vm>_<snapshot>' of task) with time they were added:
+# {'sha256': {'size': ..., 'refs': {'reference': time}}}
+# Changes since index was saved are appended to <store>/index.log (one JSON document per line), so adding artifacts
+# does not rewrite whole index: {'ref': ..., 'sha256': ..., 'size': ..., 'time': ...} adds reference,
+# {'ref': ...} removes all blobs from reference
+def blob_path(store, sha256):
+    return f'{store}/{sha256[:2]}/{sha256}'
+
+
+# Load store index with changes from log
+def store_index(store):
+    index = {}
+    if os.path.isfile(f'{store}/index.json'):
+        with open(f'{store}/index.json', encoding='utf-8') as f:
+            try:
+                index = json.load(f)
+            except ValueError:
+                logging.warning(f'Unable to read index of artifact store "{store}".')
+    if not os.path.isfile(f'{store}/index.log'):
+        return index
+
+    # Blobs of every reference: {'reference': {'sha256'}}
+    references = {}
+    for sha256, blob in index.items():
+        for reference in blob['refs']:
+            references.setdefault(reference, set()).add(sha256)
+    with open(f'{store}/index.log', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line may be incomplete after crash
+                continue
+            if 'sha256' in entry:
+                index.setdefault(entry['sha256'], {'size': entry['size'], 'refs': {}})['refs'][entry['ref']] = \
+                    entry['time']
+                references.setdefault(entry['ref'], set()).add(entry['sha256'])
+            else:
+                for sha256 in references.pop(entry['ref'], ()):
+                    index[sha256]['refs'].pop(entry['ref'], None)
+    return index
+
+
+# Save store index, changes from log are included. File is replaced atomically
+def store_index_save(store, index):
+    with open(f'{store}/index.json.tmp', mode='w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(f'{store}/index.json.tmp', f'{store}/index.json')
+    if os.path.isfile(f'{store}/index.log'):
+        os.remove(f'{store}/index.log')
+    return 0
+
+
+# Append changes to index log
+def store_log(store, entries):
+    with open(f'{store}/index.log', mode='a', encoding='utf-8') as f:
+        f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+    return 0
+
+
+# Move files to store. Files already present in store are only removed, so nothing is written for duplicates.
+# Previous references of the same owner are replaced (e.g. task was run again). Returns {'file name': 'sha256'}
+def store_add(store, files, reference):
+    os.makedirs(store, exist_ok=True)
+    # Files (e.g. memory dumps) are hashed before lock is taken, so tasks do not wait for each other
+    hashes = {file: support_functions.file_hash(file)[0] for file in files if os.path.isfile(file)}
+    artifacts = {}
+    entries = [{'ref': reference}]
+    added = 0
+    with store_lock:
+        for file, sha256 in hashes.items():
+            size = os.path.getsize(file)
+            path = blob_path(store, sha256)
+            if os.path.isfile(path):
+                os.remove(file)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Rename if store is on the same file system, copy otherwise
+                shutil.move(file, path)
+                added += 1
+            entries.append({'ref': reference, 'sha256': sha256, 'size': size, 'time': time.time()})
+            artifacts[os.path.basename(file)] = sha256
+        store_log(store, entries)
+    logging.debug('%s artifacts saved to store, %s of them are new.', len(artifacts), added)
+    return 0, artifacts
+
+
+# Remove reference (e.g. report was deleted). Blobs without references are removed by store_cleanup()
+def store_release(store, reference):
+    with store_lock:
+        released = len([blob for blob in store_index(store).values() if reference in blob['refs']])
+        store_log(store, [{'ref': reference}])
+    return 0, released
+
+
+# Remove references older than max_age days (if set) and blobs without references. Returns number of removed blobs
+# and space reclaimed (bytes)
+def store_cleanup(store, max_age=None):
+    removed = 0
+    reclaimed = 0
+    with store_lock:
+        index = store_index(store)
+        for sha256, blob in list(index.items()):
+            if max_age is not None:
+                blob['refs'] = {reference: added for reference, added in blob['refs'].items()
+                                if time.time() - added <= max_age * 86400}
+            if blob['refs']:
+                continue
+            for path in [blob_path(store, sha256), f'{store}/thumbnails/{sha256}']:
+                if os.path.isfile(path):
+                    os.remove(path)
+            del index[sha256]
+            removed += 1
+            reclaimed += blob['size']
+        if os.path.isdir(store):
+            store_index_save(store, index)
+    logging.info(f'{removed} artifacts removed from store, {round(reclaimed / 1024 / 1024)} MB reclaimed.')
+    return 0, removed, reclaimed
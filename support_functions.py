@@ -1,15 +1,121 @@
+import contextvars
 import datetime
 import hashlib
+import html
+import json
 import logging
+import math
+import mmap
+import operator
 import os
+import queue
 import random
 import re
 import string
+import struct
+import threading
+import zlib
+
+
+# Locks for results record and timings history, shared between threads
+results_lock = threading.Lock()
+timings_lock = threading.Lock()
 
 if __name__ == "__main__":
     print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
     exit(1)
 
+# Task of current thread, added to every log record as 'task' ('-' outside of tasks)
+task_context = contextvars.ContextVar('task', default='-')
+log_record_factory = logging.getLogRecordFactory()
+
+
+# Create log record with task of current thread
+def task_log_record(*args, **kwargs):
+    record = log_record_factory(*args, **kwargs)
+    record.task = task_context.get()
+    return record
+
+
+# Format log records as JSON documents (one per line)
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'task': getattr(record, 'task', '-'),
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+# Write log records of every task to its own file: task_open('task', 'file') ... task_close('task')
+class TaskLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+        # Queue of records written by background thread, see log_setup()
+        self.records_queue = None
+
+    def task_open(self, task, file):
+        with self.lock:
+            self.files[task] = open(file, mode='a', encoding='utf-8')
+
+    def task_close(self, task):
+        if self.records_queue is not None:
+            # Last records of task may still be queued: file is closed by background thread after them
+            self.records_queue.put(logging.makeLogRecord({'task': task, 'task_closed': True}))
+        else:
+            self._close(task)
+
+    def _close(self, task):
+        with self.lock:
+            f = self.files.pop(task, None)
+        if f:
+            f.close()
+
+    def emit(self, record):
+        if getattr(record, 'task_closed', False):
+            self._close(record.task)
+            return
+        f = self.files.get(getattr(record, 'task', None))
+        if f:
+            try:
+                f.write(self.format(record) + '\n')
+                f.flush()
+            except Exception:
+                self.handleError(record)
+
+
+task_log_handler = TaskLogHandler()
+
+
+# Configure logging: task in every record, text or JSON format, per-task log files (see task_log_handler).
+# With log_queue=1 records are passed to background thread, so logging does not block tasks.
+# Returns queue listener (should be stopped before exit to write remaining records) or None
+def log_setup(level, file=None, log_format='text', log_queue=0):
+    logging.setLogRecordFactory(task_log_record)
+    if log_format == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s [%(levelname)s] [%(task)s] %(message)s')
+    handlers = [logging.FileHandler(file, mode='a') if file else logging.StreamHandler(), task_log_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    # Records closing task log files are only for task_log_handler
+    handlers[0].addFilter(lambda record: not getattr(record, 'task_closed', False))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    if log_queue:
+        import logging.handlers as logging_handlers
+        records_queue = task_log_handler.records_queue = queue.SimpleQueue()
+        listener = logging_handlers.QueueListener(records_queue, *handlers)
+        listener.start()
+        root.addHandler(logging_handlers.QueueHandler(records_queue))
+        return listener
+    for handler in handlers:
+        root.addHandler(handler)
+    return None
+
 
 # Normalize path (replace '\' and '/' with '\\').
 def normalize_path(path):
@@ -83,13 +189,446 @@ def randomize_filename(login, file, destination_folder):
         logging.debug('Using custom remote_folder')
 
     random_filename = destination_folder + random_name + file_extension
-    logging.debug(f'Remote file: "{random_filename}"')
+    logging.debug('Remote file: "%s"', random_filename)
     return random_filename
 
 
-# Generate html report
+# Compare memory dump with baseline dump page by page and save only changed pages.
+# Diff file format: b'VMADIFF1', page size, dump size (<QQ), then runs of changed pages as
+# offset, length (<QQ) followed by raw data.
+def memdump_diff(baseline_file, dump_file, diff_file, page_size=4096):
+    # numpy is optional and slow to import, so it is imported only here
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    dump_size = os.path.getsize(dump_file)
+    baseline_size = os.path.getsize(baseline_file)
+    common_size = min(dump_size, baseline_size) // page_size * page_size
+    pages_total = -(-dump_size // page_size)
+    pages_changed = 0
+
+    with open(baseline_file, 'rb') as baseline_fo, open(dump_file, 'rb') as dump_fo, \
+            open(diff_file, 'wb') as diff_fo:
+        baseline = mmap.mmap(baseline_fo.fileno(), 0, access=mmap.ACCESS_READ) if baseline_size else b''
+        dump = mmap.mmap(dump_fo.fileno(), 0, access=mmap.ACCESS_READ) if dump_size else b''
+        diff_fo.write(b'VMADIFF1' + struct.pack('<QQ', page_size, dump_size))
+
+        # Find changed pages within common part of both files, 4096 pages per chunk
+        changed_pages = []
+        chunk_pages = 4096
+        for chunk_start in range(0, common_size, chunk_pages * page_size):
+            chunk_end = min(chunk_start + chunk_pages * page_size, common_size)
+            if numpy is not None and page_size % 8 == 0:
+                a = numpy.frombuffer(baseline, dtype=numpy.uint64, count=(chunk_end - chunk_start) // 8,
+                                     offset=chunk_start).reshape(-1, page_size // 8)
+                b = numpy.frombuffer(dump, dtype=numpy.uint64, count=(chunk_end - chunk_start) // 8,
+                                     offset=chunk_start).reshape(-1, page_size // 8)
+                for page in numpy.flatnonzero((a != b).any(axis=1)):
+                    changed_pages.append(chunk_start + int(page) * page_size)
+                del a, b
+            else:
+                for offset in range(chunk_start, chunk_end, page_size):
+                    if baseline[offset:offset + page_size] != dump[offset:offset + page_size]:
+                        changed_pages.append(offset)
+        # Everything after the common part is treated as changed
+        changed_pages.extend(range(common_size, dump_size, page_size))
+
+        # Merge adjacent pages into runs and write them
+        run_start = run_end = None
+        for offset in changed_pages + [None]:
+            if offset is not None and offset == run_end:
+                run_end = min(offset + page_size, dump_size)
+                continue
+            if run_start is not None:
+                diff_fo.write(struct.pack('<QQ', run_start, run_end - run_start))
+                diff_fo.write(dump[run_start:run_end])
+            if offset is not None:
+                run_start, run_end = offset, min(offset + page_size, dump_size)
+        pages_changed = len(changed_pages)
+
+        if dump_size:
+            dump.close()
+        if baseline_size:
+            baseline.close()
+
+    logging.debug('Memory dump diff: %s of %s pages changed, saved as %s.', pages_changed, pages_total, diff_file)
+    return 0, pages_changed, pages_total
+
+
+# Rebuild full memory dump from baseline dump and diff file created with memdump_diff()
+def memdump_patch(baseline_file, diff_file, dump_file):
+    with open(diff_file, 'rb') as diff_fo:
+        if diff_fo.read(8) != b'VMADIFF1':
+            logging.error(f'File "{diff_file}" is not a memory dump diff.')
+            return 1
+        page_size, dump_size = struct.unpack('<QQ', diff_fo.read(16))
+        with open(baseline_file, 'rb') as baseline_fo, open(dump_file, 'wb') as dump_fo:
+            # Copy baseline, then apply changed runs on top of it
+            block_size = 65536
+            copied = 0
+            while copied < dump_size:
+                fb = baseline_fo.read(min(block_size, dump_size - copied))
+                if not fb:
+                    break
+                dump_fo.write(fb)
+                copied += len(fb)
+            header = diff_fo.read(16)
+            while len(header) == 16:
+                offset, length = struct.unpack('<QQ', header)
+                dump_fo.seek(offset)
+                dump_fo.write(diff_fo.read(length))
+                header = diff_fo.read(16)
+            dump_fo.truncate(dump_size)
+    return 0
+
+
+# Get query name from DNS request
+def dns_query_name(payload):
+    if len(payload) < 17:
+        return None
+    flags, questions = struct.unpack_from('>HH', payload, 2)
+    if flags & 0x8000 or questions == 0:
+        return None
+    labels = []
+    offset = 12
+    while offset < len(payload):
+        length = payload[offset]
+        if length == 0:
+            return '.'.join(labels).lower() if labels else None
+        if length & 0xc0 or offset + 1 + length > len(payload):
+            return None
+        labels.append(payload[offset + 1:offset + 1 + length].decode('ascii', errors='replace'))
+        offset += 1 + length
+    return None
+
+
+# Get server name (SNI) from TLS ClientHello
+def tls_server_name(payload):
+    try:
+        if payload[0] != 0x16 or payload[5] != 0x01:
+            return None
+        # Skip record and handshake headers, version and random
+        offset = 5 + 4 + 2 + 32
+        offset += 1 + payload[offset]  # Session ID
+        offset += 2 + struct.unpack_from('>H', payload, offset)[0]  # Cipher suites
+        offset += 1 + payload[offset]  # Compression methods
+        extensions_end = offset + 2 + struct.unpack_from('>H', payload, offset)[0]
+        offset += 2
+        while offset + 4 <= min(extensions_end, len(payload)):
+            extension_type, extension_length = struct.unpack_from('>HH', payload, offset)
+            offset += 4
+            if extension_type == 0:
+                # Server name list: list length, name type, name length, name
+                name_length = struct.unpack_from('>H', payload, offset + 3)[0]
+                return payload[offset + 5:offset + 5 + name_length].decode('ascii', errors='replace').lower()
+            offset += extension_length
+    except (IndexError, struct.error):
+        pass
+    return None
+
+
+# Parse traffic dump (pcap format) and return summary: flows, DNS queries, HTTP hosts and TLS server names.
+# File is memory-mapped and parsed packet by packet, so memory usage does not depend on file size.
+def pcap_summary(file, index_file=None, max_flows=100):
+    import ipaddress
+    summary = {'packets': 0, 'bytes': 0, 'flows_total': 0, 'flows': [], 'dns': [], 'http_hosts': [], 'tls_sni': []}
+    if not os.path.isfile(file) or os.path.getsize(file) < 24:
+        logging.error(f'Traffic dump "{file}" does not exists or empty.')
+        return 1, summary
+
+    flows = {}
+    dns, http_hosts, tls_sni = set(), set(), set()
+    http_host_pattern = re.compile(rb'\r\nhost:[ \t]*([^\r\n: \t]+)', flags=re.IGNORECASE)
+    http_methods = (b'GET ', b'POST ', b'HEAD ', b'PUT ', b'DELETE ', b'OPTIONS ', b'CONNECT ', b'PATCH ')
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic = data[:4]
+        if magic in [b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1']:
+            endian = '<'
+        elif magic in [b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d']:
+            endian = '>'
+        else:
+            logging.error(f'Traffic dump "{file}" is not in pcap format.')
+            return 1, summary
+        link_type = struct.unpack_from(f'{endian}I', data, 20)[0]
+        record_header = struct.Struct(f'{endian}IIII')
+
+        offset = 24
+        size = len(data)
+        while offset + 16 <= size:
+            incl_len, orig_len = record_header.unpack_from(data, offset)[2:]
+            packet = data[offset + 16:offset + 16 + incl_len]
+            offset += 16 + incl_len
+            summary['packets'] += 1
+            summary['bytes'] += orig_len
+
+            # Link layer: Ethernet (with optional VLAN tags) or raw IP
+            if link_type == 1:
+                if len(packet) < 14:
+                    continue
+                ip_offset, ether_type = 14, struct.unpack_from('>H', packet, 12)[0]
+                while ether_type == 0x8100 and len(packet) >= ip_offset + 4:
+                    ether_type = struct.unpack_from('>H', packet, ip_offset + 2)[0]
+                    ip_offset += 4
+            elif link_type == 101:
+                ip_offset, ether_type = 0, 0x0800 if packet[:1] and packet[0] >> 4 == 4 else 0x86dd
+            else:
+                continue
+
+            # Network layer
+            if ether_type == 0x0800 and len(packet) >= ip_offset + 20:
+                header_length = (packet[ip_offset] & 0x0f) * 4
+                if struct.unpack_from('>H', packet, ip_offset + 6)[0] & 0x1fff:
+                    # Skip non-first fragments
+                    continue
+                protocol = packet[ip_offset + 9]
+                src = packet[ip_offset + 12:ip_offset + 16]
+                dst = packet[ip_offset + 16:ip_offset + 20]
+                transport_offset = ip_offset + header_length
+            elif ether_type == 0x86dd and len(packet) >= ip_offset + 40:
+                protocol = packet[ip_offset + 6]
+                src = packet[ip_offset + 8:ip_offset + 24]
+                dst = packet[ip_offset + 24:ip_offset + 40]
+                transport_offset = ip_offset + 40
+            else:
+                continue
+
+            # Transport layer
+            if protocol == 6 and len(packet) >= transport_offset + 20:
+                protocol_name = 'tcp'
+                sport, dport = struct.unpack_from('>HH', packet, transport_offset)
+                payload = packet[transport_offset + (packet[transport_offset + 12] >> 4) * 4:]
+            elif protocol == 17 and len(packet) >= transport_offset + 8:
+                protocol_name = 'udp'
+                sport, dport = struct.unpack_from('>HH', packet, transport_offset)
+                payload = packet[transport_offset + 8:]
+            else:
+                protocol_name, sport, dport, payload = str(protocol), 0, 0, b''
+
+            # Flows are counted in both directions, first seen packet defines source
+            key = (protocol_name, src, sport, dst, dport)
+            if key not in flows:
+                reverse_key = (protocol_name, dst, dport, src, sport)
+                if reverse_key in flows:
+                    key = reverse_key
+                else:
+                    flows[key] = [0, 0]
+            flows[key][0] += 1
+            flows[key][1] += orig_len
+
+            # Application layer
+            if not payload:
+                continue
+            if protocol_name == 'udp' and dport == 53:
+                name = dns_query_name(payload)
+                if name:
+                    dns.add(name)
+            elif protocol_name == 'tcp':
+                if payload.startswith(http_methods):
+                    host = http_host_pattern.search(payload)
+                    if host:
+                        http_hosts.add(host.group(1).decode('ascii', errors='replace').lower())
+                elif payload[0] == 0x16:
+                    name = tls_server_name(payload)
+                    if name:
+                        tls_sni.add(name)
+
+    summary['flows_total'] = len(flows)
+    for key, (packets, size) in sorted(flows.items(), key=lambda item: item[1][1], reverse=True)[:max_flows]:
+        summary['flows'].append({'protocol': key[0], 'src': str(ipaddress.ip_address(key[1])), 'sport': key[2],
+                                 'dst': str(ipaddress.ip_address(key[3])), 'dport': key[4], 'packets': packets,
+                                 'bytes': size})
+    summary['dns'] = sorted(dns)
+    summary['http_hosts'] = sorted(http_hosts)
+    summary['tls_sni'] = sorted(tls_sni)
+    logging.debug('Traffic dump "%s": %s packets, %s flows.', file, summary['packets'], summary['flows_total'])
+
+    # Save summary next to traffic dump
+    if index_file:
+        with open(index_file, mode='w', encoding='utf-8') as f:
+            json.dump(summary, f)
+    return 0, summary
+
+
+# Append task result to results record (one JSON document per line)
+def save_results(record, reports_directory='reports'):
+    os.makedirs(reports_directory, exist_ok=True)
+    line = json.dumps(record) + '\n'
+    with results_lock:
+        with open(f'{reports_directory}/results.jsonl', mode='a', encoding='utf-8') as f:
+            f.write(line)
+    return 0
+
+
+# Search results record for domain/host (also matches subdomains)
+def search_results(domain, reports_directory='reports'):
+    domain = domain.lower().rstrip('.')
+    results_file = f'{reports_directory}/results.jsonl'
+    matches = []
+    if not os.path.isfile(results_file):
+        logging.error(f'Results record "{results_file}" does not exists.')
+        return 1, matches
+    with open(results_file, encoding='utf-8') as f:
+        for line in f:
+            # Skip JSON parsing for lines which does not contain domain at all
+            if domain not in line.lower():
+                continue
+            record = json.loads(line)
+            network = record.get('network_summary') or {}
+            names = network.get('dns', []) + network.get('http_hosts', []) + network.get('tls_sni', [])
+            if any(name == domain or name.endswith(f'.{domain}') for name in names):
+                matches.append(record)
+    return 0, matches
+
+
+# Return history of task durations: {'vm/snapshot': {'phase': seconds}}
+def load_timings(history_file='timings.json'):
+    if not os.path.isfile(history_file):
+        return {}
+    with open(history_file, encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            logging.warning(f'Unable to read timings history "{history_file}".')
+            return {}
+
+
+# Update history of task durations with timings of finished task (exponential moving average)
+def save_timings(vm, snapshot, timings, history_file='timings.json', weight=0.3):
+    with timings_lock:
+        history = load_timings(history_file)
+        task_history = history.setdefault(f'{vm}/{snapshot}', {})
+        for phase, duration in timings.items():
+            if phase in task_history:
+                duration = task_history[phase] * (1 - weight) + duration * weight
+            task_history[phase] = round(duration, 2)
+        with open(f'{history_file}.tmp', mode='w', encoding='utf-8') as f:
+            json.dump(history, f, indent=1)
+        os.replace(f'{history_file}.tmp', history_file)
+    return 0
+
+
+# Return expected duration of task phase (average for list of VMs) from history, or default value if unknown
+def expected_duration(history, vms_list, snapshot, phase='total', default=0):
+    durations = [history[f'{vm}/{snapshot}'][phase] for vm in vms_list
+                 if phase in history.get(f'{vm}/{snapshot}', {})]
+    if not durations:
+        return default
+    return sum(durations) / len(durations)
+
+
+# Sum of two bytes modulo 256: byte_table[a + b]
+byte_table = bytes(range(256)) * 2
+
+
+# Reverse PNG filter of one row (bpp - bytes per pixel, prev - previous row after reversing filter)
+def png_unfilter(filter_type, row, prev, bpp):
+    if filter_type == 0:
+        return row
+    if filter_type == 2:
+        return bytearray(map(byte_table.__getitem__, map(operator.add, row, prev)))
+    row = bytearray(row)
+    if filter_type == 1:
+        for i in range(bpp, len(row)):
+            row[i] = (row[i] + row[i - bpp]) & 255
+    elif filter_type == 3:
+        for i in range(len(row)):
+            row[i] = (row[i] + ((row[i - bpp] if i >= bpp else 0) + prev[i] >> 1)) & 255
+    elif filter_type == 4:
+        for i in range(len(row)):
+            a, c = (row[i - bpp], prev[i - bpp]) if i >= bpp else (0, 0)
+            b = prev[i]
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 255
+    return row
+
+
+# Decode PNG image. Returns width, height, bytes per pixel and generator of pixel rows, or None if format is not
+# supported. Pillow is used if installed (image is decoded in C), pure Python decoder otherwise: only 8-bit RGB/RGBA
+# images without interlacing (as saved by VirtualBox) are supported
+def png_decode(file):
+    # Pillow is optional, so it is imported only here
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        with Image.open(file) as image:
+            image = image.convert('RGB')
+        image_width, image_height = image.size
+        pixels = image.tobytes()
+        return image_width, image_height, 3, (pixels[y * image_width * 3:(y + 1) * image_width * 3]
+                                              for y in range(image_height))
+
+    with open(file, 'rb') as f:
+        data = f.read()
+    if data[:8] != b'\x89PNG\r\n\x1a\n':
+        return None
+    header, idat, offset = None, [], 8
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if chunk_type == b'IHDR' and length == 13:
+            header = struct.unpack('>IIBBBBB', data[offset + 8:offset + 21])
+        elif chunk_type == b'IDAT':
+            idat.append(data[offset + 8:offset + 8 + length])
+        elif chunk_type == b'IEND':
+            break
+        offset += length + 12
+    if not header or len(header) != 7 or header[2] != 8 or header[3] not in [2, 6] or header[6] != 0:
+        return None
+    image_width, image_height, bpp = header[0], header[1], 3 if header[3] == 2 else 4
+
+    # Every row has to be unfiltered, as filters depend on previous row
+    def rows():
+        stride = image_width * bpp + 1
+        pixels = zlib.decompress(b''.join(idat))
+        prev = bytearray(stride - 1)
+        for y in range(image_height):
+            row = pixels[y * stride:(y + 1) * stride]
+            prev = png_unfilter(row[0], row[1:], prev, bpp)
+            yield prev
+    return image_width, image_height, bpp, rows()
+
+
+# Create thumbnail of PNG image (e.g. screenshot), so reports do not load full size images. Image libraries are not
+# required (see png_decode()). Thumbnail is saved as RGB image, width is reduced by integer factor.
+# Returns size of thumbnail
+def png_thumbnail(file, thumbnail_file, width=320):
+    thumbnail = bytearray()
+    try:
+        image = png_decode(file)
+        if not image:
+            logging.debug('Unable to create thumbnail for %s: unsupported image format.', file)
+            return 1, None, None
+        image_width, image_height, bpp, rows = image
+        # Every factor-th row and pixel is kept
+        factor = max(1, math.ceil(image_width / width))
+        thumbnail_width, thumbnail_height = math.ceil(image_width / factor), math.ceil(image_height / factor)
+        for y, row in enumerate(rows):
+            if y % factor == 0:
+                thumbnail_row = bytearray(thumbnail_width * 3 + 1)
+                for channel in range(3):
+                    thumbnail_row[1 + channel::3] = row[channel::bpp * factor]
+                thumbnail += thumbnail_row
+    except (OSError, zlib.error, IndexError, ValueError) as error:
+        # Damaged or truncated image
+        logging.debug('Unable to create thumbnail for %s: %s', file, error)
+        return 1, None, None
+    with open(thumbnail_file, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        for chunk_type, chunk in [(b'IHDR', struct.pack('>IIBBBBB', thumbnail_width, thumbnail_height, 8, 2, 0, 0, 0)),
+                                  (b'IDAT', zlib.compress(bytes(thumbnail), 6)), (b'IEND', b'')]:
+            f.write(struct.pack('>I', len(chunk)) + chunk_type + chunk +
+                    struct.pack('>I', zlib.crc32(chunk_type + chunk)))
+    return 0, thumbnail_width, thumbnail_height
+
+
+# Generate html report. Files of task are taken from report directory, or from artifacts ({'name': 'path'}) if they
+# are kept elsewhere (e.g. in artifact store, see store_functions)
 def html_report(vm, snapshot, filename, file_args, file_size, sha256, md5, timeout, vm_network_state,
-                reports_directory='reports'):
+                reports_directory='reports', network_summary=None, page_size=24, artifacts=None,
+                thumbnails_directory=None, network_profile=None):
     # Set options and paths
     now = datetime.datetime.now()
     time = now.strftime("%Y-%m-%d %H:%M:%S")
@@ -109,11 +648,11 @@ def html_report(vm, snapshot, filename, file_args, file_size, sha256, md5, timeo
     <table>
       <tr>
         <td><b>Filename:</b></td>
-        <td>{filename}</td>
+        <td>{html.escape(filename)}</td>
       </tr>
       <tr>
         <td><b>File args:</b></td>
-        <td>{file_args}</td>
+        <td>{html.escape(str(file_args))}</td>
       </tr>
       <tr>
         <td><b>File size:</b></td>
@@ -139,33 +678,104 @@ def html_report(vm, snapshot, filename, file_args, file_size, sha256, md5, timeo
         <td><b>Network:</b></td>
         <td>{vm_network_state}</td>
       </tr>
-      <tr>    
-        <td><b>Downloads:</b></td>
-        <td>
-        <a href=./{sha256}/{vm}{snapshot}.webm target=_blank>Screen recording</a>, 
-        <a href=./{sha256}/{vm}{snapshot}.pcap target=_blank>Traffic dump</a>, 
-        <a href=./{sha256}/{vm}{snapshot}.dmp target=_blank>Memory dump</a>
-        </td>
-      </tr>
     </table>
     <br>
     '''
 
-    # Search for screenshots in reports directory
-    screenshots = os.listdir(destination_dir)
+    # Links to files of task, relative to report
+    def link(path):
+        return html.escape(os.path.relpath(path, destination_dir).replace(os.sep, '/'))
 
-    html_template_screenshots = f'''<h3>VM:</b> {vm}, <b>Snapshot:</b> {snapshot}<h3>'''
+    # Files of task are named <vm>_<snapshot>[_<network profile>]
+    task_name = f'{vm}_{snapshot}_{network_profile}' if network_profile else f'{vm}_{snapshot}'
+
+    # Search for screenshots of task and create thumbnails (once per screenshot)
+    task_files = artifacts or {name: f'{destination_dir}/{name}' for name in os.listdir(destination_dir)}
+    thumbnails_directory = thumbnails_directory or f'{destination_dir}/thumbnails'
+    os.makedirs(thumbnails_directory, exist_ok=True)
+    screenshots = sorted(screenshot for screenshot in task_files
+                         if re.fullmatch(rf'{re.escape(task_name)}_\d+\.png', screenshot))
+    images = []
     for screenshot in screenshots:
-        # Check if filename matches task name and have .png extension
-        if re.search(rf'{vm}_{snapshot}_\d+\.png', screenshot):
-            html_template_screenshots += f'''
-                <a href="{screenshot}" target=_blank><img src="{screenshot}" width="320" high="240"></img></a>
-                '''
+        path = task_files[screenshot]
+        thumbnail = f'{thumbnails_directory}/{os.path.basename(path)}'
+        if not os.path.isfile(thumbnail) and png_thumbnail(path, thumbnail)[0] != 0:
+            thumbnail = path
+        images.append((link(path), link(thumbnail)))
+
+    network = f', <b>Network:</b> {html.escape(network_profile)}' if network_profile else ''
+    html_template_screenshots = f'''<h3>VM:</b> {html.escape(vm)}, <b>Snapshot:</b> {html.escape(snapshot)}''' \
+                                f'''{network}<h3>'''
+
+    # Downloads. Video is loaded only when played, first screenshot is used as poster frame
+    downloads = []
+    for extension, title in [('webm', 'Screen recording'), ('pcap', 'Traffic dump'), ('dmp', 'Memory dump'),
+                             ('dmpdiff', 'Memory dump (diff)'), ('log', 'Log')]:
+        name = f'{task_name}.{extension}'
+        if name in task_files and os.path.isfile(task_files[name]):
+            downloads.append(f'<a href="{link(task_files[name])}" download="{html.escape(name)}" target=_blank>{title}</a>')
+    if downloads:
+        html_template_screenshots += f'''<p><b>Downloads:</b> {', '.join(downloads)}</p>
+    '''
+    if f'{task_name}.webm' in task_files:
+        poster = f' poster="{images[0][1]}"' if images else ''
+        html_template_screenshots += f'''<video{poster} preload="none" controls width="640">
+    <source src="{link(task_files[f'{task_name}.webm'])}" type="video/webm"></video><br>
+    '''
+
+    # Gallery: thumbnails are loaded when visible, pages after the first one are loaded when opened
+    for page_start in range(0, len(images), page_size):
+        page = ''.join(f'''
+        <a href="{screenshot}" target=_blank><img src="{thumbnail}" loading="lazy" width="320"></a>'''
+                       for screenshot, thumbnail in images[page_start:page_start + page_size])
+        if page_start == 0:
+            html_template_screenshots += f'''<div>{page}
+    </div>
+    '''
+        else:
+            html_template_screenshots += f'''<details><summary>Screenshots {page_start + 1}-''' \
+                                         f'''{min(page_start + page_size, len(images))}</summary>{page}
+    </details>
+    '''
+
+    # Network summary from traffic dump. Names and addresses come from guest traffic and are escaped
+    if network_summary:
+        def join(values):
+            return ', '.join(html.escape(str(value)) for value in values)
+
+        html_template_screenshots += f'''
+    <p><b>Traffic:</b> {network_summary['packets']} packets, {network_summary['bytes']} bytes,
+    {network_summary['flows_total']} flows</p>
+    <table>
+      <tr>
+        <td><b>DNS queries:</b></td>
+        <td>{join(network_summary['dns'])}</td>
+      </tr>
+      <tr>
+        <td><b>HTTP hosts:</b></td>
+        <td>{join(network_summary['http_hosts'])}</td>
+      </tr>
+      <tr>
+        <td><b>TLS server names:</b></td>
+        <td>{join(network_summary['tls_sni'])}</td>
+      </tr>
+    </table>
+    <table>
+      <tr><td><b>Protocol</b></td><td><b>Source</b></td><td><b>Destination</b></td><td><b>Packets</b></td><td><b>Bytes</b></td></tr>
+    '''
+        for flow in network_summary['flows'][:20]:
+            flow = {key: html.escape(str(value)) for key, value in flow.items()}
+            html_template_screenshots += f'''  <tr><td>{flow['protocol']}</td><td>{flow['src']}:{flow['sport']}</td>
+    <td>{flow['dst']}:{flow['dport']}</td><td>{flow['packets']}</td><td>{flow['bytes']}</td></tr>
+    '''
+        html_template_screenshots += '''</table>
+    '''
 
     # Write data to report file
-    file_object = open(destination_file, mode='a', encoding='utf-8')
-    # If file is empty, write html header first
-    if os.path.getsize(destination_file) == 0:
-        file_object.write(html_template_header)
-    # Write screenshots block
-    file_object.write(html_template_screenshots)
+    with open(destination_file, mode='a', encoding='utf-8') as file_object:
+        # If file is empty, write html header first
+        if os.path.getsize(destination_file) == 0:
+            file_object.write(html_template_header)
+        # Write screenshots block
+        file_object.write(html_template_screenshots)
+    return 0
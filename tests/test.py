@@ -1,6 +1,26 @@
+import contextlib
+import datetime
+import demo_cli
+import health_functions
+import logging
+import logging.handlers
+import metrics_functions
+import os
+import plan_functions
+import provision_functions
+import queue
+import queue_functions
+import sqlite3
+import store_functions
+import struct
+import subprocess
 import support_functions
+import tempfile
+import threading
+import time
 import vm_functions
 import unittest
+import zlib
 
 version_good = "6.1.34r150636"
 vm_good = "ws2019"
@@ -141,6 +161,733 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(result[1], ips_good)
         self.assertEqual(result[2], "")
 
+    def test18_memdump_diff(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline_file, dump_file = f'{tmp}/baseline.dmp', f'{tmp}/task.dmp'
+            diff_file, patched_file = f'{tmp}/task.dmpdiff', f'{tmp}/patched.dmp'
+            baseline = bytearray(os.urandom(4096 * 64))
+            dump = bytearray(baseline) + os.urandom(100)
+            dump[4096 * 3 + 10] ^= 0xff
+            dump[4096 * 4 + 20] ^= 0xff
+            dump[4096 * 40] ^= 0xff
+            with open(baseline_file, 'wb') as f:
+                f.write(baseline)
+            with open(dump_file, 'wb') as f:
+                f.write(dump)
+            result = support_functions.memdump_diff(baseline_file, dump_file, diff_file)
+            self.assertEqual(result, (0, 4, 65))
+            self.assertLess(os.path.getsize(diff_file), 4096 * 5)
+            result = support_functions.memdump_patch(baseline_file, diff_file, patched_file)
+            self.assertEqual(result, 0)
+            with open(patched_file, 'rb') as f:
+                self.assertEqual(f.read(), dump)
+
+    def test19_pcap_summary(self):
+        def packet(protocol, sport, dport, payload):
+            if protocol == 17:
+                transport = struct.pack('>HHHH', sport, dport, 8 + len(payload), 0) + payload
+            else:
+                transport = struct.pack('>HHIIBBHHH', sport, dport, 0, 0, 0x50, 0x18, 0, 0, 0) + payload
+            ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(transport), 0, 0, 64, protocol, 0,
+                             bytes([10, 0, 2, 15]), bytes([8, 8, 8, 8])) + transport
+            frame = b'\x00' * 12 + b'\x08\x00' + ip
+            return struct.pack('<IIII', 0, 0, len(frame), len(frame)) + frame
+
+        dns_query = struct.pack('>HHHHHH', 1, 0x0100, 1, 0, 0, 0) + b'\x07example\x03com\x00\x00\x01\x00\x01'
+        http_request = b'GET / HTTP/1.1\r\nHost: www.example.org\r\n\r\n'
+        sni = b'\x00\x0e\x00\x00\x0bexample.net'
+        extensions = struct.pack('>HH', 0, len(sni)) + sni
+        hello = b'\x03\x03' + b'\x00' * 32 + b'\x00' + b'\x00\x02\x13\x01' + b'\x01\x00' + \
+            struct.pack('>H', len(extensions)) + extensions
+        handshake = b'\x01' + len(hello).to_bytes(3, 'big') + hello
+        client_hello = b'\x16\x03\x01' + struct.pack('>H', len(handshake)) + handshake
+
+        with tempfile.TemporaryDirectory() as tmp:
+            pcap_file = f'{tmp}/task.pcap'
+            with open(pcap_file, 'wb') as f:
+                f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+                f.write(packet(17, 50000, 53, dns_query))
+                f.write(packet(6, 50001, 80, http_request))
+                f.write(packet(6, 50001, 80, b''))
+                f.write(packet(6, 50002, 443, client_hello))
+            result = support_functions.pcap_summary(pcap_file, index_file=f'{pcap_file}.json')
+            self.assertEqual(result[0], 0)
+            self.assertEqual(result[1]['packets'], 4)
+            self.assertEqual(result[1]['flows_total'], 3)
+            self.assertEqual(result[1]['flows'][0]['packets'], 2)
+            self.assertEqual(result[1]['dns'], ['example.com'])
+            self.assertEqual(result[1]['http_hosts'], ['www.example.org'])
+            self.assertEqual(result[1]['tls_sni'], ['example.net'])
+            self.assertTrue(os.path.isfile(f'{pcap_file}.json'))
+
+            support_functions.save_results({'sha256': 'a', 'network_summary': result[1]}, reports_directory=tmp)
+            support_functions.save_results({'sha256': 'b', 'network_summary': None}, reports_directory=tmp)
+            result = support_functions.search_results('example.org', reports_directory=tmp)
+            self.assertEqual([record['sha256'] for record in result[1]], ['a'])
+            result = support_functions.search_results('org', reports_directory=tmp)
+            self.assertEqual(len(result[1]), 1)
+            result = support_functions.search_results('example.info', reports_directory=tmp)
+            self.assertEqual(result[1], [])
+
+    def test20_queue(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue_file, sample_file = f'{tmp}/queue.db', f'{tmp}/sample.exe'
+            with open(sample_file, 'wb') as f:
+                f.write(b'MZ' + os.urandom(1000))
+            queue_functions.queue_register_worker(queue_file, 'host1', {'vm1': {'group': '/', 'snapshots': ['a', 'b']}})
+            queue_functions.queue_register_worker(queue_file, 'host2', {'vm2': {'group': '/', 'snapshots': ['c']}})
+            result = queue_functions.queue_submit(queue_file, [sample_file, f'{tmp}/missing.exe'], ['all'], ['all'])
+            self.assertEqual(len(result[1]), 3)
+
+            # Queue created by previous version gets column of VM group
+            old_queue_file = f'{tmp}/old_queue.db'
+            with contextlib.closing(sqlite3.connect(old_queue_file)) as connection:
+                connection.execute('CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, sha256 TEXT, vm TEXT, '
+                                   'snapshot TEXT, status TEXT DEFAULT \'queued\', worker TEXT, result TEXT, '
+                                   'created REAL, started REAL, finished REAL)')
+            self.assertEqual(len(queue_functions.queue_submit(old_queue_file, [sample_file], ['vm1'], ['a'])[1]), 1)
+
+            job = queue_functions.queue_claim(queue_file, 'host2', {'vm2': '/'})
+            self.assertEqual((job['vm'], job['snapshot']), ('vm2', 'c'))
+            self.assertIsNone(queue_functions.queue_claim(queue_file, 'host2', {'vm2': '/'}))
+            result = queue_functions.queue_fetch_sample(queue_file, job['sha256'], directory=f'{tmp}/samples')
+            self.assertEqual(result[0], 0)
+            with open(result[1], 'rb') as f, open(sample_file, 'rb') as f_original:
+                self.assertEqual(f.read(), f_original.read())
+            queue_functions.queue_complete(queue_file, job['id'], 'done', {'status': 'done'})
+            result = queue_functions.queue_status(queue_file)
+            self.assertEqual(result[1], {'done': 1, 'queued': 2})
+            self.assertEqual(sorted(result[2]), ['host1', 'host2'])
+
+    def test21_queue_groups(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue_file, sample_file = f'{tmp}/queue.db', f'{tmp}/sample.exe'
+            with open(sample_file, 'wb') as f:
+                f.write(b'MZ')
+            queue_functions.queue_register_worker(queue_file, 'host1', {
+                'w10a': {'group': '/win10/office', 'snapshots': ['clean', 'av']},
+                'w10b': {'group': '/win10', 'snapshots': ['clean']},
+                'w7': {'group': '/win7', 'snapshots': ['clean']}})
+            result = queue_functions.queue_submit(queue_file, [sample_file], ['/win10'], ['all'])
+            self.assertEqual(len(result[1]), 1)
+            queue_functions.queue_submit(queue_file, [sample_file], ['/win10'], ['clean'])
+
+            free_vms = {'w10a': '/win10/office', 'w10b': '/win10', 'w7': '/win7'}
+            job = queue_functions.queue_claim(queue_file, 'host1', free_vms, {'w10a': 1, 'w10b': 2})
+            self.assertEqual((job['vm'], job['vm_group']), ('w10a', '/win10'))
+            job = queue_functions.queue_claim(queue_file, 'host1', {'w7': '/win7'})
+            self.assertIsNone(job)
+            job = queue_functions.queue_claim(queue_file, 'host1', {'w10b': '/win10', 'w7': '/win7'})
+            self.assertEqual(job['vm'], 'w10b')
+
+            # Group job is not taken by VM without its snapshot
+            queue_functions.queue_submit(queue_file, [sample_file], ['/win10'], ['av'])
+            vms_snapshots = {'w10a': ['clean', 'av'], 'w10b': ['clean']}
+            self.assertIsNone(queue_functions.queue_claim(queue_file, 'host1', {'w10b': '/win10'},
+                                                          vms_snapshots=vms_snapshots))
+            job = queue_functions.queue_claim(queue_file, 'host1', {'w10a': '/win10/office'},
+                                              vms_snapshots=vms_snapshots)
+            self.assertEqual((job['vm'], job['snapshot']), ('w10a', 'av'))
+
+    def test22_timings(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            history_file = f'{tmp}/timings.json'
+            support_functions.save_timings('vm1', 'clean', {'boot': 10, 'total': 100}, history_file=history_file)
+            support_functions.save_timings('vm1', 'clean', {'boot': 20, 'total': 200}, history_file=history_file)
+            support_functions.save_timings('vm2', 'clean', {'total': 50}, history_file=history_file)
+            history = support_functions.load_timings(history_file)
+            self.assertEqual(history['vm1/clean'], {'boot': 13, 'total': 130})
+            self.assertEqual(support_functions.expected_duration(history, ['vm1', 'vm2'], 'clean'), 90)
+            self.assertEqual(support_functions.expected_duration(history, ['vm3'], 'clean', default=5), 5)
+
+    def test23_journal(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal_file = f'{tmp}/journal.jsonl'
+            for task_id in ['a', 'b', 'c']:
+                queue_functions.journal_write(journal_file, task_id, 'queued',
+                                              job={'target': 'vm1', 'snapshot': task_id})
+            queue_functions.journal_write(journal_file, 'a', 'restoring', vm='vm1')
+            queue_functions.journal_write(journal_file, 'a', 'done', vm='vm1')
+            queue_functions.journal_write(journal_file, 'b', 'restoring', vm='vm2')
+            with open(journal_file, 'a') as f:
+                f.write('{"task": "c", "sta')
+            result = queue_functions.journal_unfinished(journal_file)
+            self.assertEqual(sorted(result), ['b', 'c'])
+            self.assertEqual(result['b']['vm'], 'vm2')
+            self.assertEqual(result['c']['job']['snapshot'], 'c')
+            self.assertNotIn('vm', result['c'])
+
+    def test24_cancel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue_file, sample_file = f'{tmp}/queue.db', f'{tmp}/sample.exe'
+            with open(sample_file, 'wb') as f:
+                f.write(b'MZ' + os.urandom(1000))
+            queue_functions.queue_register_worker(queue_file, 'host1', {'vm1': {'group': '/win10', 'snapshots': ['a']}})
+            queue_functions.queue_submit(queue_file, [sample_file], ['/win10'], ['a'])
+            job = queue_functions.queue_claim(queue_file, 'host1', {'vm1': '/win10'})
+            self.assertEqual(job['vm'], 'vm1')
+            # Interrupted group job can be taken by any VM of group again
+            queue_functions.queue_release(queue_file, job['id'])
+            self.assertEqual(queue_functions.queue_status(queue_file)[1], {'queued': 1})
+            job = queue_functions.queue_claim(queue_file, 'host2', {'vm2': '/win10'})
+            self.assertEqual(job['vm'], 'vm2')
+
+            journal_file = f'{tmp}/journal.jsonl'
+            for task_id, state in [('a', 'cancelled'), ('b', 'interrupted')]:
+                queue_functions.journal_write(journal_file, task_id, 'queued', job={'target': 'vm1', 'snapshot': 'a'})
+                queue_functions.journal_write(journal_file, task_id, state, vm='vm1')
+            self.assertEqual(list(queue_functions.journal_unfinished(journal_file)), ['b'])
+
+    def test25_metrics(self):
+        metrics_functions.metrics_inc('test_total', status='done')
+        metrics_functions.metrics_inc('test_total', 2, status='done')
+        metrics_functions.metrics_observe('test_seconds', 0.7, phase='boot')
+        metrics_functions.metrics_observe('test_seconds', 4000, phase='boot')
+        metrics_functions.metrics_gauge('test_gauge', lambda: 5)
+        text = metrics_functions.metrics_text()
+        self.assertIn('test_total{status="done"} 3\n', text)
+        self.assertIn('test_seconds_bucket{phase="boot",le="0.5"} 0\n', text)
+        self.assertIn('test_seconds_bucket{phase="boot",le="1"} 1\n', text)
+        self.assertIn('test_seconds_bucket{phase="boot",le="+Inf"} 2\n', text)
+        self.assertIn('test_seconds_count{phase="boot"} 2\n', text)
+        self.assertIn('test_gauge 5\n', text)
+        self.assertEqual(vm_functions.error_category('VBoxManage: error: Could not find a registered machine'),
+                         'not_found')
+        self.assertEqual(vm_functions.error_category('VERR_AUTHENTICATION_FAILURE'), 'guest_auth')
+        self.assertEqual(vm_functions.error_category(''), 'other')
+
+    def test26_task_log(self):
+        # Logging is disabled for other tests
+        logging.disable(logging.NOTSET)
+        logging.setLogRecordFactory(support_functions.task_log_record)
+        logger = logging.getLogger('test26')
+        logger.setLevel(logging.INFO)
+        handler = support_functions.TaskLogHandler()
+        handler.setFormatter(logging.Formatter('[%(task)s] %(message)s'))
+        logger.addHandler(handler)
+
+        def task(name, file):
+            support_functions.task_context.set(name)
+            handler.task_open(name, file)
+            for i in range(100):
+                logger.info('%s message %s', name, i)
+            handler.task_close(name)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            threads_list = [threading.Thread(target=task, args=(name, f'{tmp}/{name}.log')) for name in ['a', 'b']]
+            for t in threads_list:
+                t.start()
+            logger.info('Not a task message')
+            for t in threads_list:
+                t.join()
+            for name in ['a', 'b']:
+                with open(f'{tmp}/{name}.log') as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(len(lines), 100)
+                self.assertTrue(all(line.startswith(f'[{name}] {name} message') for line in lines))
+        logger.removeHandler(handler)
+
+        # Records written by background thread: file is closed after last record of task
+        handler.records_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(handler.records_queue, handler)
+        queue_handler = logging.handlers.QueueHandler(handler.records_queue)
+        logger.addHandler(queue_handler)
+        with tempfile.TemporaryDirectory() as tmp:
+            task('c', f'{tmp}/c.log')
+            listener.start()
+            listener.stop()
+            with open(f'{tmp}/c.log') as f:
+                self.assertEqual(len(f.read().splitlines()), 100)
+            self.assertEqual(handler.files, {})
+        logger.removeHandler(queue_handler)
+        logging.disable()
+
+    def test27_config(self):
+        config = demo_cli.parse_config(['file.exe', '--vms', '/win10', '--memdump_diff'])
+        self.assertEqual((config.filename, config.vms, config.snapshots), ('file.exe', ['/win10'], ['all']))
+        self.assertTrue(config.memdump)
+        config = demo_cli.parse_config(vms=['vm1'], timeout=5)
+        self.assertEqual((config.filename, config.vms, config.timeout, config.delay), (None, ['vm1'], 5, 7))
+        with self.assertRaises(ValueError):
+            demo_cli.parse_config(unknown_option=1)
+
+    def test28_client(self):
+        calls = []
+
+        def backend(cmd, timeout):
+            calls.append((threading.current_thread().name, cmd[0], cmd[1], timeout))
+            return 0, 'VMState="running"\n', ''
+
+        client_a = vm_functions.VBoxClient('vbox_a', timeout=5, timeouts={'memdump': 900}, backend=backend)
+        client_b = vm_functions.VBoxClient('vbox_b', timeout=0, backend=backend)
+        client_a.vm_memdump('vm1', '/tmp/vm1.dmp')
+        client_a.vboxmanage('controlvm vm1 poweroff', timeout=1)
+        self.assertEqual(client_b.vm_info('vm2')[1]['VMState'], 'running')
+
+        def task(client):
+            with vm_functions.use_client(client):
+                vm_functions.vm_snapshot_restore('vm3', 'clean')
+
+        threads_list = [threading.Thread(target=task, args=(client,), name=name)
+                        for name, client in [('a', client_a), ('b', client_b)]]
+        for t in threads_list:
+            t.start()
+        for t in threads_list:
+            t.join()
+        self.assertEqual(calls[:3], [('MainThread', 'vbox_a', 'debugvm', 900), ('MainThread', 'vbox_a', 'controlvm', 1),
+                                     ('MainThread', 'vbox_b', 'showvminfo', None)])
+        self.assertEqual(sorted(calls[3:]), [('a', 'vbox_a', 'snapshot', 5), ('b', 'vbox_b', 'snapshot', None)])
+        self.assertEqual(vm_functions.default_client.command_timeout('controlvm'), vm_functions.timeout)
+
+    def test29_operation(self):
+        self.assertEqual(vm_functions.VBoxClient(timeout=5).command_timeout('export'),
+                         vm_functions.command_timeouts['long'])
+        with tempfile.TemporaryDirectory() as directory:
+            # Fake vboxmanage reporting progress of operation
+            path = f'{directory}/vboxmanage'
+            with open(path, mode='w') as f:
+                f.write('#!/bin/sh\nfor p in 0 50 100; do printf "$p%%..." >&2; sleep 0.2; done\necho "$@"\n')
+            os.chmod(path, 0o755)
+            client = vm_functions.VBoxClient(path)
+            progress = []
+            operation = client.start('export vm1 --output vm1.ova')
+            while operation.poll() is None:
+                progress.append(operation.progress)
+                operation.wait(0.1)
+            self.assertEqual(operation.wait(), (0, 'export vm1 --output vm1.ova\n', '0%...50%...100%...'))
+            self.assertIn(50, progress)
+            self.assertEqual(operation.progress, 100)
+            result = client.vm_clone('vm1', 'vm2', background=1)
+            self.assertEqual(result[1].wait()[0], 0)
+            result = client.vboxmanage('import vm1.ova', timeout=0.3)
+            self.assertEqual((result[0], result[2]), (1, 'Command timed out after 0.3 seconds'))
+
+        # Exception of command is raised by wait(), waiting callers are not blocked
+        def backend(cmd, timeout):
+            raise OSError('disk full')
+
+        operation = vm_functions.VBoxClient('vbox', backend=backend).start('export vm1 --output vm1.ova')
+        with self.assertRaises(OSError):
+            operation.wait(5)
+        self.assertTrue(operation.done.is_set())
+
+    def test30_property_watcher(self):
+        output = ("/VirtualBox/GuestInfo/OS/LoggedInUsers = '0' @ 2022-11-07T10:00:00.000000000Z : TRANSIENT\n"
+                  "/VMAutomation/stage = 'started' @ 2022-11-07T10:00:01.000000000Z\n")
+        self.assertEqual(vm_functions.guest_properties(output)[1],
+                         {'name': '/VMAutomation/stage', 'value': 'started', 'flags': ''})
+        output = 'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 10.0.2.15, timestamp: 1, flags: TRANSIENT\n'
+        self.assertEqual(vm_functions.guest_properties(output)[0],
+                         {'name': '/VirtualBox/GuestInfo/Net/0/V4/IP', 'value': '10.0.2.15', 'flags': 'TRANSIENT'})
+
+        # Fake VM: user logs in, then script in guest sets marker, then VM is stopped
+        changes = ['/VirtualBox/GuestInfo/OS/LoggedInUsers, value: 1', '/VMAutomation/stage, value: done']
+
+        def backend(cmd, timeout):
+            if cmd[2] == 'enumerate':
+                return 0, 'Name: /VirtualBox/GuestInfo/OS/LoggedInUsers, value: 0, timestamp: 1, flags: \n', ''
+            if changes:
+                return 0, f'Name: {changes.pop(0)}, flags: \n', ''
+            return 1, '', 'VBoxManage: error: Machine "vm1" is not running'
+
+        with vm_functions.use_client(vm_functions.VBoxClient(backend=backend)):
+            watcher = vm_functions.PropertyWatcher('vm1', '/VirtualBox/GuestInfo/OS/*|/VMAutomation/*')
+        self.assertEqual(watcher.wait_for('/VirtualBox/GuestInfo/OS/LoggedInUsers', lambda users: users != '0',
+                                          timeout=5), ('/VirtualBox/GuestInfo/OS/LoggedInUsers', '1'))
+        self.assertIsNone(watcher.wait_for('/VMAutomation/missing', timeout=5))
+        self.assertTrue(watcher.stopped.is_set())
+        self.assertEqual(watcher.values['/VMAutomation/stage'], 'done')
+        # Values read before subscription are delivered too
+        received = []
+        watcher.subscribe(lambda name, value, flags: received.append((name, value)), '/VMAutomation/*')
+        self.assertEqual(received, [('/VMAutomation/stage', 'done')])
+
+    def test31_provision(self):
+        # Fake VirtualBox: registered VMs and their snapshots
+        vms = {'win10': []}
+
+        def backend(cmd, timeout):
+            calls.append(cmd[1:3])
+            if cmd[1:3] == ['list', 'vms']:
+                return 0, ''.join(f'Name:            {vm}\nGroups:          /\n\n' for vm in vms), ''
+            if cmd[1] == 'import':
+                vms[cmd[cmd.index('--vmname') + 1]] = []
+            elif cmd[1] == 'clonevm':
+                vms[[arg for arg in cmd if arg.startswith('--name=')][0][7:]] = []
+            elif cmd[1] == 'snapshot':
+                vms[cmd[2]].append(cmd[4])
+            elif cmd[1] == 'unregistervm':
+                vms.pop(cmd[2])
+            return 0, '', ''
+
+        with tempfile.TemporaryDirectory() as directory:
+            image, inventory_file = f'{directory}/base.ova', f'{directory}/inventory.json'
+            with open(image, 'wb') as f:
+                f.write(b'image v1')
+            with vm_functions.use_client(vm_functions.VBoxClient(backend=backend)):
+                calls = []
+                result = provision_functions.provision(image, 'base', 3, inventory_file=inventory_file)
+                self.assertEqual(result[0], 0)
+                self.assertEqual(sorted(result[1]), ['base_01', 'base_02', 'base_03'])
+                self.assertEqual(vms['base_02'], ['clean'])
+                self.assertEqual(calls.count(['clonevm', 'base']), 3)
+                # Unchanged image: nothing to do
+                calls = []
+                result = provision_functions.provision(image, 'base', 4, inventory_file=inventory_file)
+                self.assertEqual((result[0], len(result[1])), (0, 4))
+                self.assertEqual([call[0] for call in calls], ['list', 'clonevm', 'snapshot'])
+                # Changed image: everything is provisioned again, VM not created by provisioning is kept
+                with open(image, 'wb') as f:
+                    f.write(b'image v2')
+                calls = []
+                result = provision_functions.provision(image, 'base', 2, mode='full', inventory_file=inventory_file)
+                self.assertEqual(result[0], 0)
+                self.assertEqual(calls.count(['unregistervm', 'base_01']), 1)
+                self.assertEqual(calls.count(['import', image]), 1)
+                self.assertEqual(sorted(vms), ['base', 'base_01', 'base_02', 'win10'])
+                self.assertEqual(provision_functions.inventory_load(inventory_file)['vms']['base_01']['mode'], 'full')
+
+    def test32_backup_cleanup(self):
+        # Snapshots: clean -> backup (8 days old) -> backup (3 days old) -> backup (today, current), clean -> av
+        now = datetime.datetime.now()
+        names = [f'backup_{(now - datetime.timedelta(days=days)).strftime("%Y_%m_%d_%H_%M_%S")}' for days in [8, 3, 0]]
+        output = (f'SnapshotName="clean"\nSnapshotUUID="u0"\nSnapshotName-1="{names[0]}"\nSnapshotUUID-1="u1"\n'
+                  f'SnapshotName-1-1="{names[1]}"\nSnapshotUUID-1-1="u2"\nSnapshotName-1-1-1="{names[2]}"\n'
+                  f'SnapshotUUID-1-1-1="u3"\nSnapshotName-2="av"\nSnapshotUUID-2="u4"\n'
+                  f'CurrentSnapshotName="{names[2]}"\nCurrentSnapshotUUID="u3"\nCurrentSnapshotNode="SnapshotName-1-1-1"\n')
+        tree = vm_functions.snapshot_tree(output)
+        self.assertEqual([(snapshot['name'], snapshot['parent']) for snapshot in tree][:3],
+                         [('clean', None), (names[0], ''), (names[1], '-1')])
+        self.assertTrue(tree[3]['current'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Every snapshot has differencing disk of 1 KB
+            for uuid in ['u1', 'u2', 'u3']:
+                with open(f'{directory}/{uuid}.vdi', 'wb') as f:
+                    f.write(b'0' * 1024)
+            state = ['running']
+            removed = []
+
+            def backend(cmd, timeout):
+                if cmd[1] == 'showvminfo':
+                    return 0, f'VMState="{state[0]}"\nCfgFile="{directory}/vm1.vbox"\nSnapFldr="{directory}"\n', ''
+                if cmd[3] == 'list':
+                    return 0, output, ''
+                removed.append(cmd[4])
+                os.remove(f'{directory}/{cmd[4]}.vdi')
+                return 0, '', ''
+
+            client = vm_functions.VBoxClient(backend=backend)
+            self.assertEqual(client.vm_backup_cleanup('vm1', keep_last=1)[0], 1)
+            state[0] = 'poweroff'
+            result = client.vm_backup_cleanup('vm1', max_age=5, dry_run=1)
+            self.assertEqual((result[1]['removed'], result[1]['kept']), ([names[0]], [names[2], names[1]]))
+            result = client.vm_backup_cleanup('vm1', keep_last=1)
+            self.assertEqual((result[0], result[1]['removed'], result[1]['reclaimed']), (0, [names[0], names[1]], 2048))
+            self.assertEqual(removed, ['u1', 'u2'])
+
+    def test33_report_gallery(self):
+        # RGBA image 50x20, every row uses other PNG filter
+        width, height, bpp = 50, 20, 4
+        rows = [bytes((x * 7 + y * 13 + channel * 50) % 256 for x in range(width) for channel in range(bpp))
+                for y in range(height)]
+
+        def paeth(a, b, c):
+            p = a + b - c
+            return a if abs(p - a) <= abs(p - b) and abs(p - a) <= abs(p - c) else b if abs(p - b) <= abs(p - c) else c
+
+        data = b''
+        prev = bytes(width * bpp)
+        for y, row in enumerate(rows):
+            left = bytes(bpp) + row[:-bpp]
+            upper_left = bytes(bpp) + prev[:-bpp]
+            predictors = [[0] * len(row), left, prev, [(a + b) // 2 for a, b in zip(left, prev)],
+                          [paeth(a, b, c) for a, b, c in zip(left, prev, upper_left)]]
+            data += bytes([y % 5]) + bytes((x - p) % 256 for x, p in zip(row, predictors[y % 5]))
+            prev = row
+
+        def chunk(chunk_type, chunk_data):
+            return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + \
+                struct.pack('>I', zlib.crc32(chunk_type + chunk_data))
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(f'{directory}/{"0" * 64}')
+            for number in range(1, 4):
+                with open(f'{directory}/{"0" * 64}/vm1_clean_{number:04}.png', 'wb') as f:
+                    f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+                            chunk(b'IDAT', zlib.compress(data)) + chunk(b'IEND', b''))
+            open(f'{directory}/{"0" * 64}/vm1_clean.webm', 'wb').close()
+            result = support_functions.png_thumbnail(f'{directory}/{"0" * 64}/vm1_clean_0001.png',
+                                                     f'{directory}/thumbnail.png', width=20)
+            self.assertEqual(result, (0, 17, 7))
+            with open(f'{directory}/thumbnail.png', 'rb') as f:
+                thumbnail = zlib.decompress(f.read()[41:-16])
+            self.assertEqual(thumbnail[1 + 3 * 4:1 + 3 * 5], rows[0][12 * 4:12 * 4 + 3])
+            self.assertEqual(thumbnail[(17 * 3 + 1) * 6 + 1:(17 * 3 + 1) * 6 + 4], rows[18][:3])
+
+            support_functions.html_report('vm1', 'clean', 'file.exe', None, 1, '0' * 64, '0' * 32, 60, 'on',
+                                          reports_directory=directory, page_size=2)
+            with open(f'{directory}/{"0" * 64}/index.html', encoding='utf-8') as f:
+                report = f.read()
+            self.assertIn('<img src="thumbnails/vm1_clean_0001.png" loading="lazy"', report)
+            self.assertIn('poster="thumbnails/vm1_clean_0001.png" preload="none"', report)
+            self.assertIn('<details><summary>Screenshots 3-3</summary>', report)
+            self.assertTrue(os.path.isfile(f'{directory}/{"0" * 64}/thumbnails/vm1_clean_0003.png'))
+
+            # Names from guest traffic are escaped
+            summary = {'packets': 1, 'bytes': 60, 'flows_total': 1, 'dns': ['<b>.com'],
+                       'http_hosts': ['<script>alert(1)</script>'], 'tls_sni': [],
+                       'flows': [{'protocol': 'tcp', 'src': '10.0.2.15', 'sport': 1, 'dst': '<i>', 'dport': 80,
+                                  'packets': 1, 'bytes': 60}]}
+            support_functions.html_report('vm2', 'clean', 'file.exe', None, 1, '0' * 64, '0' * 32, 60, 'on',
+                                          reports_directory=directory, network_summary=summary)
+            with open(f'{directory}/{"0" * 64}/index.html', encoding='utf-8') as f:
+                report = f.read()
+            self.assertIn('&lt;script&gt;alert(1)&lt;/script&gt;', report)
+            self.assertNotIn('<script>', report)
+            self.assertNotIn('<b>.com', report)
+            self.assertIn('&lt;i&gt;:80', report)
+
+    def test34_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = f'{directory}/store'
+            for task in ['vm1_clean', 'vm2_clean']:
+                os.makedirs(f'{directory}/{task}')
+                for name, data in [(f'{task}_0001.png', b'same screenshot'), (f'{task}.pcap', task.encode())]:
+                    with open(f'{directory}/{task}/{name}', 'wb') as f:
+                        f.write(data)
+            files = [f'{directory}/vm1_clean/vm1_clean_0001.png', f'{directory}/vm1_clean/vm1_clean.pcap']
+            result = store_functions.store_add(store, files, 'sha/vm1_clean')
+            self.assertEqual(result[0], 0)
+            self.assertEqual(result[1]['vm1_clean_0001.png'], support_functions.file_hash(
+                f'{store}/{result[1]["vm1_clean_0001.png"][:2]}/{result[1]["vm1_clean_0001.png"]}')[0])
+            self.assertFalse(os.path.isfile(files[0]))
+            result = store_functions.store_add(store, [f'{directory}/vm2_clean/vm2_clean_0001.png',
+                                                       f'{directory}/vm2_clean/vm2_clean.pcap'], 'sha/vm2_clean')
+            screenshot = result[1]['vm2_clean_0001.png']
+            index = store_functions.store_index(store)
+            # Identical screenshots are stored once
+            self.assertEqual(len(index), 3)
+            self.assertEqual(sorted(index[screenshot]['refs']), ['sha/vm1_clean', 'sha/vm2_clean'])
+            self.assertFalse(os.path.isfile(f'{directory}/vm2_clean/vm2_clean_0001.png'))
+
+            # Report links to store
+            os.makedirs(f'{directory}/{"0" * 64}')
+            artifacts = {name: store_functions.blob_path(store, blob) for name, blob in result[1].items()}
+            support_functions.html_report('vm2', 'clean', 'file.exe', None, 1, '0' * 64, '0' * 32, 60, 'on',
+                                          reports_directory=directory, artifacts=artifacts)
+            with open(f'{directory}/{"0" * 64}/index.html', encoding='utf-8') as f:
+                report = f.read()
+            self.assertIn(f'../store/{screenshot[:2]}/{screenshot}', report)
+            self.assertIn('download="vm2_clean.pcap"', report)
+
+            # Screenshot is kept while referenced by other task
+            self.assertEqual(store_functions.store_release(store, 'sha/vm1_clean'), (0, 2))
+            self.assertEqual(store_functions.store_cleanup(store)[:2], (0, 1))
+            self.assertTrue(os.path.isfile(store_functions.blob_path(store, screenshot)))
+            self.assertEqual(store_functions.store_cleanup(store, max_age=0)[:2], (0, 2))
+            self.assertEqual(store_functions.store_index(store), {})
+            self.assertFalse(os.path.isfile(store_functions.blob_path(store, screenshot)))
+
+            # Changes are appended to log, previous references of task are replaced when it is added again
+            for data in [b'first run', b'second run']:
+                with open(f'{directory}/vm1_clean/vm1_clean.pcap', 'wb') as f:
+                    f.write(data)
+                result = store_functions.store_add(store, [f'{directory}/vm1_clean/vm1_clean.pcap'], 'sha/vm1_clean')
+            index = store_functions.store_index(store)
+            self.assertEqual([blob for blob in index if index[blob]['refs']], [result[1]['vm1_clean.pcap']])
+            self.assertTrue(os.path.isfile(f'{store}/index.log'))
+            self.assertEqual(store_functions.store_cleanup(store)[:2], (0, 1))
+            self.assertFalse(os.path.isfile(f'{store}/index.log'))
+            self.assertEqual(list(store_functions.store_index(store)), [result[1]['vm1_clean.pcap']])
+
+    def test35_plan(self):
+        history = {'vm1/clean': {'restore': 10, 'boot': 20, 'exec': 60, 'total': 90},
+                   'vm2/clean': {'restore': 10, 'boot': 40, 'exec': 60, 'total': 110},
+                   'vm1/av': {'restore': 10, 'boot': 20, 'exec': 20, 'total': 50}}
+        vms_groups = {'vm1': '/win10', 'vm2': '/win10', 'vm3': '/other'}
+        jobs = [{'target': '/win10', 'snapshot': snapshot, 'file': file} for file in ['a.exe', 'b.exe']
+                for snapshot in ['clean', 'av']] + [{'target': 'vm3', 'snapshot': 'clean', 'file': 'a.exe'}]
+        result = plan_functions.plan_schedule(jobs, vms_groups, 2, delay=5, history=history, default=300)
+        self.assertEqual(result[0], 0)
+        schedule = [(task['vm'], task['snapshot'], task['start'], task['end']) for task in result[1]]
+        # Longest first: vm3 has no history (default duration), clean (100 on average) before av (50)
+        self.assertEqual(schedule, [('vm3', 'clean', 0, 300), ('vm1', 'clean', 5, 95), ('vm2', 'clean', 95, 205),
+                                    ('vm1', 'av', 205, 255), ('vm2', 'av', 255, 305)])
+        summary = result[2]
+        self.assertEqual((summary['tasks'], summary['makespan'], summary['limit']), (5, 305, 'threads'))
+        self.assertEqual(summary['no_history'], 1)
+        self.assertEqual(summary['bottleneck'], 'exec')
+        self.assertAlmostEqual(summary['utilisation']['vm2'], 160 / 305)
+        self.assertEqual(plan_functions.format_duration(3725.4), '1:02:05')
+
+        # VM which failed health check with snapshot is not used for it
+        result = plan_functions.plan_schedule(jobs, vms_groups, 2, history=history, excluded={'vm2/clean'})
+        self.assertEqual(result[2]['tasks'], 5)
+        self.assertEqual({task['vm'] for task in result[1] if task['snapshot'] == 'clean'}, {'vm1', 'vm3'})
+
+    def test36_record_replay(self):
+        states = ['VMState="running"\n', 'VMState="poweroff"\n']
+
+        def backend(cmd, timeout):
+            time.sleep(0.1)
+            if cmd[1] == 'showvminfo':
+                return 0, states.pop(0), ''
+            if cmd[1] == 'debugvm':
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            if 'stat' in cmd:
+                return 0, 'c:\\a.exe is a file', ''
+            return 0, ' '.join(cmd[1:]), ''
+
+        with tempfile.TemporaryDirectory() as directory:
+            cassette = f'{directory}/cassette.jsonl'
+            client = vm_functions.VBoxClient('vbox', backend=vm_functions.RecordingBackend(cassette, backend=backend))
+            client.vm_info('vm1')
+            client.vm_info('vm1')
+            client.vboxmanage('guestcontrol vm1 --username user --password pass copyto --target-directory c:\\a.exe a')
+            self.assertEqual(client.vboxmanage('debugvm vm1 dumpvmcore --filename vm1.dmp', timeout=1)[0], 1)
+            client.vboxmanage('guestcontrol vm1 --username user --password S3cret stat c:\\a.exe')
+            # Password of guest OS is not saved
+            with open(cassette, encoding='utf-8') as f:
+                self.assertNotIn('S3cret', f.read())
+
+            # Results are returned in recorded order, last one is repeated, with recorded latency
+            client = vm_functions.VBoxClient('other', backend=vm_functions.ReplayBackend(cassette, speed=1))
+            started = time.time()
+            self.assertEqual([client.vm_info('vm1')[1]['VMState'] for _ in range(3)], ['running', 'poweroff',
+                                                                                       'poweroff'])
+            self.assertGreaterEqual(time.time() - started, 0.3)
+
+            # Commands with other arguments match by subcommand, VM and action. Timeouts are replayed too
+            client = vm_functions.VBoxClient('other', backend=vm_functions.ReplayBackend(cassette))
+            started = time.time()
+            result = client.vboxmanage('guestcontrol vm1 --username user --password pass copyto --target-directory '
+                                       'c:\\b.exe b')
+            self.assertEqual(result, (0, 'guestcontrol vm1 --username user --password pass copyto --target-directory '
+                                         'c:\\a.exe a', ''))
+            self.assertLess(time.time() - started, 0.1)
+            self.assertEqual(client.vboxmanage('debugvm vm1 dumpvmcore --filename other.dmp')[0], 1)
+            self.assertEqual(client.vboxmanage('controlvm vm2 poweroff'),
+                             (1, '', 'Command is not found in cassette'))
+            self.assertEqual(client.vboxmanage('guestcontrol vm1 --username user --password other stat c:\\a.exe'),
+                             (0, 'c:\\a.exe is a file', ''))
+
+    def test37_health(self):
+        def backend(cmd, timeout):
+            if cmd[1:3] == ['guestproperty', 'enumerate']:
+                return 0, 'Name: /VirtualBox/GuestInfo/OS/LoggedInUsers, value: 1, timestamp: 1, flags: \n' \
+                          'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 10.0.2.15, timestamp: 1, flags: \n', ''
+            if cmd[1:3] == ['guestproperty', 'wait']:
+                time.sleep(0.1)
+                return 2, '', 'Time out or interruption while waiting for a notification.'
+            if 'stat' in cmd and cmd[2] == 'vm2':
+                return 1, '', 'VBoxManage: error: VERR_AUTHENTICATION_FAILURE'
+            if 'stat' in cmd and cmd[2] == 'vm3':
+                return 1, '', 'VBoxManage: error: VERR_FILE_NOT_FOUND'
+            if 'screenshotpng' in cmd:
+                with open(cmd[-1], 'wb') as f:
+                    f.write(b'png')
+            return 0, 'VMState="poweroff"\n', ''
+
+        with tempfile.TemporaryDirectory() as directory, \
+                vm_functions.use_client(vm_functions.VBoxClient('vbox', backend=backend)):
+            records = health_functions.health_run({'vm1': ['clean', 'av'], 'vm2': ['clean'], 'vm3': ['clean']},
+                                                  threads=3, login='user', password='pass', boot_timeout=5,
+                                                  screenshot_file=f'{directory}/screenshot.png')
+            records = {f'{record["vm"]}/{record["snapshot"]}': record for record in records}
+            self.assertTrue(records['vm1/av']['healthy'])
+            self.assertEqual(list(records['vm1/clean']['checks']), health_functions.health_checks)
+            self.assertEqual(records['vm1/clean']['ips'], ['10.0.2.15'])
+            # Credentials are rejected: stat is not checked
+            self.assertEqual(list(records['vm2/clean']['checks']), ['restore', 'boot', 'auth'])
+            self.assertIn('VERR_AUTHENTICATION_FAILURE', records['vm2/clean']['checks']['auth']['error'])
+            self.assertEqual([records['vm3/clean']['checks'][check]['ok'] for check in ['auth', 'stat']], [True, False])
+
+            health_file = f'{directory}/health.json'
+            health_functions.health_save(records.values(), health_file)
+            health_functions.health_save([dict(records['vm1/av'], healthy=False)], health_file)
+            self.assertEqual(health_functions.health_unhealthy(health_functions.health_load(health_file)),
+                             {'vm1/av', 'vm2/clean', 'vm3/clean'})
+
+    def test38_network_profiles(self):
+        calls = []
+
+        def backend(cmd, timeout):
+            calls.append(' '.join(cmd[1:]))
+            return 0, '', ''
+
+        client = vm_functions.VBoxClient('vbox', backend=backend)
+        info = {'VMState': 'poweroff', 'nic1': 'nat', 'cableconnected1': 'on', 'intnet1': 'other'}
+        # Settings which already match are skipped, other settings are applied with one command
+        self.assertEqual(client.vm_config('vm1', {'network_profile': 'nat'}, info=info)[1], [])
+        self.assertEqual(client.vm_config('vm1', {'network_profile': 'offline'}, info=info)[1],
+                         ['--cableconnected1 off'])
+        self.assertEqual(client.vm_config('vm1', {'network_profile': 'internal', 'internal_network': 'lab'},
+                                          info=info)[1], ['--nic1 intnet', '--intnet1 lab'])
+        self.assertEqual(client.vm_config('vm1', {'network_profile': 'hostonly'}, info=dict(info, VMState='saved'))[1],
+                         [])
+        client.vm_network_profile('vm1', 'hostonly', hostonly_adapter='vboxnet1')
+        self.assertEqual(calls, ['modifyvm vm1 --cableconnected1 off', 'modifyvm vm1 --nic1 intnet --intnet1 lab',
+                                 'controlvm vm1 nic1 hostonly vboxnet1', 'controlvm vm1 setlinkstate1 on'])
+
+        # Every profile has own section in report
+        with tempfile.TemporaryDirectory() as directory:
+            os.makedirs(f'{directory}/{"0" * 64}')
+            for name in ['vm1_clean_nat_0001.png', 'vm1_clean_offline_0001.png', 'vm1_clean_offline.pcap']:
+                open(f'{directory}/{"0" * 64}/{name}', 'wb').close()
+            for profile in ['offline', 'nat']:
+                support_functions.html_report('vm1', 'clean', 'file.exe', None, 1, '0' * 64, '0' * 32, 60,
+                                              'offline, nat', reports_directory=directory, network_profile=profile)
+            with open(f'{directory}/{"0" * 64}/index.html', encoding='utf-8') as f:
+                report = f.read()
+            offline, nat = report.split('<b>Network:</b> offline')[1].split('<b>Network:</b> nat')
+            self.assertIn('vm1_clean_offline_0001.png', offline)
+            self.assertIn('vm1_clean_offline.pcap', offline)
+            self.assertNotIn('vm1_clean_offline', nat)
+            self.assertIn('vm1_clean_nat_0001.png', nat)
+
+    def test39_stream(self):
+        # Shared folder names are not taken for VM names, names with spaces are parsed
+        output = ['Name:            Windows 10', 'Groups:          /win10', 'Name: \'share\', Host path: \'/tmp\'',
+                  'Name:            vm2', 'Groups:          /']
+        self.assertEqual(dict(vm_functions.parse_vms(output)), {'Windows 10': '/win10', 'vm2': '/'})
+        self.assertEqual(list(vm_functions.parse_vms(['"Windows 10" {0b2c1e8a-1234-4d4e-8f00-0123456789ab}'])),
+                         [('Windows 10', None)])
+        output = ["/VMAutomation/stage = 'started' @ 2022-11-07T10:00:01.000000000Z",
+                  'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 10.0.2.15, timestamp: 1, flags: TRANSIENT']
+        self.assertEqual([item['value'] for item in vm_functions.parse_properties(output)], ['started', '10.0.2.15'])
+
+        def backend(cmd, timeout):
+            calls.append(cmd[1:])
+            return 0, ''.join(f'Name:            {vm}\nGroups:          /win10\n' for vm in ['Windows 10', 'vm1']), ''
+
+        # VM with space in name can not be used in commands: it is not listed, so no task is run on it
+        calls = []
+        client = vm_functions.VBoxClient('vbox', backend=backend)
+        result = client.list_vms(dictionary=1)
+        self.assertEqual(result, (0, {'vm1': '/win10'}, ''))
+        self.assertEqual(demo_cli.get_targets(['Windows 10', '/win10'], result[1]), (['/win10'], {'vm1': '/win10'}))
+        self.assertEqual(calls, [['list', 'vms', '--sorted', '--long']])
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Fake vboxmanage printing lines until it is killed
+            path = f'{directory}/vboxmanage'
+            with open(path, mode='w') as f:
+                f.write('#!/bin/sh\necho error >&2\ni=0\nwhile true; do echo "line $i"; i=$((i+1)); done\n')
+            os.chmod(path, 0o755)
+            client = vm_functions.VBoxClient(path)
+            stream = client.stream('list vms')
+            lines = iter(stream)
+            self.assertEqual([next(lines) for _ in range(3)], ['line 0', 'line 1', 'line 2'])
+            # Command is killed when iteration is stopped early
+            lines.close()
+            self.assertNotEqual(stream.returncode, 0)
+            self.assertEqual(stream.stderr, 'error\n')
+            stream = client.stream('list vms', timeout=0.3)
+            for _ in stream:
+                pass
+            self.assertEqual((stream.returncode, stream.stderr), (1, 'Command timed out after 0.3 seconds'))
+
 
 if __name__ == "__main__":
     unittest.main()
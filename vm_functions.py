@@ -1,36 +1,589 @@
+import contextlib
+import contextvars
 import datetime
+import fnmatch
+import json
 import logging
+import os
 import random
 import re
 import secrets
 import subprocess
+import threading
+import time
+
+import metrics_functions
 
 if __name__ == "__main__":
     print('This script only contains functions and cannot be called directly. See demo scripts for usage examples.')
     exit(1)
 
-# Set essential options
-if 'vboxmanage_path' not in locals():
-    vboxmanage_path = 'vboxmanage'
-if 'timeout' not in locals():
-    timeout = 60
+# Path to vboxmanage binary and timeout for commands (seconds) used by clients which do not set their own.
+# Use VBoxClient() to configure commands per thread/task instead of changing these.
+vboxmanage_path = 'vboxmanage'
+timeout = 60
+
+# Command classes used to select timeout (see VBoxClient), 'control' for all other commands
+command_classes = {'snapshot': 'snapshot',
+                   'guestcontrol': 'guest', 'guestproperty': 'guest',
+                   'debugvm': 'memdump',
+                   'import': 'long', 'export': 'long', 'clonevm': 'long'}
+
+# Default timeouts of command classes (seconds), which should not be limited by timeout of client.
+# Memory dump of large guest and import/export/clone of large VM take minutes
+command_timeouts = {'memdump': 1800, 'long': 3600}
+
+# Progress of long operations is written to stderr as "0%...10%...20%"
+progress_pattern = re.compile(r'(\d+)%')
+
+# Guest properties as printed by "guestproperty wait" and "guestproperty enumerate" ("Name: x, value: y, flags: z",
+# VirtualBox 6 adds timestamp) and by "guestproperty enumerate" of VirtualBox 7 ("x = 'y' @ timestamp : flags")
+property_patterns = [re.compile(r'^Name: (?P<name>[^,]+), value: (?P<value>.*?)(?:, timestamp: \d+)?, '
+                                r'flags: ?(?P<flags>.*)$', flags=re.MULTILINE),
+                     re.compile(r"^(?P<name>/\S+) += '(?P<value>.*)'(?: @ \S+)?(?: : (?P<flags>.*))?$",
+                                flags=re.MULTILINE)]
+
+# Lines of "list vms" ('"name" {uuid}'), "list vms --long" ('Name:  name', 'Groups:  /group'), "showvminfo
+# --machinereadable" ('setting="value"') and "snapshot list --machinereadable" ('SnapshotName-1="name"'). Patterns are
+# matched against every line once, see parse_vms(), parse_info()
+vm_line_pattern = re.compile(r'^"(.*)" \{[0-9a-fA-F-]+\}$')
+vm_long_pattern = re.compile(r'^(Name|Groups):\s+(.*?)\s*$')
+info_pattern = re.compile(r'^"?([^"=]+)"?="?(.*?)"?$')
+snapshot_name_pattern = re.compile(r'^SnapshotName(?:-\d+)*="(.*)"$')
+
+# Screen recording profiles: frames per second, bitrate (kbps)
+recording_profiles = {'low': {'fps': 2, 'videorate': 128},
+                      'normal': {'fps': 10, 'videorate': 512},
+                      'high': {'fps': 30, 'videorate': 1228}}
+
+# Categories of vboxmanage errors (for metrics), first matching pattern in stderr is used
+error_categories = [('timeout', re.compile(r'timed out', flags=re.IGNORECASE)),
+                    ('not_found', re.compile(r'VBOX_E_OBJECT_NOT_FOUND|Could not find a registered machine')),
+                    ('invalid_state', re.compile(r'VBOX_E_INVALID_VM_STATE|VBOX_E_INVALID_OBJECT_STATE|'
+                                                 r'is not currently running|is already locked')),
+                    ('guest_auth', re.compile(r'VERR_AUTHENTICATION_FAILURE|authentication', flags=re.IGNORECASE)),
+                    ('guest_file', re.compile(r'VERR_FILE_NOT_FOUND|VERR_PATH_NOT_FOUND|VERR_ACCESS_DENIED')),
+                    ('guest_not_ready', re.compile(r'Guest Additions|VERR_TIMEOUT|VERR_NOT_FOUND'))]
+
+# Subcommands with action ('controlvm vm poweroff' is counted as 'controlvm poweroff' in metrics): position of action
+action_subcommands = {'controlvm': 2, 'debugvm': 2, 'guestcontrol': 6, 'guestproperty': 1, 'snapshot': 2}
+
+# Snapshots in output of "snapshot list --machinereadable": SnapshotName-1-2="name" is second child of first child of
+# root snapshot (SnapshotName="name")
+snapshot_pattern = re.compile(r'^Snapshot(Name|UUID)((?:-\d+)*)="(.*)"$', flags=re.MULTILINE)
+
+# Name of snapshots taken by vm_backup()
+backup_pattern = re.compile(r'^backup_(\d{4}_\d{2}_\d{2}_\d{2}_\d{2}_\d{2})$')
+
+# Network profiles of first network adapter: attachment type ('showvminfo' setting nic1) and link state.
+# Host-only adapter and internal network name are set by options of network_profile_settings()
+network_profiles = {'offline': {'nic': None, 'cable': 'off'},
+                    'nat': {'nic': 'nat', 'cable': 'on'},
+                    'hostonly': {'nic': 'hostonly', 'cable': 'on'},
+                    'internal': {'nic': 'intnet', 'cable': 'on'}}
+
+# Extra data set by this process, {'vm': {'key': 'value'}}. Extra data is not reverted by snapshot restore.
+extradata_cache = {}
+
+
+def subprocess_backend(cmd, timeout=None, progress=None):
+    """Run command as child process (default backend of VBoxClient)
+
+    :param cmd: Command as list of arguments.
+    :param timeout: Timeout for operation, seconds (None for no timeout).
+    :param progress: Function called with percentage of operation done, as reported by command.
+    :return: returncode, stdout, stderr. Raises subprocess.TimeoutExpired and FileNotFoundError.
+    """
+    if not progress:
+        result = subprocess.run(cmd, capture_output=True, timeout=timeout, text=True)
+        return result.returncode, result.stdout, result.stderr
+
+    # Read stderr while command runs, stdout is read by separate thread so pipe does not fill up
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+        stdout = []
+        reader = threading.Thread(target=lambda: stdout.append(process.stdout.read()), daemon=True)
+        reader.start()
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            process.kill()
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        stderr = b''
+        try:
+            while True:
+                chunk = process.stderr.read1(4096)
+                if not chunk:
+                    break
+                stderr += chunk
+                # Percentage may be split between chunks
+                percents = progress_pattern.findall(stderr[-len(chunk) - 4:].decode(errors='replace'))
+                if percents:
+                    progress(int(percents[-1]))
+            process.wait()
+            reader.join()
+        finally:
+            if timer:
+                timer.cancel()
+        if killed.is_set():
+            raise subprocess.TimeoutExpired(cmd, timeout)
+    return process.returncode, (stdout or [b''])[0].decode(errors='replace'), stderr.decode(errors='replace')
+
+
+def cassette_key(cmd, exact=1):
+    """Return key of command in cassette: command without path to binary. Password of guest OS is replaced with
+    placeholder, so it is not saved to cassette. Inexact key has only subcommand, VM and action
+    ('guestcontrol vm copyto'), so commands with random file names, MAC addresses, etc. match too
+
+    :param cmd: Command as list of arguments (with path to binary).
+    :param exact: Return key of full command.
+    :return: key.
+    """
+    if exact:
+        return ' '.join('********' if previous == '--password' else argument
+                        for previous, argument in zip(cmd, cmd[1:]))
+    subcommand = cmd[1] if len(cmd) > 1 else ''
+    position = action_subcommands.get(subcommand)
+    if not position:
+        return ' '.join(cmd[1:3])
+    return ' '.join(cmd[1:3] + cmd[position + 1:position + 2])
+
+
+class RecordingBackend:
+    """Backend of VBoxClient which runs commands with other backend and records them to cassette file: one JSON
+    document per line with command (without path to binary), returncode, stdout, stderr and latency (seconds).
+    Cassette is replayed by ReplayBackend.
+
+    :param cassette: Path to cassette file. Commands are appended to file.
+    :param backend: Backend used to run commands.
+    """
+
+    def __init__(self, cassette, backend=subprocess_backend):
+        self.cassette = cassette
+        self.backend = backend
+        self.reports_progress = backend is subprocess_backend
+        self.lock = threading.Lock()
+
+    def __call__(self, cmd, timeout=None, progress=None):
+        started = time.time()
+        try:
+            if progress:
+                result = self.backend(cmd, timeout, progress)
+            else:
+                result = self.backend(cmd, timeout)
+        except subprocess.TimeoutExpired:
+            self.save({'cmd': cassette_key(cmd), 'timeout': True, 'latency': round(time.time() - started, 3)})
+            raise
+        self.save({'cmd': cassette_key(cmd), 'returncode': result[0], 'stdout': result[1], 'stderr': result[2],
+                   'latency': round(time.time() - started, 3)})
+        return result
+
+    def save(self, entry):
+        with self.lock:
+            with open(self.cassette, mode='a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+class ReplayBackend:
+    """Backend of VBoxClient which returns results of commands recorded by RecordingBackend instead of running them.
+    Results of the same command are returned in recorded order, last one is repeated (e.g. VM state polled in loop).
+    Commands which were not recorded as is (random file names, etc.) get results of command with the same subcommand,
+    VM and action. Unknown commands fail with error.
+
+    :param cassette: Path to cassette file.
+    :param speed: Replay speed: 0 - return results immediately, 1 - with recorded latency, 10 - 10 times faster, etc.
+    """
 
+    def __init__(self, cassette, speed=0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.entries = {}
+        with open(cassette, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                cmd = [''] + entry['cmd'].split()
+                for key in [cassette_key(cmd), (cassette_key(cmd, exact=0),)]:
+                    self.entries.setdefault(key, []).append(entry)
+
+    def __call__(self, cmd, timeout=None, progress=None):
+        with self.lock:
+            for key in [cassette_key(cmd), (cassette_key(cmd, exact=0),)]:
+                entries = self.entries.get(key)
+                if entries:
+                    # Skip results already returned for other key
+                    while len(entries) > 1 and entries[0].get('replayed'):
+                        entries.pop(0)
+                    entry = entries.pop(0) if len(entries) > 1 else entries[0]
+                    entry['replayed'] = True
+                    break
+            else:
+                logging.error(f'''Command is not found in cassette: {' '.join(cmd)}''')
+                return 1, '', 'Command is not found in cassette'
+        latency = entry['latency'] / self.speed if self.speed else 0
+        if entry.get('timeout') or (timeout and latency > timeout):
+            time.sleep(min(latency, timeout or latency))
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        time.sleep(latency)
+        return entry['returncode'], entry['stdout'], entry['stderr']
+
+
+class VBoxClient:
+    """Client for "VBoxManage": path to binary, timeouts and backend used to run commands.
+    Functions of this module use client set for current thread/task with use_client() or default_client.
+    Every function of this module can be called as client method too: client.vm_start('vm').
+
+    :param path: Path to vboxmanage binary (module option 'vboxmanage_path' if not set).
+    :param timeout: Default timeout for commands, seconds (module option 'timeout' if not set, 0 - no timeout).
+    :param timeouts: Timeouts for command classes as {'class': seconds}, see command_classes and command_timeouts.
+    :param backend: Function to run command: backend(cmd, timeout) returns returncode, stdout, stderr.
+                    Progress of background operations is reported only by subprocess_backend.
+                    Use RecordingBackend/ReplayBackend to record commands and run them again without VirtualBox.
+    """
 
-def vboxmanage(cmd, timeout=timeout):
-    """Wrapper for "VBoxManage" command
+    def __init__(self, path=None, timeout=None, timeouts=None, backend=subprocess_backend):
+        self.path = path
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.backend = backend
+
+    def command_timeout(self, subcommand, timeout=None):
+        """Return timeout for command
+
+        :param subcommand: vboxmanage subcommand ('controlvm', 'import', etc.).
+        :param timeout: Timeout set by caller. Overrides timeouts of client.
+        :return: timeout, seconds (None for no timeout).
+        """
+        command_class = command_classes.get(subcommand, 'control')
+        if timeout is None:
+            timeout = self.timeouts.get(command_class, command_timeouts.get(command_class))
+        if timeout is None:
+            timeout = self.timeout if self.timeout is not None else globals()['timeout']
+        return timeout or None
+
+    def run(self, cmd, timeout=None, progress=None):
+        """Run "VBoxManage" command
+
+        :param cmd: Command to run.
+        :param timeout: Timeout for operation, seconds. Timeout of command class is used if not set.
+        :param progress: Function called with percentage of operation done (passed to backend).
+        :return: returncode, stdout, stderr.
+        """
+        path = self.path or vboxmanage_path
+        logging.debug('Running command: %s %s', path, cmd)
+        cmd = f'{path} {cmd}'.split()
+        timeout = self.command_timeout(cmd[1] if len(cmd) > 1 else '', timeout)
+        started = time.time()
+        try:
+            if progress:
+                result = self.backend(cmd, timeout, progress)
+            else:
+                result = self.backend(cmd, timeout)
+        except subprocess.TimeoutExpired:
+            # Child process is killed by subprocess.run()
+            logging.error(f'''Command timed out after {timeout} seconds: {' '.join(cmd)}''')
+            result = 1, '', f'Command timed out after {timeout} seconds'
+        except FileNotFoundError:
+            logging.critical('vboxmanage path is incorrect. Stopping.')
+            exit(1)
+        self.observe(cmd, started, result[0], result[2])
+        return result[0], result[1], result[2]
 
+    def observe(self, cmd, started, returncode, stderr):
+        """Update metrics of finished command
+
+        :param cmd: Command as list of arguments.
+        :param started: Time command was started.
+        :param returncode: Return code of command.
+        :param stderr: Error output of command.
+        """
+        subcommand = cmd[1] if len(cmd) > 1 else ''
+        position = action_subcommands.get(subcommand)
+        if position and len(cmd) > position + 1:
+            subcommand = f'{subcommand} {cmd[position + 1]}'
+        metrics_functions.metrics_inc('vm_automation_vboxmanage_calls_total', subcommand=subcommand)
+        metrics_functions.metrics_observe('vm_automation_vboxmanage_seconds', time.time() - started,
+                                          subcommand=subcommand)
+        if returncode != 0:
+            metrics_functions.metrics_inc('vm_automation_vboxmanage_errors_total', subcommand=subcommand,
+                                          category=error_category(stderr))
+
+    def start(self, cmd, timeout=None, finished=None):
+        """Start "VBoxManage" command in background
+
+        :param cmd: Command to run.
+        :param timeout: Timeout for operation, seconds. Timeout of command class is used if not set.
+        :param finished: Function called with result (returncode, stdout, stderr) when command is finished.
+        :return: VBoxOperation object.
+        """
+        return VBoxOperation(self, cmd, timeout, finished)
+
+    def stream(self, cmd, timeout=None):
+        """Run "VBoxManage" command and read its output line by line while it runs
+
+        :param cmd: Command to run.
+        :param timeout: Timeout for operation, seconds. Timeout of command class is used if not set.
+        :return: VBoxStream object.
+        """
+        return VBoxStream(self, cmd, timeout)
+
+    def __getattr__(self, name):
+        # Call function of this module with this client
+        function = globals().get(name)
+        if name.startswith('_') or not callable(function) or isinstance(function, type):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            with use_client(self):
+                return function(*args, **kwargs)
+        return call
+
+
+class VBoxOperation:
+    """"VBoxManage" command running in background (import, export, clone, memory dump).
+    Started with vboxmanage_start() or with "background" option of functions like vm_export().
+
+    :param client: VBoxClient object used to run command.
     :param cmd: Command to run.
-    :param timeout: Timeout for operation, seconds.
-    :return: returncode, stdout, stderr.
+    :param timeout: Timeout for operation, seconds. Timeout of command class is used if not set.
+    :param finished: Function called with result (returncode, stdout, stderr) when command is finished.
+                     Value returned by it is used as result.
+    """
+
+    def __init__(self, client, cmd, timeout=None, finished=None):
+        self.cmd = cmd
+        self.progress = 0
+        self.result = None
+        self.error = None
+        self.started = time.time()
+        self.finished = finished
+        self.done = threading.Event()
+        # Only default backend reports progress
+        self.report_progress = client.backend is subprocess_backend or getattr(client.backend, 'reports_progress', 0)
+        # Log records of operation belong to the same task as caller
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self.run, client, timeout), daemon=True).start()
+
+    def run(self, client, timeout):
+        # Callers waiting for operation are released also when command raises exception (it is raised by wait())
+        try:
+            result = client.run(self.cmd, timeout, self.set_progress if self.report_progress else None)
+            if self.finished:
+                result = self.finished(result)
+            self.result = result[0], result[1], result[2]
+            self.progress = 100
+        except BaseException as error:
+            self.error = error
+            logging.error(f'Command "{self.cmd}" failed: {error!r}')
+        finally:
+            self.done.set()
+
+    def set_progress(self, percent):
+        self.progress = percent
+        logging.debug('Progress of command "%s": %s%%', self.cmd, percent)
+
+    def poll(self):
+        """Check if operation is finished
+
+        :return: returncode, stdout, stderr if operation is finished, None otherwise.
+        """
+        return self.result
+
+    def wait(self, timeout=None):
+        """Wait for operation to finish
+
+        :param timeout: Time to wait, seconds (None to wait until finished).
+        :return: returncode, stdout, stderr if operation is finished, None otherwise. Exception raised by command is
+        raised again.
+        """
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class VBoxStream:
+    """Output of "VBoxManage" command, read line by line from pipe while command runs, so large outputs (list of
+    hundreds of VMs, all guest properties) are not kept in memory and first lines can be used before command finishes.
+    Command is started when iteration starts, returncode and stderr are set when iteration is finished. Command is
+    killed if iteration is stopped early. Backends other than subprocess_backend return whole output at once.
+    Started with vboxmanage_stream(), see parse_vms(), parse_properties() and parse_info().
+
+    :param client: VBoxClient object used to run command.
+    :param cmd: Command to run.
+    :param timeout: Timeout for operation, seconds. Timeout of command class is used if not set.
     """
-    cmd = f'{vboxmanage_path} {cmd}'.split()
-    logging.debug(f'''Running command: {' '.join(cmd)}''')
+
+    def __init__(self, client, cmd, timeout=None):
+        self.client = client
+        self.cmd = cmd
+        self.timeout = timeout
+        self.returncode = None
+        self.stderr = ''
+
+    def __iter__(self):
+        if self.client.backend is not subprocess_backend:
+            result = self.client.run(self.cmd, self.timeout)
+            self.returncode, self.stderr = result[0], result[2]
+            yield from result[1].splitlines()
+            return
+
+        path = self.client.path or vboxmanage_path
+        logging.debug('Running command: %s %s', path, self.cmd)
+        cmd = f'{path} {self.cmd}'.split()
+        timeout = self.client.command_timeout(cmd[1] if len(cmd) > 1 else '', self.timeout)
+        started = time.time()
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            logging.critical('vboxmanage path is incorrect. Stopping.')
+            exit(1)
+        stderr = []
+        reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        reader.start()
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            process.kill()
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            for line in process.stdout:
+                yield line.decode(errors='replace').rstrip('\r\n')
+        finally:
+            if timer:
+                timer.cancel()
+            # Iteration was stopped early
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            reader.join()
+            process.stdout.close()
+            process.stderr.close()
+            self.returncode = process.returncode
+            self.stderr = (stderr or [b''])[0].decode(errors='replace')
+            if killed.is_set():
+                logging.error(f'''Command timed out after {timeout} seconds: {' '.join(cmd)}''')
+                self.returncode, self.stderr = 1, f'Command timed out after {timeout} seconds'
+            self.client.observe(cmd, started, self.returncode, self.stderr)
+
+
+# Client used when no client is set for current thread/task
+default_client = VBoxClient()
+
+# Client of current thread/task, see use_client()
+client_context = contextvars.ContextVar('client', default=None)
+
+
+@contextlib.contextmanager
+def use_client(client):
+    """Use client for all commands run by current thread/task within "with" block
+
+    :param client: VBoxClient object.
+    :return: client.
+    """
+    context = client_context.set(client)
     try:
-        result = subprocess.run(cmd, capture_output=True, timeout=timeout, text=True)
-        return result.returncode, result.stdout, result.stderr
-    except FileNotFoundError:
-        logging.critical('vboxmanage path is incorrect. Stopping.')
-        exit(1)
+        yield client
+    finally:
+        client_context.reset(context)
+
+
+def vboxmanage(cmd, timeout=None):
+    """Wrapper for "VBoxManage" command. Command is run by client of current thread/task (see use_client())
+
+    :param cmd: Command to run.
+    :param timeout: Timeout for operation, seconds. Timeout of client for command class is used if not set.
+    :return: returncode, stdout, stderr.
+    """
+    return (client_context.get() or default_client).run(cmd, timeout)
+
+
+def vboxmanage_start(cmd, timeout=None, finished=None):
+    """Start "VBoxManage" command in background. Command is run by client of current thread/task
+
+    :param cmd: Command to run.
+    :param timeout: Timeout for operation, seconds. Timeout of client for command class is used if not set.
+    :param finished: Function called with result (returncode, stdout, stderr) when command is finished.
+    :return: VBoxOperation object (see VBoxOperation.progress, poll() and wait()).
+    """
+    return (client_context.get() or default_client).start(cmd, timeout, finished)
+
+
+def vboxmanage_stream(cmd, timeout=None):
+    """Run "VBoxManage" command and read its output line by line. Command is run by client of current thread/task
+
+    :param cmd: Command to run.
+    :param timeout: Timeout for operation, seconds. Timeout of client for command class is used if not set.
+    :return: VBoxStream object: iterate it for lines of output, then check returncode and stderr.
+    """
+    return (client_context.get() or default_client).stream(cmd, timeout)
+
+
+def parse_vms(lines):
+    """Parse output of "list vms" or "list vms --long" in one pass
+
+    :param lines: Lines of output (e.g. VBoxStream).
+    :return: generator of (vm, groups) tuples, groups is None for output of "list vms".
+    """
+    name = None
+    for line in lines:
+        match = vm_line_pattern.match(line)
+        if match:
+            yield match[1], None
+            continue
+        match = vm_long_pattern.match(line)
+        if not match:
+            continue
+        # Groups follow name of VM. Other 'Name:' lines (shared folders, etc.) are not followed by groups
+        if match[1] == 'Name':
+            name = match[2]
+        elif name is not None:
+            yield name, match[2]
+            name = None
+
+
+def parse_properties(lines):
+    """Parse output of "guestproperty enumerate" or "guestproperty wait" in one pass
+
+    :param lines: Lines of output (e.g. VBoxStream).
+    :return: generator of properties as {'name': name, 'value': value, 'flags': flags}.
+    """
+    for line in lines:
+        for pattern in property_patterns:
+            match = pattern.match(line)
+            if match:
+                yield {'name': match['name'], 'value': match['value'], 'flags': match['flags'] or ''}
+                break
+
+
+def parse_info(lines):
+    """Parse machine readable output ("showvminfo --machinereadable", etc.) in one pass
+
+    :param lines: Lines of output (e.g. VBoxStream).
+    :return: generator of (setting, value) tuples.
+    """
+    for line in lines:
+        match = info_pattern.match(line)
+        if match:
+            yield match[1], match[2]
+
+
+def error_category(stderr):
+    """Return category of vboxmanage error
+
+    :param stderr: Error message.
+    :return: 'timeout', 'not_found', 'invalid_state', 'guest_auth', 'guest_file', 'guest_not_ready' or 'other'.
+    """
+    for category, pattern in error_categories:
+        if pattern.search(stderr):
+            return category
+    return 'other'
 
 
 def virtualbox_version(strip_newline=1, strip_build=0):
@@ -54,29 +607,52 @@ def list_vms(list=1, dictionary=0):
 
     :param list: Return stdout as a list.
     :param dictionary: Return stdout as a {'vm': 'group'} dictionary. Overrides 'list' option.
-    :return: returncode, stdout, stderr.
+    :return: returncode, stdout, stderr. VMs with whitespace in name are skipped (commands are split by whitespace).
     """
-    if dictionary:
-        options = '--long'
+    if dictionary or list:
+        # Output is parsed while it is read (output of "--long" is large with hundreds of VMs)
+        stream = vboxmanage_stream(f'list vms --sorted {"--long" if dictionary else ""}')
+        vms = usable_vms(parse_vms(stream))
+        # Convert output to {'vm': 'group'} dictionary or list
+        vms_list_ = dict(vms) if dictionary else [vm for vm, groups in vms]
+        result = stream.returncode, vms_list_, stream.stderr
     else:
-        options = ''
-    result = vboxmanage(f'list vms --sorted {options}')
+        result = vboxmanage('list vms --sorted')
     if result[0] == 0:
-        if dictionary:
-            # Convert output to {'vm': 'group'} dictionary.
-            vms = re.findall(r'^Name:\s+(\S+)', result[1], flags=re.MULTILINE)
-            groups = re.findall(r'^Groups:\s+(\S+)', result[1], flags=re.MULTILINE)
-            vms_list_ = dict(zip(vms, groups))
-        elif list:
-            vms_list_ = re.findall(r'^"(\w+)"', result[1], flags=re.MULTILINE)
-        else:
-            vms_list_ = result[1]
-        return result[0], vms_list_, result[2]
+        return result[0], result[1], result[2]
     else:
         logging.error(f'Unable to get list of VMs: {result[2]}')
         return result[0], result[1], result[2]
 
 
+def usable_vms(vms):
+    """Skip VMs which can not be used in commands: name contains whitespace
+
+    :param vms: (vm, groups) tuples, see parse_vms().
+    :return: generator of (vm, groups) tuples.
+    """
+    for vm, groups in vms:
+        if vm.split() != [vm]:
+            logging.warning(f'Name of VM "{vm}" contains whitespace, which is not supported. Skipping.')
+            continue
+        yield vm, groups
+
+
+def vm_groups(groups):
+    """Return list of groups virtual machine belongs to, including parent groups
+
+    :param groups: Groups of virtual machine, as returned by list_vms(dictionary=1) ('/group1/subgroup,/group2').
+    :return: list of groups.
+    """
+    groups_list = []
+    for group in groups.split(','):
+        group = group.rstrip('/') or '/'
+        while group not in groups_list:
+            groups_list.append(group)
+            group = group.rsplit('/', 1)[0] or '/'
+    return groups_list
+
+
 def list_snapshots(vm, list=1):
     """Return list of snapshots for specific virtual machine
 
@@ -84,13 +660,14 @@ def list_snapshots(vm, list=1):
     :param list: Return stdout as a list.
     :return: returncode, stdout, stderr.
     """
-    result = vboxmanage(f'snapshot {vm} list --machinereadable')
+    if list == 1:
+        stream = vboxmanage_stream(f'snapshot {vm} list --machinereadable')
+        snapshots_list = [match[1] for match in map(snapshot_name_pattern.match, stream) if match]
+        result = stream.returncode, snapshots_list, stream.stderr
+    else:
+        result = vboxmanage(f'snapshot {vm} list --machinereadable')
     if result[0] == 0:
-        if list == 1:
-            snapshots_list = re.findall(r'^SnapshotName(?:-\d+)?="(\S+)"', result[1], flags=re.MULTILINE)
-        else:
-            snapshots_list = result[1]
-        return result[0], snapshots_list, result[2]
+        return result[0], result[1], result[2]
     else:
         logging.error(f'Unable to get list of snapshots: {result[2]}')
         return result[0], result[1], result[2]
@@ -134,7 +711,7 @@ def vm_stop(vm, ignore_status_error=0):
     else:
         if 'is not currently running' in result[2] or 'Invalid machine state: PoweredOff' in result[2] and \
                 ignore_status_error:
-            logging.debug(f'VM already stopped: {result[2]}')
+            logging.debug('VM already stopped: %s', result[2])
         else:
             logging.error(f'Error while stopping VM: {result[2]}')
     return result[0], result[1], result[2]
@@ -147,7 +724,7 @@ def vm_enumerate(vm, pattern=None):
     :param pattern: Pattern for virtual machine properties.
     :return: returncode, stdout, stderr.
     """
-    logging.debug(f'Enumerating VM "{vm}" guest properties.')
+    logging.debug('Enumerating VM "%s" guest properties.', vm)
     if pattern:
         result = vboxmanage(f'guestproperty enumerate {vm} --pattern {pattern}')
     else:
@@ -165,15 +742,181 @@ def list_ips(vm):
     :param vm: Virtual machine name.
     :return: returncode, stdout, stderr.
     """
-    result = vm_enumerate(vm, pattern='/VirtualBox/GuestInfo/Net/*/V4/IP')
+    patterns = '/VirtualBox/GuestInfo/Net/*/V4/IP'
+    stream = vboxmanage_stream(f'guestproperty enumerate {vm} --pattern {patterns}')
+    ips_list = [prop['value'] for prop in parse_properties(stream)
+                if property_match(prop['name'], patterns) and prop['value']]
+    result = stream.returncode, ips_list, stream.stderr
     if result[0] == 0:
-        ips_list = re.findall(r'value:\s(\d+\.\d+\.\d+\.\d+)', result[1], flags=re.MULTILINE)
-        return result[0], ips_list, result[2]
+        return result[0], result[1], result[2]
     else:
         logging.error(f'Unable to get list of IP addresses: {result[2]}')
         return result[0], result[1], result[2]
 
 
+def guest_properties(output):
+    """Parse output of "guestproperty enumerate" or "guestproperty wait"
+
+    :param output: Output of command.
+    :return: list of properties as {'name': name, 'value': value, 'flags': flags}.
+    """
+    return list(parse_properties(output.splitlines()))
+
+
+def property_match(name, patterns):
+    """Check if property name matches one of patterns
+
+    :param name: Property name.
+    :param patterns: Patterns separated by '|' ('/VirtualBox/GuestInfo/Net/*|/VMAutomation/*').
+    :return: True if name matches.
+    """
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns.split('|'))
+
+
+def vm_properties(vm, patterns='*'):
+    """Get guest properties of virtual machine
+
+    :param vm: Virtual machine name.
+    :param patterns: Patterns of property names, separated by '|'.
+    :return: returncode, stdout, stderr. stdout is dictionary {'name': 'value'}.
+    """
+    logging.debug('Enumerating VM "%s" guest properties.', vm)
+    stream = vboxmanage_stream(f'guestproperty enumerate {vm}')
+    properties = {prop['name']: prop['value'] for prop in parse_properties(stream)
+                  if property_match(prop['name'], patterns)}
+    if stream.returncode != 0:
+        logging.error(f'Error while enumerating guest properties: {stream.stderr}')
+        return stream.returncode, '', stream.stderr
+    return stream.returncode, properties, stream.stderr
+
+
+def vm_property_wait(vm, patterns='*', timeout=10):
+    """Wait for change of guest property
+
+    :param vm: Virtual machine name.
+    :param patterns: Patterns of property names, separated by '|'.
+    :param timeout: Time to wait for change, seconds (0 - wait forever).
+    :return: returncode, stdout, stderr. stdout is changed property as {'name': name, 'value': value, 'flags': flags}
+             or None if nothing changed within timeout.
+    """
+    options = f'--timeout={int(timeout * 1000)} --fail-on-timeout' if timeout else ''
+    result = vboxmanage(f'guestproperty wait {vm} {patterns} {options}', timeout=timeout and timeout + 10)
+    if result[0] == 2 and 'Time out' in result[2]:
+        return 0, None, result[2]
+    if result[0] != 0:
+        logging.debug('Unable to wait for guest property of VM "%s": %s', vm, result[2])
+        return result[0], result[1], result[2]
+    properties = guest_properties(result[1])
+    if not properties:
+        return 1, result[1], f'Unexpected output of "guestproperty wait": {result[1]}'
+    return result[0], properties[0], result[2]
+
+
+class PropertyWatcher:
+    """Watch guest properties of running VM and deliver changes to subscribers with "guestproperty wait" (one
+    command per change). Current values are read on start and after every idle period, so changes made between two
+    waits are not lost. Watcher stops when VM is stopped.
+
+    :param vm: Virtual machine name.
+    :param patterns: Patterns of property names to watch, separated by '|'.
+    :param idle_timeout: Time to wait for change before reading current values again, seconds.
+    """
+
+    def __init__(self, vm, patterns='*', idle_timeout=10):
+        self.vm = vm
+        self.patterns = patterns
+        self.idle_timeout = idle_timeout
+        self.values = {}
+        self.subscribers = []
+        self.changed = threading.Condition()
+        self.stopped = threading.Event()
+        # Commands are run by client of caller, log records belong to the same task
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self.run,), daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def subscribe(self, callback, patterns='*'):
+        """Call function on every change of property. Properties already read by watcher are delivered at once
+
+        :param callback: Function called with property name, value and flags (from watcher thread, current values
+        from caller thread).
+        :param patterns: Patterns of property names, separated by '|'.
+        """
+        # Current values and changes are delivered once: update() takes list of subscribers with the same lock
+        with self.changed:
+            self.subscribers.append((patterns, callback))
+            values = list(self.values.items())
+        for name, value in values:
+            self.notify([(patterns, callback)], name, value)
+
+    def update(self, name, value, flags=''):
+        with self.changed:
+            if self.values.get(name) == value:
+                return
+            self.values[name] = value
+            subscribers = list(self.subscribers)
+            self.changed.notify_all()
+        logging.debug('Guest property of VM "%s" changed: %s = "%s"', self.vm, name, value)
+        self.notify(subscribers, name, value, flags)
+
+    @staticmethod
+    def notify(subscribers, name, value, flags=''):
+        for patterns, callback in subscribers:
+            if property_match(name, patterns):
+                try:
+                    callback(name, value, flags)
+                except Exception as error:
+                    logging.error(f'Error in guest property subscriber: {error}')
+
+    def sync(self):
+        result = vm_properties(self.vm, self.patterns)
+        for name, value in (result[1] if result[0] == 0 else {}).items():
+            self.update(name, value)
+        return result[0]
+
+    def run(self):
+        result = self.sync(), None, ''
+        while result[0] == 0 and not self.stopped.is_set():
+            result = vm_property_wait(self.vm, self.patterns, self.idle_timeout)
+            if result[0] == 0 and result[1] is None:
+                result = self.sync(), None, ''
+            elif result[0] == 0:
+                self.update(**result[1])
+        logging.debug('Stopped watching guest properties of VM "%s".', self.vm)
+        self.stop()
+
+    def wait_for(self, patterns, condition=None, timeout=None):
+        """Wait for property with value matching condition
+
+        :param patterns: Patterns of property names, separated by '|'.
+        :param condition: Function called with value, returns True if value is expected (default: value is not empty).
+        :param timeout: Time to wait, seconds (None to wait until watcher is stopped).
+        :return: (name, value) or None if timed out or watcher is stopped.
+        """
+        condition = condition or bool
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.changed:
+            while True:
+                for name, value in self.values.items():
+                    if property_match(name, patterns) and condition(value):
+                        return name, value
+                remaining = deadline - time.time() if deadline is not None else None
+                if self.stopped.is_set() or remaining is not None and remaining <= 0:
+                    return None
+                self.changed.wait(remaining)
+
+    def stop(self):
+        """Stop watching (command waiting for change finishes in background)"""
+        self.stopped.set()
+        with self.changed:
+            self.changed.notify_all()
+
+
 def vm_snapshot_take(vm, snapshot, live=0):
     """Take snapshot for virtual machine
 
@@ -220,17 +963,17 @@ def vm_snapshot_restore(vm, snapshot, ignore_status_error=0):
         logging.info(f'Restoring VM "{vm}" to current snapshot.')
         result = vboxmanage(f'snapshot {vm} restorecurrent')
         if result[0] == 0:
-            logging.debug(f'VM "{vm}" restored to current snapshot.')
+            logging.debug('VM "%s" restored to current snapshot.', vm)
         else:
             logging.error(f'Error while restoring VM "{vm}" to current snapshot: {result[2]}.')
     else:
         logging.info(f'Restoring VM "{vm}" to snapshot "{snapshot}".')
         result = vboxmanage(f'snapshot {vm} restore {snapshot}')
         if result[0] == 0:
-            logging.debug(f'VM "{vm}" restored to snapshot "{snapshot}".')
+            logging.debug('VM "%s" restored to snapshot "%s".', vm, snapshot)
         else:
             if 'Could not find a snapshot' in result[2] and ignore_status_error:
-                logging.debug(f'VM "{vm}" does not have snapshot "{snapshot}": {result[2]}.')
+                logging.debug('VM "%s" does not have snapshot "%s": %s.', vm, snapshot, result[2])
             else:
                 logging.error(f'Error while restoring VM "{vm}" to snapshot "{snapshot}": {result[2]}.')
     return result[0], result[1], result[2]
@@ -252,6 +995,103 @@ def vm_snapshot_remove(vm, snapshot):
     return result[0], result[1], result[2]
 
 
+def snapshot_tree(output):
+    """Parse output of list_snapshots(vm, list=0)
+
+    :param output: Output of "snapshot list --machinereadable".
+    :return: list of snapshots as {'name': name, 'uuid': uuid, 'node': '-1-2', 'parent': '-1', 'current': bool}.
+             Root snapshot has node '' and parent None.
+    """
+    current = re.search(r'^CurrentSnapshotUUID="(.*)"$', output, flags=re.MULTILINE)
+    snapshots = {}
+    for field, node, value in snapshot_pattern.findall(output):
+        snapshot = snapshots.setdefault(node, {'node': node, 'parent': node.rsplit('-', 1)[0] if node else None})
+        snapshot[field.lower()] = value
+    for snapshot in snapshots.values():
+        snapshot['current'] = bool(current) and snapshot.get('uuid') == current[1]
+    return list(snapshots.values())
+
+
+def vm_disk_usage(vm):
+    """Return disk space used by virtual machine folder and snapshots folder
+
+    :param vm: Virtual machine name.
+    :return: returncode, stdout (size in bytes), stderr.
+    """
+    result = vm_info(vm)
+    if result[0] != 0:
+        return result[0], result[1], result[2]
+    folders = {os.path.dirname(result[1].get('CfgFile', '')), result[1].get('SnapFldr', '')}
+    files = set()
+    for folder in folders:
+        for path, _, names in os.walk(folder) if folder else []:
+            files.update(os.path.join(path, name) for name in names)
+    return 0, sum(os.path.getsize(file) for file in files if os.path.isfile(file)), ''
+
+
+def vm_backup_cleanup(vm, keep_last=None, max_age=None, dry_run=0):
+    """Remove old backup snapshots (taken by vm_backup()) of powered off or saved virtual machine.
+    Backup is kept if it is one of the last "keep_last" backups or is not older than "max_age" days. Current snapshot
+    and other snapshots are never removed. Snapshots are removed oldest first (disks are merged by VirtualBox).
+
+    :param vm: Virtual machine name.
+    :param keep_last: Number of backups to keep.
+    :param max_age: Keep backups taken within this number of days.
+    :param dry_run: Only return backups to remove.
+    :return: returncode, stdout, stderr. stdout is {'removed': [names], 'kept': [names], 'reclaimed': bytes}.
+    """
+    if keep_last is None and max_age is None:
+        logging.error('Retention policy for backups is not set.')
+        return 1, None, 'Retention policy for backups is not set'
+    result = vm_info(vm)
+    if result[0] != 0:
+        return result[0], result[1], result[2]
+    if result[1].get('VMState') not in ['poweroff', 'saved', 'aborted']:
+        logging.warning(f'VM "{vm}" is {result[1].get("VMState")}. Backups are removed only from idle VMs.')
+        return 1, None, f'VM "{vm}" is not idle'
+    result = list_snapshots(vm, list=0)
+    if result[0] != 0:
+        # VM without snapshots
+        if 'does not have any snapshots' in result[2]:
+            return 0, {'removed': [], 'kept': [], 'reclaimed': 0}, ''
+        return result[0], result[1], result[2]
+
+    # Backups, newest first
+    backups = []
+    for snapshot in snapshot_tree(result[1]):
+        match = backup_pattern.match(snapshot.get('name', ''))
+        if match:
+            taken = datetime.datetime.strptime(match[1], '%Y_%m_%d_%H_%M_%S')
+            backups.append((taken, snapshot))
+    backups.sort(key=lambda backup: backup[0], reverse=True)
+    now = datetime.datetime.now()
+    removed, kept = [], []
+    for number, (taken, snapshot) in enumerate(backups):
+        if snapshot['current'] or keep_last is not None and number < keep_last or \
+                max_age is not None and now - taken <= datetime.timedelta(days=max_age):
+            kept.append(snapshot)
+        else:
+            removed.append(snapshot)
+    removed.reverse()
+    if dry_run or not removed:
+        return 0, {'removed': [snapshot['name'] for snapshot in removed],
+                   'kept': [snapshot['name'] for snapshot in kept], 'reclaimed': 0}, ''
+
+    # Remove by UUID, names of snapshots may be not unique
+    size_before = vm_disk_usage(vm)[1]
+    removed_names = []
+    for snapshot in removed:
+        result = vm_snapshot_remove(vm, snapshot['uuid'])
+        if result[0] != 0:
+            break
+        removed_names.append(snapshot['name'])
+    size_after = vm_disk_usage(vm)[1]
+    reclaimed = size_before - size_after if isinstance(size_before, int) and isinstance(size_after, int) else 0
+    logging.info(f'Removed {len(removed_names)} backups of VM "{vm}", {round(reclaimed / 1024 / 1024)} MB reclaimed.')
+    return result[0], {'removed': removed_names, 'kept': [snapshot['name'] for snapshot in kept],
+                       'reclaimed': reclaimed}, result[2]
+
+
 def vm_network(vm, link_state):
     """Change guest OS network link state
 
@@ -263,7 +1103,7 @@ def vm_network(vm, link_state):
         logging.info(f'Setting network parameters to {link_state} for VM {vm}')
         result = vboxmanage(f'controlvm {vm} setlinkstate1 {link_state}')
         if result[0] == 0:
-            logging.debug(f'Network state set.')
+            logging.debug('Network state set.')
         else:
             logging.error(f'Unable to change network state for VM: {result[2]}.')
         return result[0], result[1], result[2]
@@ -271,6 +1111,47 @@ def vm_network(vm, link_state):
         return 0, 0, 0
 
 
+def network_profile_settings(profile, hostonly_adapter='vboxnet0', internal_network='vm-automation'):
+    """Return settings of first network adapter for network profile
+
+    :param profile: Network profile: 'offline' (link is down, attachment is not changed), 'nat', 'hostonly',
+                    'internal'. See network_profiles.
+    :param hostonly_adapter: Host-only adapter used by 'hostonly' profile.
+    :param internal_network: Name of internal network used by 'internal' profile.
+    :return: settings as {'modifyvm option': ('showvminfo setting', 'value')}.
+    """
+    nic = network_profiles[profile]['nic']
+    settings = {}
+    if nic:
+        settings['--nic1'] = ('nic1', nic)
+    if nic == 'hostonly':
+        settings['--hostonlyadapter1'] = ('hostonlyadapter1', hostonly_adapter)
+    elif nic == 'intnet':
+        settings['--intnet1'] = ('intnet1', internal_network)
+    settings['--cableconnected1'] = ('cableconnected1', network_profiles[profile]['cable'])
+    return settings
+
+
+def vm_network_profile(vm, profile, hostonly_adapter='vboxnet0', internal_network='vm-automation'):
+    """Apply network profile to running virtual machine (use vm_config() for stopped one)
+
+    :param vm: Virtual machine name.
+    :param profile: Network profile, see network_profile_settings().
+    :param hostonly_adapter: Host-only adapter used by 'hostonly' profile.
+    :param internal_network: Name of internal network used by 'internal' profile.
+    :return: returncode, stdout, stderr.
+    """
+    logging.info(f'Setting network profile "{profile}" for VM {vm}')
+    nic = network_profiles[profile]['nic']
+    arguments = {'hostonly': f' {hostonly_adapter}', 'intnet': f' {internal_network}'}.get(nic, '')
+    if nic:
+        result = vboxmanage(f'controlvm {vm} nic1 {nic}{arguments}')
+        if result[0] != 0:
+            logging.error(f'Unable to change network adapter of VM: {result[2]}.')
+            return result[0], result[1], result[2]
+    return vm_network(vm, network_profiles[profile]['cable'])
+
+
 def vm_set_resolution(vm, screen_resolution):
     """Control guest OS screen resolution
 
@@ -282,7 +1163,7 @@ def vm_set_resolution(vm, screen_resolution):
         return 0, 0, 0
     if screen_resolution == 'random':
         screen_resolution = random.choice['1024 768 32', '1280 1024 32', '1440 1080 32', '1600 1200 32', '1920 1080 32']
-    logging.debug(f'Changing screen resolution for VM "{vm}".')
+    logging.debug('Changing screen resolution for VM "%s".', vm)
     result = vboxmanage(f'controlvm {vm} setvideomodehint {screen_resolution}')
     if result[0] == 0:
         logging.debug('Screen resolution changed.')
@@ -298,7 +1179,7 @@ def vm_set_mac(vm, mac):
     :param mac: New MAC address.
     :return: returncode, stdout, stderr.
     """
-    logging.debug(f'Changing MAC address for VM "{vm}".')
+    logging.debug('Changing MAC address for VM "%s".', vm)
     if mac == 'new':
         # Generate new MAC in VirtualBox range (080027xxxxxx)
         mac = f'080027{secrets.token_hex(3)}'
@@ -322,24 +1203,31 @@ def vm_pcap(vm, file):
     """
     result = vboxmanage(f'modifyvm {vm} --nictrace1 on --nictracefile1 {file}')
     if result[0] == 0:
-        logging.debug(f'Saving network traffic from VM "{vm}" as {file}.')
+        logging.debug('Saving network traffic from VM "%s" as %s.', vm, file)
     else:
         logging.error(f'Unable to update VM settings to capture traffic: {result[2]}')
     return result[0], result[1], result[2]
 
 
-def vm_memdump(vm, file):
+def vm_memdump(vm, file, background=0):
     """Dump VM memory to a file
 
     :param vm: Virtual machine name.
     :param file: Output file.
+    :param background: Do not wait for dump to finish, return VBoxOperation object as stdout.
     :return: returncode, stdout, stderr.
     """
-    result = vboxmanage(f'debugvm {vm} dumpvmcore --filename={file}')
-    if result[0] == 0:
-        logging.debug(f'Dumping memory of VM "{vm}" as {file}.')
-    else:
-        logging.error(f'Unable to dump VM memory: {result[2]}')
+    def finished(result):
+        if result[0] == 0:
+            logging.debug('Memory of VM "%s" dumped as %s.', vm, file)
+        else:
+            logging.error(f'Unable to dump VM memory: {result[2]}')
+        return result
+
+    logging.debug('Dumping memory of VM "%s" as %s.', vm, file)
+    if background:
+        return 0, vboxmanage_start(f'debugvm {vm} dumpvmcore --filename={file}', finished=finished), ''
+    result = finished(vboxmanage(f'debugvm {vm} dumpvmcore --filename={file}'))
     return result[0], result[1], result[2]
 
 
@@ -349,14 +1237,106 @@ def vm_disable_time_sync(vm):
     :param vm: Virtual machine name.
     :return: returncode, stdout, stderr.
     """
-    result = vboxmanage(f'setextradata {vm} "VBoxInternal/Devices/VMMDev/0/Config/GetHostTimeDisabled" "1"')
+    result = vboxmanage(f'setextradata {vm} VBoxInternal/Devices/VMMDev/0/Config/GetHostTimeDisabled 1')
     if result[0] == 0:
-        logging.debug(f'Time sync disabled for VM "{vm}".')
+        logging.debug('Time sync disabled for VM "%s".', vm)
+        extradata_cache.setdefault(vm, {})['VBoxInternal/Devices/VMMDev/0/Config/GetHostTimeDisabled'] = '1'
     else:
         logging.error(f'Unable to disable time sync for VM: {result[2]}')
     return result[0], result[1], result[2]
 
 
+def vm_info(vm):
+    """Return virtual machine settings and state
+
+    :param vm: Virtual machine name.
+    :return: returncode, stdout (as {'setting': 'value'} dictionary), stderr.
+    """
+    stream = vboxmanage_stream(f'showvminfo {vm} --machinereadable')
+    info = dict(parse_info(stream))
+    if stream.returncode == 0:
+        return stream.returncode, info, stream.stderr
+    else:
+        logging.error(f'Unable to get VM "{vm}" information: {stream.stderr}')
+        return stream.returncode, '', stream.stderr
+
+
+def vm_config(vm, config, info=None):
+    """Apply settings to stopped virtual machine. Settings which already match are skipped,
+    all other are applied with one 'modifyvm' command
+
+    :param vm: Virtual machine name.
+    :param config: Settings as dictionary. Supported keys: 'mac' (MAC address, 'new' or 'random'),
+    'network' ('on'/'off'), 'network_profile' (see network_profile_settings(), with 'hostonly_adapter' and
+    'internal_network'), 'pcap' (output file), 'time_sync' (0 to disable),
+    'recording' ({'filename': ..., 'profile': ..., 'screens': ..., 'duration': ...}).
+    :param info: Current VM settings from vm_info(). Obtained if not set.
+    :return: returncode, stdout (list of applied options), stderr.
+    """
+    if info is None:
+        result = vm_info(vm)
+        if result[0] != 0:
+            return result[0], result[1], result[2]
+        info = result[1]
+
+    # Desired settings as {'option': ('showvminfo setting', 'value')}
+    desired = {}
+    mac = config.get('mac')
+    if mac == 'new':
+        # Generate new MAC in VirtualBox range (080027xxxxxx)
+        mac = f'080027{secrets.token_hex(3)}'
+    elif mac == 'random':
+        # Fully random MAC
+        mac = secrets.token_hex(6)
+    if mac:
+        desired['--macaddress1'] = ('macaddress1', mac.upper())
+    if config.get('network') in ['on', 'off']:
+        if info.get('VMState', 'saved') == 'saved':
+            # Link state of VM with saved state is set after start, see vm_network()
+            logging.debug('VM "%s" has saved state. Network state will not be changed.', vm)
+        else:
+            desired['--cableconnected1'] = ('cableconnected1', config['network'])
+    if config.get('network_profile'):
+        if info.get('VMState', 'saved') == 'saved':
+            # Network adapter of VM with saved state is changed after start, see vm_network_profile()
+            logging.debug('VM "%s" has saved state. Network profile will be applied after start.', vm)
+        else:
+            desired.update(network_profile_settings(config['network_profile'],
+                                                    config.get('hostonly_adapter', 'vboxnet0'),
+                                                    config.get('internal_network', 'vm-automation')))
+    if config.get('pcap'):
+        desired['--nictrace1'] = ('nictrace1', 'on')
+        desired['--nictracefile1'] = ('nictracefile1', config['pcap'])
+    if config.get('recording'):
+        recording_settings = {'--recording': 'recording_enabled',
+                              '--recordingfile': 'rec_screen_dest_filename',
+                              '--recordingvideofps': 'rec_screen_video_fps',
+                              '--recordingvideorate': 'rec_screen_video_rate_kbps'}
+        for option, value in recording_options(**config['recording']).items():
+            desired[option] = (recording_settings.get(option), str(value))
+
+    # Skip settings which already match
+    options = [f'{option} {value}' for option, (setting, value) in desired.items()
+               if setting is None or info.get(setting) != value]
+    skipped = len(desired) - len(options)
+    if options:
+        logging.debug('Updating VM "%s" settings: %s (%s already set).', vm, ' '.join(options), skipped)
+        result = vboxmanage(f'modifyvm {vm} {" ".join(options)}')
+        if result[0] != 0:
+            logging.error(f'Unable to update VM settings: {result[2]}')
+            return result[0], result[1], result[2]
+    else:
+        logging.debug('VM "%s" settings already match (%s settings).', vm, skipped)
+
+    # Extra data can not be obtained from 'showvminfo', so only values set by this process are known
+    if config.get('time_sync') == 0 and \
+            extradata_cache.get(vm, {}).get('VBoxInternal/Devices/VMMDev/0/Config/GetHostTimeDisabled') != '1':
+        result = vm_disable_time_sync(vm)
+        if result[0] != 0:
+            return result[0], result[1], result[2]
+    return 0, options, ''
+
+
 def vm_exec(vm, username, password, remote_file, open_with='%windir%\\explorer.exe', file_args=None):
     """Execute file/command on guest OS
 
@@ -391,7 +1371,7 @@ def vm_file_stat(vm, username, password, remote_file):
     :param remote_file: Path to file on guest OS.
     :return: returncode, stdout, stderr.
     """
-    logging.debug(f'Checking if file "{remote_file}" exist on VM "{vm}".')
+    logging.debug('Checking if file "%s" exist on VM "%s".', remote_file, vm)
     result = vboxmanage(f'guestcontrol {vm} --username {username} --password {password} stat {remote_file}')
     if result[0] == 0:
         logging.debug('File exist.')
@@ -414,7 +1394,7 @@ def vm_copyto(vm, username, password, local_file, remote_file):
     result = vboxmanage(
         f'guestcontrol {vm} --username {username} --password {password} copyto {local_file} {remote_file}')
     if result[0] == 0:
-        logging.debug(f'File uploaded.')
+        logging.debug('File uploaded.')
     else:
         logging.error(f'Error while uploading file: {result[2]}')
     return result[0], result[1], result[2]
@@ -449,7 +1429,7 @@ def vm_copyfrom(vm, username, password, remote_file, local_file):
     result = vboxmanage(
         f'guestcontrol {vm} --username {username} --password {password} copyfrom {remote_file} {local_file}')
     if result[0] == 0:
-        logging.debug(f'File downloaded.')
+        logging.debug('File downloaded.')
     else:
         logging.error(f'Error while downloading file: {result[2]}')
     return result[0], result[1], result[2]
@@ -477,7 +1457,7 @@ def vm_screenshot(vm, screenshot_name):
     :param screenshot_name: Name of file to save screenshot as.
     :return: returncode, stdout, stderr.
     """
-    logging.debug(f'Taking screenshot "{screenshot_name}" on VM "{vm}".')
+    logging.debug('Taking screenshot "%s" on VM "%s".', screenshot_name, vm)
     result = vboxmanage(f'controlvm {vm} screenshotpng {screenshot_name}')
     if result[0] == 0:
         logging.debug('Screenshot created.')
@@ -534,6 +1514,49 @@ def vm_record(vm, filename, screens='all', fps=10, videorate=512, duration=0):
     return result[0], result[1], result[2]
 
 
+def recording_options(filename, profile='normal', screens='all', duration=0):
+    """Return 'modifyvm' options to enable screen recording
+
+    :param filename: Name of file to save video as (.webm).
+    :param profile: Recording profile (see recording_profiles).
+    :param screens: Screens to record.
+    :param duration: Record duration, seconds.
+    :return: options as {'option': 'value'} dictionary.
+    """
+    if profile not in recording_profiles:
+        logging.error('Unknown recording profile set. Assuming normal.')
+        profile = 'normal'
+    options = {'--recording': 'on',
+               '--recordingscreens': screens,
+               '--recordingfile': filename,
+               '--recordingvideofps': recording_profiles[profile]['fps'],
+               '--recordingvideorate': recording_profiles[profile]['videorate']}
+    if duration > 0:
+        options['--recordingmaxtime'] = duration
+    return options
+
+
+def vm_record_setup(vm, filename, profile='normal', screens='all', duration=0):
+    """Enable screen recording for stopped VM with one command. Recording starts with VM
+
+    :param vm: Virtual machine name.
+    :param filename: Name of file to save video as (.webm).
+    :param profile: Recording profile (see recording_profiles).
+    :param screens: Screens to record.
+    :param duration: Record duration, seconds.
+    :return: returncode, stdout, stderr.
+    """
+    logging.info(f'Recording video as "{filename}" on VM "{vm}" ({profile} profile).')
+    options = recording_options(filename, profile, screens, duration)
+    options = ' '.join(f'{option} {value}' for option, value in options.items())
+    result = vboxmanage(f'modifyvm {vm} {options}')
+    if result[0] == 0:
+        logging.debug('Recording enabled.')
+    else:
+        logging.error(f'Unable to update VM settings to record video: {result[2]}')
+    return result[0], result[1], result[2]
+
+
 def vm_record_stop(vm):
     """Stop screen recording on VM
 
@@ -549,15 +1572,37 @@ def vm_record_stop(vm):
     return result[0], result[1], result[2]
 
 
-def vm_import(vm, vm_file, preview=0, timeout=600):
+def vm_capture_off(vm):
+    """Disable traffic dump and screen recording in VM settings (they are kept by VM until snapshot is restored)
+
+    :param vm: Virtual machine name.
+    :return: returncode, stdout, stderr.
+    """
+    result = vboxmanage(f'modifyvm {vm} --nictrace1 off --recording off')
+    if result[0] == 0:
+        logging.debug('Traffic dump and recording disabled for VM "%s".', vm)
+    else:
+        logging.error(f'Unable to update VM settings to disable traffic dump and recording: {result[2]}')
+    return result[0], result[1], result[2]
+
+
+def vm_import(vm, vm_file, preview=0, timeout=None, background=0):
     """Import virtual machine from file
 
     :param vm: Virtual machine name.
     :param vm_file: Path to input file.
     :param preview: Only preview (no actual import).
-    :param timeout: Timeout for operation, seconds.
+    :param timeout: Timeout for operation, seconds (timeout of 'long' command class if not set).
+    :param background: Do not wait for import to finish, return VBoxOperation object as stdout.
     :return: returncode, stdout, stderr.
     """
+    def finished(result):
+        if result[0] == 0:
+            logging.debug('VM imported.')
+        else:
+            logging.error(f'Error while importing VM: {result[2]}')
+        return result
+
     if preview:
         logging.info(f'Importing file {vm_file} in preview mode.')
         options = '--dry-run'
@@ -565,50 +1610,82 @@ def vm_import(vm, vm_file, preview=0, timeout=600):
         logging.info(f'Importing file {vm_file}.')
         options = ''
     if vm:
-        result = vboxmanage(f'import {vm_file} {options} --vmname {vm}', timeout=timeout)
-    else:
-        result = vboxmanage(f'import {vm} {options}', timeout=timeout)
-    if result[0] == 0:
-        logging.debug('VM imported.')
+        cmd = f'import {vm_file} {options} --vsys 0 --vmname {vm}'
     else:
-        logging.error(f'Error while importing VM: {result[2]}')
+        cmd = f'import {vm_file} {options}'
+    if background:
+        return 0, vboxmanage_start(cmd, timeout=timeout, finished=finished), ''
+    result = finished(vboxmanage(cmd, timeout=timeout))
     return result[0], result[1], result[2]
 
 
-def vm_export(vm, vm_file, file_format='ovf20', timeout=600):
+def vm_export(vm, vm_file, file_format='ovf20', timeout=None, background=0):
     """Export virtual machine to file
 
     :param vm: Virtual machine name.
     :param vm_file: Path to output file.
     :param file_format: Format for output file.
-    :param timeout: Timeout for operation, seconds.
+    :param timeout: Timeout for operation, seconds (timeout of 'long' command class if not set).
+    :param background: Do not wait for export to finish, return VBoxOperation object as stdout.
     :return: returncode, stdout, stderr.
     """
+    def finished(result):
+        if result[0] == 0:
+            logging.debug('VM exported.')
+        else:
+            logging.error(f'Error while exporting VM: {result[2]}')
+        return result
+
     if file_format not in ['legacy09', 'ovf09', 'ovf10', 'ovf20', 'opc10']:
         logging.error('Unknown file format. Exiting.')
         exit()
     logging.info(f'Exporting VM "{vm}" as {vm_file}.')
-    result = vboxmanage(f'export {vm} --output {vm_file}', timeout=timeout)
-    if result[0] == 0:
-        logging.debug('VM exported.')
-    else:
-        logging.error(f'Error while exporting VM: {result[2]}')
+    if background:
+        return 0, vboxmanage_start(f'export {vm} --output {vm_file}', timeout=timeout, finished=finished), ''
+    result = finished(vboxmanage(f'export {vm} --output {vm_file}', timeout=timeout))
     return result[0], result[1], result[2]
 
 
-def vm_clone(vm, name, mode='all', register=1, timeout=600):
+def vm_clone(vm, name, mode='all', register=1, timeout=None, background=0, snapshot=None, linked=0, groups=None):
     """Clone virtual machine
 
     :param vm: Virtual machine to clone.
     :param name: Clone name.
     :param mode: Clone mode (machine/machinechildren/all).
     :param register: Register cloned virtual machine.
-    :param timeout: Timeout for operation, seconds.
-    :return:
+    :param timeout: Timeout for operation, seconds (timeout of 'long' command class if not set).
+    :param background: Do not wait for clone to finish, return VBoxOperation object as stdout.
+    :param snapshot: Clone state of virtual machine in snapshot.
+    :param linked: Create linked clone (uses disks of snapshot, snapshot must be set).
+    :param groups: Groups of cloned virtual machine ('/group').
+    :return: returncode, stdout, stderr.
     """
     if register:
         options = '--register'
     else:
         options = ''
+    if snapshot:
+        options += f' --snapshot={snapshot}'
+    if linked:
+        options += ' --options=link'
+    if groups:
+        options += f' --groups={groups}'
+    if background:
+        return 0, vboxmanage_start(f'clonevm {vm} --mode={mode} --name={name} {options}', timeout=timeout), ''
     result = vboxmanage(f'clonevm {vm} --mode={mode} --name={name} {options}', timeout=timeout)
     return result[0], result[1], result[2]
+
+
+def vm_remove(vm):
+    """Unregister virtual machine and delete all its files
+
+    :param vm: Virtual machine name.
+    :return: returncode, stdout, stderr.
+    """
+    logging.info(f'Removing VM "{vm}".')
+    result = vboxmanage(f'unregistervm {vm} --delete')
+    if result[0] == 0:
+        logging.debug('VM "%s" removed.', vm)
+    else:
+        logging.error(f'Error while removing VM "{vm}": {result[2]}')
+    return result[0], result[1], result[2]